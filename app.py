@@ -7,10 +7,11 @@ import logging
 import random
 import traceback
 
-from bge import get_sentence_embedding, load_model
+from bge import embedding_cache, get_sentence_embedding, load_model
 import werkzeug
 from werkzeug.middleware.proxy_fix import ProxyFix
 import database
+import file_staging
 from flask import Flask, jsonify, request, send_file, send_from_directory
 from flask_cors import CORS
 import os
@@ -53,6 +54,7 @@ app.wsgi_app = ProxyFix(
     x_prefix=1,  # Number of proxies that set X-Forwarded-Prefix
 )
 load_model()
+database.init_app(app)
 
 # Enable CORS for all origins (prototype only)
 CORS(app, origins="*", allow_headers=["Content-Type", "Authorization"], methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
@@ -71,6 +73,18 @@ os.makedirs(IMAGES_FOLDER, exist_ok=True)
 # Valid file tags
 VALID_TAGS = ["dispense", "appunti", "esercizi"]
 
+# Users allowed to read the operational /stats routes (comma separated user ids), nobody by default
+STATS_ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv("STATS_ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+
+def require_stats_admin() -> None:
+    """
+    Raises:
+        ForbiddenError: If the authenticated user is not in STATS_ADMIN_USER_IDS
+    """
+    if str(get_jwt_identity()) not in STATS_ADMIN_USER_IDS:
+        raise ForbiddenError("Stats are only available to administrators")
+
 # ---------------------------------------------
 # Error handlers
 # ---------------------------------------------
@@ -233,6 +247,7 @@ def new_search():
     New semantic + keyword search endpoint using vector embeddings and full-text search.
     Query parameter: 'q' - the search query string
     Additional filter parameters: course_name, faculty, canale, language, date_year, course_year, tag, extension
+    Optional ANN tuning parameters (recall vs latency): ef_search (HNSW index), probes (IVFFlat index)
     """
     query_data = request.args.to_dict()
     for key, value in query_data.items():
@@ -240,12 +255,19 @@ def new_search():
             query_data[key] = None
 
     validated_params = SearchRequest(**query_data)
-    filter_params = {k: v for k, v in validated_params.model_dump().items() if k != "q" and v is not None}
+    filter_params = {k: v for k, v in validated_params.model_dump().items() if k not in ("q", "ef_search", "probes") and v is not None}
 
     query_embedding = get_sentence_embedding(validated_params.q).squeeze()
     current_user_id = get_jwt_identity()
 
-    vetrine, chunks = database.new_search(validated_params.q, query_embedding, filter_params, current_user_id)
+    vetrine, chunks = database.new_search(
+        validated_params.q,
+        query_embedding,
+        filter_params,
+        current_user_id,
+        ef_search=validated_params.ef_search,
+        probes=validated_params.probes,
+    )
 
     return (
         jsonify(
@@ -290,31 +312,27 @@ def upload_file(vetrina_id):
     if tag and tag not in VALID_TAGS:
         return jsonify({"error": "invalid_tag", "msg": f"Invalid tag. Valid tags are: {', '.join(VALID_TAGS)}"}), 400
 
-    # Read file content into memory for processing
-    file_content = file.read()
-    # file_size = len(file_content)
-
     new_file_name = "-".join([str(uuid.uuid4()), str(requester_id), file.filename])
-    new_file_path = os.path.join(FILES_FOLDER, new_file_name)
-
-    if os.path.exists(new_file_path):
-        return jsonify({"error": "file_already_exists", "msg": "File already exists"}), 500
-
     display_name = request.form.get("display_name", file.filename[: -len(extension) - 1]).strip()
 
-    database.add_file_to_processing_queue(
-        requester_id=requester_id,
-        vetrina_id=vetrina_id,
-        file_name=new_file_name,
-        extension=extension,
-        price=random.uniform(0.5, 1.0),
-        tag=tag,
-        file_data=file_content,
-        display_name=display_name,
-    )
-
-    with open(new_file_path, "wb") as f:
-        f.write(file_content)
+    # Stream the upload to the staging folder, the queue only references it by path
+    staged_path, sha256, size = file_staging.stage_upload(file.stream, new_file_name)
+    try:
+        database.add_file_to_processing_queue(
+            requester_id=requester_id,
+            vetrina_id=vetrina_id,
+            file_name=new_file_name,
+            extension=extension,
+            price=random.uniform(0.5, 1.0),
+            tag=tag,
+            staged_path=staged_path,
+            sha256=sha256,
+            size=size,
+            display_name=display_name,
+        )
+    except Exception:
+        file_staging.remove_staged_file(staged_path)
+        raise
 
     try:
         file.close()
@@ -654,5 +672,26 @@ def get_valid_tags():
     return jsonify({"tags": VALID_TAGS}), 200
 
 
+# ---------------------------------------------
+# Stats routes
+# ---------------------------------------------
+
+
+@app.route("/stats/embedding-cache", methods=["GET"])
+@jwt_required()
+def get_embedding_cache_stats():
+    """Get hit/miss counters of the query embedding cache."""
+    require_stats_admin()
+    return jsonify(embedding_cache.stats()), 200
+
+
+@app.route("/stats/db-pool", methods=["GET"])
+@jwt_required()
+def get_db_pool_stats():
+    """Get the database connection pool counters."""
+    require_stats_admin()
+    return jsonify(database.get_pool_stats()), 200
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", debug=True)
@@ -0,0 +1,175 @@
+"""
+Accuracy drift and latency of the embedding precisions (see BGETextBase.set_precision).
+
+Every precision is loaded in its own process and encodes the same fixed query set. The report
+compares its embeddings with the fp32 ones: cosine similarity per query and overlap of the top-k
+neighbours retrieved from the corpus (the query set itself unless --corpus is given), which is
+what a search with the reduced precision query encoder would lose. With --images the multimodal
+path (Visualized_BGE.encode_mm_batch) is measured too, pairing each query with one of the images.
+
+Usage:
+    python benchmark_precision.py [--precisions fp32,bf16,int8] [--corpus corpus.txt] [--images a.png b.png] [--k 10]
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+import torch
+
+MODELS_FOLDER = os.getenv("MODELS_FOLDER")
+model_path = os.path.join(MODELS_FOLDER or ".", "Visualized_m3.pth")
+
+QUERIES = [
+    "appunti di analisi matematica 1",
+    "esercizi svolti sugli integrali",
+    "limiti notevoli e forme indeterminate",
+    "riassunto di diritto privato",
+    "il contratto e i suoi elementi essenziali",
+    "termodinamica primo principio",
+    "equazioni di Maxwell in forma differenziale",
+    "algoritmi di ordinamento e complessità",
+    "alberi binari di ricerca",
+    "microeconomia domanda e offerta",
+    "bilancio d'esercizio stato patrimoniale",
+    "anatomia del sistema nervoso centrale",
+    "ciclo di Krebs",
+    "storia contemporanea seconda guerra mondiale",
+    "la Divina Commedia Inferno canto V",
+    "statistica test di ipotesi",
+    "linear algebra eigenvalues and eigenvectors",
+    "organic chemistry reaction mechanisms",
+    "introduction to machine learning lecture notes",
+    "cell biology mitosis and meiosis",
+    "macroeconomics inflation and monetary policy",
+    "operating systems process scheduling",
+    "calcolo delle probabilità variabili aleatorie",
+    "scienza delle costruzioni travi isostatiche",
+]
+
+
+def _max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def _time_ms(forward, runs: int) -> list[float]:
+    forward()  # Warm up
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        forward()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def _run(args: tuple) -> dict:
+    precision, texts, images, runs = args
+    torch.set_grad_enabled(False)
+
+    if images:
+        from bge_model import Visualized_BGE
+
+        model = Visualized_BGE(model_weight=model_path, inference=True, precision=precision)
+    else:
+        from bge_text import BGETextEncoder
+
+        model = BGETextEncoder(model_weight=model_path, precision=precision)
+
+    def encode(batch: list[str]) -> np.ndarray:
+        return model.encode(text=batch)[0].cpu().numpy()
+
+    result = {
+        "precision": precision,
+        "embeddings": np.concatenate([encode(texts[i : i + 16]) for i in range(0, len(texts), 16)]),
+        "query_ms": _time_ms(lambda: encode([texts[0]]), runs),
+        "batch_ms": _time_ms(lambda: encode(texts[:16]), max(runs // 4, 1)),
+    }
+
+    if images:
+        from PIL import Image
+
+        images = [Image.open(image).convert("RGB") for image in images]
+        queries = texts[: len(QUERIES)]
+        image_indexes = [i % len(images) for i in range(len(queries))]
+
+        def encode_mm() -> np.ndarray:
+            # The image tokens would be cached after the first pass, clear them to time the whole path
+            model.image_token_cache.clear()
+            return model.encode_mm_batch(images, queries, image_indexes).cpu().numpy()
+
+        result["mm_embeddings"] = encode_mm()
+        result["mm_ms"] = _time_ms(encode_mm, max(runs // 10, 1))
+
+    result["rss_mb"] = _max_rss_mb()
+    return result
+
+
+def _neighbours(embeddings: np.ndarray, i: int, k: int) -> set[int]:
+    ranked = np.argsort(-(embeddings @ embeddings[i]))
+    return {int(j) for j in ranked[ranked != i][:k]}
+
+
+def top_k_overlap(reference: np.ndarray, embeddings: np.ndarray, num_queries: int, k: int) -> float:
+    """Mean fraction of the fp32 top-k neighbours of each query (among all texts) also retrieved with embeddings."""
+    k = min(k, len(reference) - 1)
+    overlaps = []
+    for i in range(num_queries):
+        expected, found = (_neighbours(e, i, k) for e in (reference, embeddings))
+        overlaps.append(len(expected & found) / k)
+    return float(np.mean(overlaps))
+
+
+def drift(reference: np.ndarray, embeddings: np.ndarray) -> tuple[float, float]:
+    """Mean and minimum cosine similarity of each embedding with its fp32 reference."""
+    cosine = np.sum(reference * embeddings, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1))
+    return float(cosine.mean()), float(cosine.min())
+
+
+def benchmark_precisions(precisions: list[str], texts: list[str], images: list[str], runs: int) -> list[dict]:
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for precision in precisions:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_run, ((precision, texts, images, runs),)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy drift and latency of the embedding precisions")
+    parser.add_argument("--precisions", default="fp32,bf16,int8")
+    parser.add_argument("--corpus", default=None, help="Text file with one document per line, added to the retrieval corpus")
+    parser.add_argument("--images", nargs="*", default=[], help="Images to also measure the multimodal path with")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    texts = list(QUERIES)
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            texts += [line.strip() for line in f if line.strip()]
+
+    precisions = [precision for precision in args.precisions.split(",") if precision]
+    if "fp32" not in precisions:
+        precisions.insert(0, "fp32")
+    results = benchmark_precisions(precisions, texts, args.images, args.runs)
+    reference = next(row for row in results if row["precision"] == "fp32")
+
+    print(f"{len(QUERIES)} queries, {len(texts)} texts in the corpus, {torch.get_num_threads()} threads")
+    print(f"{'precision':<10}{'query p50':>10}{'p95':>8}{'batch16':>9}{'RSS MB':>8}{'cos mean':>10}{'cos min':>9}{'top-' + str(args.k):>8}")
+    for row in results:
+        cos_mean, cos_min = drift(reference["embeddings"], row["embeddings"])
+        overlap = top_k_overlap(reference["embeddings"], row["embeddings"], len(QUERIES), args.k)
+        print(
+            f"{row['precision']:<10}{np.percentile(row['query_ms'], 50):>10.1f}{np.percentile(row['query_ms'], 95):>8.1f}"
+            f"{np.percentile(row['batch_ms'], 50):>9.1f}{row['rss_mb']:>8.0f}{cos_mean:>10.5f}{cos_min:>9.5f}{overlap:>8.1%}"
+        )
+
+    if args.images:
+        print(f"\nmultimodal, {len(QUERIES)} (image, query) pairs over {len(args.images)} images")
+        print(f"{'precision':<10}{'ms/pair':>10}{'cos mean':>10}{'cos min':>9}")
+        for row in results:
+            cos_mean, cos_min = drift(reference["mm_embeddings"], row["mm_embeddings"])
+            print(f"{row['precision']:<10}{np.percentile(row['mm_ms'], 50) / len(QUERIES):>10.1f}{cos_mean:>10.5f}{cos_min:>9.5f}")
@@ -1,44 +1,146 @@
 import os
 
-from bge_model import Visualized_BGE
+from bge_export import TracedTextEncoder
+from bge_text import BGETextEncoder
 
 # os.environ['HF_HUB_OFFLINE'] = '1'
 # os.environ['TRANSFORMERS_OFFLINE'] = '1'
 os.environ["HF_HUB_DISABLE_TELEMETRY"] = "1"
 
-from PIL import Image
 import numpy as np
 import logging
 import torch
 import threading
+import queue
+import time
+from concurrent.futures import Future
+
+from embedding_cache import EmbeddingCache, normalize_query
 
 MODELS_FOLDER = os.getenv("MODELS_FOLDER")
 
+# Concurrent query encodings are coalesced into one padded batch of at most
+# EMBEDDING_BATCH_SIZE sentences, waiting at most EMBEDDING_BATCH_WAIT_MS for the batch to fill
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 16))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", 5))
+
+# Query embedding cache, EMBEDDING_MODEL_VERSION must change whenever the weights change
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 2048))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", 24 * 3600))
+EMBEDDING_CACHE_REDIS_URL = os.getenv("EMBEDDING_CACHE_REDIS_URL")
+EMBEDDING_MODEL_VERSION = os.getenv("EMBEDDING_MODEL_VERSION", "Visualized_m3")
+
+# Precision of the query encoder: fp32, bf16 or int8 (see BGETextBase.set_precision), measure the
+# drift and the speedup on this machine with benchmark_precision.py before changing it
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "fp32")
+# Directory of the text encoder exported with bge_export.py, used instead of the eager model when set
+EMBEDDING_GRAPH_DIR = os.getenv("EMBEDDING_GRAPH_DIR")
+
 
 model_path = os.path.join(MODELS_FOLDER, "Visualized_m3.pth")
 model = None
 model_lock = threading.Lock()
 
 
+class EmbeddingBatcher:
+    """Background thread that encodes queued sentences in batches and resolves their futures."""
+
+    def __init__(self, max_batch_size: int, max_wait_ms: float):
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait_ms / 1000
+        self.queue: queue.Queue = queue.Queue()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self.thread.start()
+
+    def submit(self, sentence: str) -> Future:
+        future = Future()
+        self.queue.put((sentence, future))
+        self.start()
+        return future
+
+    def _collect_batch(self) -> list[tuple[str, Future]]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            # Drop requests whose caller cancelled while waiting in the queue
+            batch = [(sentence, future) for sentence, future in self._collect_batch() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            sentences = [sentence for sentence, _ in batch]
+            futures = [future for _, future in batch]
+
+            try:
+                embeddings = encode_sentences(sentences)
+            except Exception as e:
+                logging.error(f"Error encoding batch of {len(sentences)} sentences: {e}")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            logging.debug(f"Encoded batch of {len(sentences)} sentences")
+            for i, future in enumerate(futures):
+                future.set_result(embeddings[i : i + 1])
+
+
+batcher = EmbeddingBatcher(EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT_MS)
+embedding_cache = EmbeddingCache(
+    max_size=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    # Reduced precision embeddings drift from the fp32 ones, they don't share cache entries
+    model_version=EMBEDDING_MODEL_VERSION if EMBEDDING_PRECISION == "fp32" else f"{EMBEDDING_MODEL_VERSION}-{EMBEDDING_PRECISION}",
+    redis_url=EMBEDDING_CACHE_REDIS_URL,
+)
+
+
 def load_model():
     global model
 
     with model_lock:
         if model is None:
             logging.debug(f"Loading BGE model...")
-            model = Visualized_BGE(model_weight=model_path)
-            model.eval()
+            # The API only encodes queries, the vision tower (and eva_clip) stay in the workers
+            if EMBEDDING_GRAPH_DIR:
+                model = TracedTextEncoder(EMBEDDING_GRAPH_DIR, precision=EMBEDDING_PRECISION, model_weight=model_path)
+            else:
+                model = BGETextEncoder(model_weight=model_path, precision=EMBEDDING_PRECISION)
     return model
 
 
-def get_sentence_embedding(sentence: str) -> np.ndarray:
+def encode_sentences(sentences: list[str]) -> np.ndarray:
+    """Encode a list of sentences in a single padded forward pass, returns a [N, 1024] array."""
     with torch.no_grad():
-        return model.encode(text=sentence)[0].detach().cpu().numpy()
+        texts = model.tokenizer(sentences, return_tensors="pt", padding=True)
+        return model.encode_text(texts.to(model.device))[0].detach().cpu().numpy()
 
 
-def get_chunk_embeddings(description: str, image: Image.Image, context: str) -> np.ndarray:
-    with torch.no_grad():
-        return model.encode(image=image, text=f"{description} {context}")[0].detach().cpu().numpy()
+def get_sentence_embedding(sentence: str) -> np.ndarray:
+    # Only the cache key is normalized, the query is encoded as typed (the tokenizer is case-sensitive)
+    key = normalize_query(sentence)
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    if EMBEDDING_BATCH_SIZE <= 1:
+        embedding = encode_sentences([sentence])
+    else:
+        embedding = batcher.submit(sentence).result()
+    embedding_cache.set(key, embedding)
+    return embedding
 
 
 def unload_model():
@@ -0,0 +1,226 @@
+"""
+TorchScript export of the BGE-M3 text path (BGETextEncoder.encode_text) for the query encoder.
+
+export traces encode_text once per sequence length bucket and freezes the graphs, so the weights
+are folded in and the attention mask construction runs inside the graph. At runtime
+TracedTextEncoder pads every batch to the smallest bucket holding it and runs the matching
+graph: no HuggingFace module tree is built and the eager Python code isn't run per query.
+The batch dimension stays dynamic, only the sequence length is bucketed. Inputs longer than the
+largest bucket are encoded by the eager model, loaded the first time one comes in.
+
+Usage:
+    python bge_export.py export OUTPUT_DIR [--buckets 16,32,64,128,256,512] [--precision fp32|int8]
+    python bge_export.py parity OUTPUT_DIR [--runs 20]
+
+parity compares the exported graphs with the eager model on the benchmark_precision.py queries
+(every bucket, batch of 1 and of many, and an input longer than the largest bucket) and exits
+with status 1 when they drift beyond the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import torch
+from torch import nn, Tensor
+
+from bge_text import BGETextEncoder, load_tokenizer
+
+MODELS_FOLDER = os.getenv("MODELS_FOLDER")
+model_path = os.path.join(MODELS_FOLDER or ".", "Visualized_m3.pth")
+
+SEQUENCE_BUCKETS = (16, 32, 64, 128, 256, 512)
+MANIFEST_NAME = "manifest.json"
+PARITY_TOLERANCE = 1e-4  # Max absolute difference of an embedding component with the eager model
+
+logger = logging.getLogger(__name__)
+
+
+class TextEmbeddingGraph(nn.Module):
+    """(input_ids, attention_mask) -> normalized CLS embeddings, the traced function"""
+
+    def __init__(self, encoder: BGETextEncoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids: Tensor, attention_mask: Tensor) -> Tensor:
+        return self.encoder.encode_text({"input_ids": input_ids, "attention_mask": attention_mask})[0]
+
+
+def graph_path(directory: str, length: int) -> str:
+    return os.path.join(directory, f"bge_text_{length}.pt")
+
+
+def read_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def export_text_encoder(encoder: BGETextEncoder, directory: str, buckets: tuple[int, ...] = SEQUENCE_BUCKETS) -> None:
+    """
+    Trace and freeze encode_text for each sequence length bucket, and write the manifest.
+
+    Raises:
+        ValueError: If the encoder runs in bf16, autocast can't be traced
+    """
+    if encoder.precision == "bf16":
+        raise ValueError("bf16 autocast can't be exported, export in fp32 or int8")
+    os.makedirs(directory, exist_ok=True)
+
+    graph = TextEmbeddingGraph(encoder).eval()
+    pad_token_id = encoder.tokenizer.pad_token_id
+    with torch.no_grad():
+        for length in buckets:
+            # Batch of 2 with a padded row, so the trace doesn't specialize on batch 1 or on an all ones mask
+            input_ids = torch.full((2, length), pad_token_id, dtype=torch.long, device=encoder.device)
+            input_ids[:, 0] = encoder.tokenizer.cls_token_id
+            input_ids[0, 1:] = encoder.tokenizer.unk_token_id
+            attention_mask = (input_ids != pad_token_id).long()
+
+            traced = torch.jit.trace(graph, (input_ids, attention_mask), check_trace=False)
+            torch.jit.save(torch.jit.freeze(traced), graph_path(directory, length))
+            logger.info(f"Exported the text encoder for {length} tokens")
+
+    with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+        json.dump({"buckets": list(buckets), "precision": encoder.precision, "hidden_dim": encoder.hidden_dim}, f)
+
+
+class TracedTextEncoder:
+    """
+    Query encoder running the graphs written by export_text_encoder, with the BGETextEncoder
+    interface used by bge.encode_sentences (tokenizer, device, encode_text).
+    """
+
+    def __init__(self, directory: str, precision: str = "fp32", model_weight: str = model_path):
+        """
+        Args:
+            model_weight: Weights of the eager BGETextEncoder encoding the inputs longer than the largest bucket
+
+        Raises:
+            FileNotFoundError: If directory holds no export
+            ValueError: If the graphs were exported with another precision
+        """
+        manifest = read_manifest(directory)
+        if manifest["precision"] != precision:
+            raise ValueError(f"The text encoder in {directory} was exported in {manifest['precision']}, not {precision}")
+
+        self.precision = precision
+        self.hidden_dim = manifest["hidden_dim"]
+        self.device = torch.device("cpu")
+        self.tokenizer = load_tokenizer()
+        self.buckets = sorted(manifest["buckets"])
+        self.graphs = {length: torch.jit.load(graph_path(directory, length), map_location=self.device) for length in self.buckets}
+        logger.info(f"Loaded the exported text encoder from {directory} ({len(self.graphs)} sequence length buckets)")
+
+        self.model_weight = model_weight
+        self.eager: BGETextEncoder | None = None
+        self.eager_lock = threading.Lock()
+
+    def bucket(self, length: int) -> int:
+        return next((bucket for bucket in self.buckets if bucket >= length), self.buckets[-1])
+
+    def eager_encoder(self) -> BGETextEncoder:
+        """The eager model, loaded on first use"""
+        with self.eager_lock:
+            if self.eager is None:
+                logger.info(f"Loading the eager text encoder for the inputs longer than {self.buckets[-1]} tokens")
+                self.eager = BGETextEncoder(model_weight=self.model_weight, precision=self.precision)
+            return self.eager
+
+    def encode_text(self, texts) -> tuple[Tensor, None]:
+        """encode_text of BGETextEncoder, inputs longer than the largest bucket go through the eager model"""
+        input_ids = texts["input_ids"]
+        attention_mask = texts["attention_mask"]
+        length = input_ids.shape[1]
+        if length > self.buckets[-1]:
+            with torch.no_grad():
+                return self.eager_encoder().encode_text(texts)[0], None
+
+        bucket = self.bucket(length)
+        if length < bucket:
+            padding = bucket - length
+            input_ids = nn.functional.pad(input_ids, (0, padding), value=self.tokenizer.pad_token_id)
+            attention_mask = nn.functional.pad(attention_mask, (0, padding), value=0)
+
+        with torch.no_grad():
+            return self.graphs[bucket](input_ids, attention_mask), None
+
+    def encode(self, text) -> tuple[Tensor, None]:
+        texts = self.tokenizer(text, return_tensors="pt", padding=True)
+        return self.encode_text(texts.to(self.device))
+
+
+def _texts_of_length(tokenizer, length: int, count: int) -> list[str]:
+    """count texts of about length tokens, built from the benchmark queries"""
+    from benchmark_precision import QUERIES
+
+    texts = []
+    for i in range(count):
+        words = " ".join(QUERIES[(i + j) % len(QUERIES)] for j in range(length))
+        ids = tokenizer(words, add_special_tokens=False)["input_ids"][: max(length - 2, 1)]
+        texts.append(tokenizer.decode(ids))
+    return texts
+
+
+def _time_ms(forward, runs: int) -> float:
+    forward()  # Warm up
+    start = time.perf_counter()
+    for _ in range(runs):
+        forward()
+    return (time.perf_counter() - start) * 1000 / runs
+
+
+def parity(directory: str, runs: int) -> bool:
+    """Compare the exported graphs with the eager model for every bucket, True when within PARITY_TOLERANCE."""
+    from benchmark_precision import QUERIES
+
+    traced = TracedTextEncoder(directory, precision=read_manifest(directory)["precision"])
+    eager = BGETextEncoder(model_weight=model_path, precision=traced.precision)
+
+    ok = True
+    print(f"{'tokens':>8}{'batch':>7}{'max diff':>12}{'cos min':>10}{'eager ms':>10}{'graph ms':>10}")
+    cases = [(None, QUERIES[:1]), (None, QUERIES)]
+    cases += [(length, _texts_of_length(traced.tokenizer, length, count)) for length in traced.buckets for count in (1, 8)]
+    cases.append((traced.buckets[-1] + 64, _texts_of_length(traced.tokenizer, traced.buckets[-1] + 64, 1)))  # Eager fallback
+    for length, texts in cases:
+        with torch.no_grad():
+            expected = eager.encode(texts)[0]
+            found = traced.encode(texts)[0]
+        max_diff = (expected - found).abs().max().item()
+        cos_min = nn.functional.cosine_similarity(expected, found, dim=-1).min().item()
+        eager_ms = _time_ms(lambda: eager.encode(texts), runs)
+        graph_ms = _time_ms(lambda: traced.encode(texts), runs)
+        tokens = length or traced.tokenizer(texts, padding=True, return_tensors="pt")["input_ids"].shape[1]
+        print(f"{tokens:>8}{len(texts):>7}{max_diff:>12.2e}{cos_min:>10.6f}{eager_ms:>10.1f}{graph_ms:>10.1f}")
+        ok = ok and max_diff <= PARITY_TOLERANCE
+    print("parity OK" if ok else f"parity FAILED, differences above {PARITY_TOLERANCE}")
+    return ok
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="TorchScript export of the BGE text encoder")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("output")
+    export_parser.add_argument("--buckets", default=",".join(str(bucket) for bucket in SEQUENCE_BUCKETS))
+    export_parser.add_argument("--precision", choices=["fp32", "int8"], default="fp32")
+
+    parity_parser = subparsers.add_parser("parity")
+    parity_parser.add_argument("output")
+    parity_parser.add_argument("--runs", type=int, default=20)
+
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.command == "export":
+        buckets = tuple(sorted(int(bucket) for bucket in args.buckets.split(",") if bucket))
+        export_text_encoder(BGETextEncoder(model_weight=model_path, precision=args.precision), args.output, buckets)
+    elif args.command == "parity":
+        sys.exit(0 if parity(args.output, args.runs) else 1)
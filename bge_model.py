@@ -1,14 +1,21 @@
 import os
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Optional
 import torch
 import torch.distributed as dist
 from torch import nn, Tensor
-from transformers import AutoModel, AutoTokenizer, AutoConfig
+from transformers.modeling_utils import no_init_weights
 from transformers.file_utils import ModelOutput
 
 MODELS_FOLDER = os.getenv("MODELS_FOLDER")
+EVA_ATTN_IMPL = os.getenv("EVA_ATTN_IMPL", "auto")  # Attention of the EVA vision tower: auto, xformers, sdpa or naive
+IMAGE_TOKEN_CACHE_BYTES = int(os.getenv("IMAGE_TOKEN_CACHE_MB", 256)) * 1024 * 1024
+from bge_text import BGETextBase, convert_to_safetensors, create_bge_model, load_tokenizer
 from eva_clip import create_eva_vision_and_transforms
 from PIL import Image
 
@@ -24,7 +31,73 @@ class EncoderOutput(ModelOutput):
     scores: Optional[Tensor] = None
 
 
-class Visualized_BGE(nn.Module):
+class ImageTokenCache:
+    """
+    LRU cache of visual tokens keyed on the content hash of the preprocessed image,
+    bounded by the memory used by the cached tensors.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, Tensor] = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(pixels: Tensor) -> str:
+        return hashlib.blake2b(pixels.detach().cpu().contiguous().numpy().tobytes(), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Tensor]:
+        with self.lock:
+            tokens = self.entries.get(key)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return tokens
+
+    def set(self, key: str, tokens: Tensor) -> None:
+        size = tokens.element_size() * tokens.nelement()
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = tokens
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.element_size() * evicted.nelement()
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class Visualized_BGE(BGETextBase):
+    # The EVA attention reads the projection weights directly, it can't use quantized Linear layers
+    quantized_modules = {"bge_encoder", "visual_proj"}
+
     def __init__(
         self,
         model_weight=None,  # "/path/to/your/weight/file/"
@@ -33,33 +106,45 @@ class Visualized_BGE(nn.Module):
         negatives_cross_device: bool = False,
         temperature: float = 0.02,  # 1.0
         device: str = "cpu",
+        image_token_cache_bytes: int = IMAGE_TOKEN_CACHE_BYTES,
+        inference: bool = False,
+        precision: str = "fp32",
     ):
+        """
+        Args:
+            inference: Build for inference only: no pooler, train transforms, loss or distributed gather,
+                weights memory-mapped (from the converted .safetensors when there is one, see convert_to_safetensors)
+                and assigned to the parameters instead of copied, model left in eval mode without gradients
+            precision: fp32, bf16 or int8 (inference only), see set_precision. int8 quantizes the BGE encoder
+                and the visual projection, the EVA tower stays in fp32 (bf16 with autocast)
+        """
         super().__init__()
 
         assert model_weight is not None
+        if precision != "fp32" and not inference:
+            raise ValueError("Reduced precisions are only available for inference models")
 
         self.hidden_dim = 1024
         self.depth = 24
+        self.inference = inference
 
-        try:
-            bge_config = AutoConfig.from_pretrained(os.path.join(MODELS_FOLDER, "bge-m3"), local_files_only=True)
-            bge = AutoModel.from_config(bge_config)
-            logging.info(f"BGE model loaded from {os.path.join(MODELS_FOLDER, 'bge-m3')}")
-        except:
-            bge_config = AutoConfig.from_pretrained("BAAI/bge-m3")
-            bge = AutoModel.from_config(bge_config)
-            bge.save_pretrained(os.path.join(MODELS_FOLDER, "bge-m3"))
-            logging.info(f"Saved BGE model to {os.path.join(MODELS_FOLDER, 'bge-m3')}")
+        # The random initialization is overwritten by the weights, skip it when they are assigned
+        with no_init_weights() if inference else nullcontext():
+            bge = create_bge_model(add_pooling_layer=not inference)
 
-        self.bge_encoder = bge.encoder
-        self.bge_embeddings = bge.embeddings
-        self.bge_pooler = bge.pooler
+            self.bge_encoder = bge.encoder
+            self.bge_embeddings = bge.embeddings
+            self.bge_pooler = bge.pooler
 
-        self.model_visual, self.preprocess_train, self.preprocess_val = create_eva_vision_and_transforms("EVA02-CLIP-L-14", force_custom_clip=True)
+            self.model_visual, self.preprocess_train, self.preprocess_val = create_eva_vision_and_transforms(
+                "EVA02-CLIP-L-14", force_custom_clip=True, force_attn_impl=EVA_ATTN_IMPL, train_transform=not inference
+            )
+            self.visual_proj = nn.Linear(self.hidden_dim, self.hidden_dim)
 
-        self.visual_proj = nn.Linear(self.hidden_dim, self.hidden_dim)
+        # Visual tokens of recently encoded images, used at inference only
+        self.image_token_cache = ImageTokenCache(image_token_cache_bytes)
 
-        self.cross_entropy = nn.CrossEntropyLoss(reduction="mean")
+        self.cross_entropy = None if inference else nn.CrossEntropyLoss(reduction="mean")
 
         self.normalized = normalized
         self.sentence_pooling_method = sentence_pooling_method
@@ -68,7 +153,7 @@ class Visualized_BGE(nn.Module):
             self.temperature = 1.0
             logger.info("reset temperature = 1.0 due to using inner product to compute similarity")
 
-        self.negatives_cross_device = negatives_cross_device
+        self.negatives_cross_device = negatives_cross_device and not inference
         if self.negatives_cross_device:
             if not dist.is_initialized():
                 raise ValueError("Distributed training has not been initialized for representation all gather.")
@@ -76,27 +161,33 @@ class Visualized_BGE(nn.Module):
             self.process_rank = dist.get_rank()
             self.world_size = dist.get_world_size()
 
-        self.load_model(model_weight)
+        if inference:
+            self.load_inference_weights(model_weight)
+        else:
+            self.load_model(model_weight)
 
-        try:
-            self.tokenizer = AutoTokenizer.from_pretrained(os.path.join(MODELS_FOLDER, "bge-m3_tokenizer"), use_fast=False, local_files_only=True)
-            logging.info(f"Tokenizer loaded from {os.path.join(MODELS_FOLDER, 'bge-m3_tokenizer')}")
-        except:
-            self.tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-m3", use_fast=False)
-            self.tokenizer.save_pretrained(os.path.join(MODELS_FOLDER, "bge-m3_tokenizer"))
-            logging.info(f"Tokenizer saved to {os.path.join(MODELS_FOLDER, 'bge-m3_tokenizer')}")
+        self.tokenizer = load_tokenizer()
 
         self.device = torch.device(device)
         self.to(self.device)
 
         self.dtype = next(bge.parameters()).dtype
 
+        # Positional tables of the vision tower (rope, relative position bias) cast once for the inference dtype/device
+        self.model_visual.visual.set_inference_mode(True, dtype=next(self.model_visual.parameters()).dtype, device=self.device)
+
+        if inference:
+            self.eval()
+            self.requires_grad_(False)
+            self.set_precision(precision)
+
     def load_model(self, model_weight):
         self.load_state_dict(torch.load(model_weight, map_location="cpu"))
 
     def gradient_checkpointing_enable(self, **kwargs):
         # self.bge_encoder.gradient_checkpointing_enable()
         self.model_visual.set_grad_checkpointing(True)
+        self.model_visual.visual.set_inference_mode(False)
 
     def encode(self, image=None, text=None) -> tuple[Tensor, Optional[Tensor]]:
         # used for simple inference
@@ -115,168 +206,139 @@ class Visualized_BGE(nn.Module):
             else:
                 return None
 
-    def get_extended_attention_mask(
-        self, attention_mask: Tensor, input_shape: Tuple[int], device: torch.device = None, dtype: torch.float = torch.float16  # type: ignore
-    ) -> Tensor:
-        """
-        Makes broadcastable attention and causal masks so that future and masked tokens are ignored.
-
-        Arguments:
-            attention_mask (`torch.Tensor`):
-                Mask with ones indicating tokens to attend to, zeros for tokens to ignore.
-            input_shape (`Tuple[int]`):
-                The shape of the input to the model.
+    def encode_mm(self, images: torch.Tensor, texts):
+        return self.encode_mm_tokens(self.cached_image_tokens(images), texts)
 
-        Returns:
-            `torch.Tensor` The extended attention mask, with a the same dtype as `attention_mask.dtype`.
+    def cached_image_tokens(self, images: torch.Tensor) -> Tensor:
         """
-
-        # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
-        # ourselves in which case we just need to make it broadcastable to all heads.
-        if attention_mask.dim() == 3:
-            extended_attention_mask = attention_mask[:, None, :, :]
-        elif attention_mask.dim() == 2:
-            # Provided a padding mask of dimensions [batch_size, seq_length]
-            # - if the model is a decoder, apply a causal mask in addition to the padding mask
-            # - if the model is an encoder, make the mask broadcastable to [batch_size, num_heads, seq_length, seq_length]
-
-            extended_attention_mask = attention_mask[:, None, None, :]
-        else:
-            raise ValueError(f"Wrong shape for input_ids (shape {input_shape}) or attention_mask (shape {attention_mask.shape})")
-
-        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-        # masked positions, this operation will create a tensor which is 0.0 for
-        # positions we want to attend and the dtype's smallest value for masked positions.
-        # Since we are adding it to the raw scores before the softmax, this is
-        # effectively the same as removing these entirely.
-        extended_attention_mask = extended_attention_mask.to(dtype=dtype)  # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * torch.finfo(dtype).min
-
-        return extended_attention_mask
-
-    def sentence_embedding(self, hidden_state, mask) -> tuple[Tensor, Optional[Tensor]]:
-        if self.sentence_pooling_method == "mean":
-            s = torch.sum(hidden_state * mask.unsqueeze(-1).float(), dim=1)
-            d = mask.sum(axis=1, keepdim=True).float()
-            return s / d
-        elif self.sentence_pooling_method == "cls":
-            return hidden_state[:, 0], hidden_state[:, 1:]
-
-    def encode_text(self, texts):
+        image_tokens, going through the image token cache at inference: images already encoded
+        (same preprocessed pixels) skip the vision tower, the others are encoded in one batch.
         """
-        encode text only
+        if self.training or self.image_token_cache.max_bytes <= 0:
+            return self.image_tokens(images)
+
+        keys = [ImageTokenCache.key(image) for image in images]
+        tokens = [self.image_token_cache.get(key) for key in keys]
+        missing = [i for i, token in enumerate(tokens) if token is None]
+        if missing:
+            computed = self.image_tokens(images[missing]).detach()
+            for i, token in zip(missing, computed):
+                # Cloned so each cached entry owns its memory instead of keeping the whole batch alive
+                token = token.clone()
+                tokens[i] = token
+                self.image_token_cache.set(keys[i], token)
+        return torch.stack(tokens)
+
+    def image_tokens(self, images: torch.Tensor) -> Tensor:
         """
-        input_ids = texts["input_ids"]
-        attention_mask = texts["attention_mask"]
-
-        input_shape = input_ids.size()
-        device = input_ids.device
-
-        token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
-
-        head_mask = [None] * self.depth
-        extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(attention_mask, input_shape).to(self.dtype)
-
-        embedding_output = self.bge_embeddings(
-            input_ids=input_ids,
-            position_ids=None,
-            token_type_ids=token_type_ids,
-            inputs_embeds=None,
-            past_key_values_length=0,
-        )
-        encoder_outputs = self.bge_encoder(
-            embedding_output,
-            attention_mask=extended_attention_mask,
-            head_mask=head_mask,
-            encoder_hidden_states=None,
-            encoder_attention_mask=None,
-            past_key_values=None,
-            use_cache=False,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
-        sequence_output = encoder_outputs[0]
-        # pooled_output = self.bge_pooler(sequence_output) if self.bge_pooler is not None else None
-
-        t_reps, t_reps_colbert = self.sentence_embedding(sequence_output, texts["attention_mask"])  # tensor: reps with pooling
-        if self.normalized:
-            t_reps = torch.nn.functional.normalize(t_reps, dim=-1)
-            t_reps_colbert = torch.nn.functional.normalize(t_reps_colbert, dim=-1)
-        return t_reps, t_reps_colbert
+        Visual tokens of preprocessed images, projected and position embedded for the BGE encoder.
+        They only depend on the image, so they can be computed once and reused for any text.
+        """
+        with self.autocast():
+            img_token_emb = self.img_token_embedding(images)  # [B, Patch_num, C]
+            img_token_emb = img_token_emb[:, 1:]  # img_cls is not used here
+            img_token_emb = self.visual_proj(img_token_emb)
+            device = img_token_emb.device
+
+            img_token_len = img_token_emb.size()[1]
+            logger.debug(f"img_token_len: {img_token_len}")
+
+            # image position embedding, default position: bge_cls + img tokens + texts
+            img_token_position_ids = torch.arange(1, 1 + img_token_len).to(device=device)
+            img_position_embeddings = self.bge_embeddings.position_embeddings(img_token_position_ids)
+            img_token_emb = img_token_emb + img_position_embeddings
+
+            return self.bge_embeddings.LayerNorm(img_token_emb)
+
+    def encode_mm_tokens(self, img_token_emb: Tensor, texts):
+        """encode_mm with the visual tokens already computed by image_tokens, one row per text"""
+        with self.autocast():
+            device = img_token_emb.device
+            img_token_len = img_token_emb.size()[1]
+
+            ### deal with prompt/text
+            prompt_input_ids = texts["input_ids"]
+            prompt_attention_mask = texts["attention_mask"]
+            prom_input_shape = prompt_input_ids.size()
+
+            # bert
+            batch_size = prom_input_shape[0]
+            prompt_len = prom_input_shape[1]
+            prompt_start = 1 + img_token_len
+            logger.debug(f"prompt_len: {prompt_len}")
+
+            cls_id = torch.tensor([0]).to(device=device)
+            prompt_position_ids = torch.arange(prompt_start, prompt_start + prompt_len - 1).to(device=device)
+            prompt_position_ids = torch.cat([cls_id, prompt_position_ids]).to(device=device)
+
+            prompt_token_type_ids = torch.zeros(prom_input_shape, dtype=torch.long, device=device)
+            prompt_embedding_output = self.bge_embeddings(
+                input_ids=prompt_input_ids,
+                position_ids=prompt_position_ids,
+                token_type_ids=prompt_token_type_ids,
+                inputs_embeds=None,
+                past_key_values_length=0,
+            )  # [B, T, C]
+
+            cls_token = prompt_embedding_output[:, 0:1, :]  # bge_cls token
+            prompt_embedding_output = prompt_embedding_output[:, 1:]
+
+            prompt_img_embedding = torch.cat([cls_token, img_token_emb.to(cls_token.dtype), prompt_embedding_output], dim=1)
+
+            img_attention_mask = torch.ones(batch_size, img_token_len, device=device)
+            prom_img_attention_mask = torch.cat([img_attention_mask, prompt_attention_mask], dim=1)
+            prom_img_input_shape = prompt_img_embedding.size()
+
+            head_mask = [None] * self.depth
+            extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(prom_img_attention_mask, prom_img_input_shape).to(self.dtype)
+
+            encoder_outputs = self.bge_encoder(
+                prompt_img_embedding,
+                attention_mask=extended_attention_mask,
+                head_mask=head_mask,
+                encoder_hidden_states=None,
+                encoder_attention_mask=None,
+                past_key_values=None,
+                use_cache=False,
+                output_attentions=False,
+                output_hidden_states=False,
+                return_dict=True,
+            )
+            sequence_output = encoder_outputs[0]
+
+            prompt_img_reps, prompt_img_reps_colbert = self.sentence_embedding(sequence_output, prom_img_attention_mask)  # tensor: reps with pooling
+            if self.normalized:
+                prompt_img_reps = torch.nn.functional.normalize(prompt_img_reps, dim=-1)
+                prompt_img_reps_colbert = torch.nn.functional.normalize(prompt_img_reps_colbert, dim=-1)
+        return prompt_img_reps.float(), prompt_img_reps_colbert.float()
+
+    def encode_mm_batch(self, images: list, texts: list[str], image_indexes: list[int], batch_size: int = 16) -> Tensor:
+        """
+        Encode many (image, text) pairs sharing few distinct images, e.g. all the chunks of a page.
+        The vision tower runs once per distinct image, then the texts go through the BGE encoder
+        in padded batches of batch_size, each row using the visual tokens of its image.
 
-    def encode_mm(self, images: torch.Tensor, texts):
-        img_token_emb = self.img_token_embedding(images)  # [B, Patch_num, C]
-        img_token_emb = img_token_emb[:, 1:]  # img_cls is not used here
-        img_token_emb = self.visual_proj(img_token_emb)
-        device = img_token_emb.device
-
-        img_token_len = img_token_emb.size()[1]
-        print(f"img_token_len: {img_token_len}")
-
-        # image position embedding, default position: bge_cls + img tokens + texts
-        img_token_position_ids = torch.arange(1, 1 + img_token_len).to(device=device)
-        img_position_embeddings = self.bge_embeddings.position_embeddings(img_token_position_ids)
-        img_token_emb = img_token_emb + img_position_embeddings
-
-        img_token_emb = self.bge_embeddings.LayerNorm(img_token_emb)
-
-        ### deal with prompt/text
-        prompt_input_ids = texts["input_ids"]
-        prompt_attention_mask = texts["attention_mask"]
-        prom_input_shape = prompt_input_ids.size()
-
-        # bert
-        batch_size = prom_input_shape[0]
-        prompt_len = prom_input_shape[1]
-        prompt_start = 1 + img_token_len
-        # print prompt_len
-        print(f"prompt_len: {prompt_len}")
-
-        cls_id = torch.tensor([0]).to(device=device)
-        prompt_position_ids = torch.arange(prompt_start, prompt_start + prompt_len - 1).to(device=device)
-        prompt_position_ids = torch.cat([cls_id, prompt_position_ids]).to(device=device)
-
-        prompt_token_type_ids = torch.zeros(prom_input_shape, dtype=torch.long, device=device)
-        prompt_embedding_output = self.bge_embeddings(
-            input_ids=prompt_input_ids,
-            position_ids=prompt_position_ids,
-            token_type_ids=prompt_token_type_ids,
-            inputs_embeds=None,
-            past_key_values_length=0,
-        )  # [B, T, C]
-
-        cls_token = prompt_embedding_output[:, 0:1, :]  # bge_cls token
-        prompt_embedding_output = prompt_embedding_output[:, 1:]
-
-        prompt_img_embedding = torch.cat([cls_token, img_token_emb, prompt_embedding_output], dim=1)
-
-        img_attention_mask = torch.ones(batch_size, img_token_len, device=device)
-        prom_img_attention_mask = torch.cat([img_attention_mask, prompt_attention_mask], dim=1)
-        prom_img_input_shape = prompt_img_embedding.size()
-
-        head_mask = [None] * self.depth
-        extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(prom_img_attention_mask, prom_img_input_shape).to(self.dtype)
-
-        encoder_outputs = self.bge_encoder(
-            prompt_img_embedding,
-            attention_mask=extended_attention_mask,
-            head_mask=head_mask,
-            encoder_hidden_states=None,
-            encoder_attention_mask=None,
-            past_key_values=None,
-            use_cache=False,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
-        sequence_output = encoder_outputs[0]
+        Args:
+            images: Distinct images (PIL images or paths)
+            texts: Texts to encode
+            image_indexes: For each text, the index of its image in images
+            batch_size: Texts per encoder forward pass
 
-        prompt_img_reps, prompt_img_reps_colbert = self.sentence_embedding(sequence_output, prom_img_attention_mask)  # tensor: reps with pooling
-        if self.normalized:
-            prompt_img_reps = torch.nn.functional.normalize(prompt_img_reps, dim=-1)
-            prompt_img_reps_colbert = torch.nn.functional.normalize(prompt_img_reps_colbert, dim=-1)
-        return prompt_img_reps, prompt_img_reps_colbert
+        Returns:
+            Tensor of shape [len(texts), hidden_dim] with the pooled representations
+        """
+        if not texts:
+            return torch.empty(0, self.hidden_dim, device=self.device)
+        pixels = torch.stack([self.preprocess_val(Image.open(image) if isinstance(image, str) else image) for image in images])
+        img_tokens = torch.cat([self.cached_image_tokens(pixels[i : i + batch_size].to(self.device)) for i in range(0, len(images), batch_size)])
+
+        image_indexes = torch.tensor(image_indexes, dtype=torch.long, device=img_tokens.device)
+        reps = []
+        for start in range(0, len(texts), batch_size):
+            tokenized = self.tokenizer(texts[start : start + batch_size], return_tensors="pt", padding=True).to(self.device)
+            batch_tokens = img_tokens.index_select(0, image_indexes[start : start + batch_size])
+            reps.append(self.encode_mm_tokens(batch_tokens, tokenized)[0])
+        return torch.cat(reps)
 
     def compute_similarity(self, q_reps, p_reps):
         if len(p_reps.size()) == 2:
@@ -360,3 +422,11 @@ class Visualized_BGE(nn.Module):
 
     def save(self, output_dir: str):
         torch.save(self.state_dict(), os.path.join(output_dir, "Visualized_BGE.pth"))
+
+
+if __name__ == "__main__":
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    # python bge_model.py [/path/to/Visualized_m3.pth]
+    convert_to_safetensors(sys.argv[1] if len(sys.argv) > 1 else os.path.join(MODELS_FOLDER, "Visualized_m3.pth"))
@@ -0,0 +1,274 @@
+"""
+BGE-M3 text side of Visualized_BGE.
+
+BGETextBase holds the text encoding shared by Visualized_BGE and BGETextEncoder. BGETextEncoder
+is the query encoder of the API server: it loads only the BGE-M3 embeddings and encoder from the
+Visualized_BGE weights, without importing or building the EVA vision tower, and gives the same
+text embeddings as Visualized_BGE.encode_text.
+"""
+
+import logging
+import os
+from contextlib import nullcontext
+from typing import Optional, Tuple
+
+import torch
+from torch import nn, Tensor
+from transformers import AutoModel, AutoTokenizer, AutoConfig
+from transformers.modeling_utils import no_init_weights
+
+MODELS_FOLDER = os.getenv("MODELS_FOLDER")
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+logger = logging.getLogger(__name__)
+
+
+def bf16_supported(device: torch.device) -> bool:
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def create_bge_model(add_pooling_layer: bool = True) -> nn.Module:
+    """Randomly initialized BGE-M3 model, from the local config when there is one"""
+    try:
+        bge_config = AutoConfig.from_pretrained(os.path.join(MODELS_FOLDER, "bge-m3"), local_files_only=True)
+        bge = AutoModel.from_config(bge_config, add_pooling_layer=add_pooling_layer)
+        logging.info(f"BGE model loaded from {os.path.join(MODELS_FOLDER, 'bge-m3')}")
+    except:
+        bge_config = AutoConfig.from_pretrained("BAAI/bge-m3")
+        bge = AutoModel.from_config(bge_config, add_pooling_layer=add_pooling_layer)
+        bge.save_pretrained(os.path.join(MODELS_FOLDER, "bge-m3"))
+        logging.info(f"Saved BGE model to {os.path.join(MODELS_FOLDER, 'bge-m3')}")
+    return bge
+
+
+def load_tokenizer():
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(os.path.join(MODELS_FOLDER, "bge-m3_tokenizer"), use_fast=False, local_files_only=True)
+        logging.info(f"Tokenizer loaded from {os.path.join(MODELS_FOLDER, 'bge-m3_tokenizer')}")
+    except:
+        tokenizer = AutoTokenizer.from_pretrained("BAAI/bge-m3", use_fast=False)
+        tokenizer.save_pretrained(os.path.join(MODELS_FOLDER, "bge-m3_tokenizer"))
+        logging.info(f"Tokenizer saved to {os.path.join(MODELS_FOLDER, 'bge-m3_tokenizer')}")
+    return tokenizer
+
+
+def load_weights(model_weight: str) -> dict[str, Tensor]:
+    """
+    Memory-mapped state dict of model_weight, read from the .safetensors file next to it when it was converted.
+    Tensors are paged in from the file as they are used instead of being read in RAM up front.
+    """
+    safetensors_path = os.path.splitext(model_weight)[0] + ".safetensors"
+    if os.path.exists(safetensors_path):
+        from safetensors.torch import load_file
+
+        return load_file(safetensors_path, device="cpu")
+    return torch.load(model_weight, map_location="cpu", mmap=True, weights_only=True)
+
+
+def convert_to_safetensors(model_weight: str) -> str:
+    """Write the weights of a .pth checkpoint as a .safetensors file next to it, returns its path."""
+    from safetensors.torch import save_file
+
+    safetensors_path = os.path.splitext(model_weight)[0] + ".safetensors"
+    state_dict = torch.load(model_weight, map_location="cpu", mmap=True, weights_only=True)
+    save_file({key: value.contiguous() for key, value in state_dict.items()}, safetensors_path)
+    logger.info(f"Converted {model_weight} to {safetensors_path}")
+    return safetensors_path
+
+
+class BGETextBase(nn.Module):
+    """
+    Text encoding of the BGE-M3 model. Subclasses set bge_embeddings, bge_encoder, depth, dtype, device,
+    normalized and sentence_pooling_method.
+    """
+
+    precision = "fp32"
+    quantized_modules = {"bge_encoder"}  # Modules whose Linear layers are quantized in int8 precision
+
+    def set_precision(self, precision: str) -> None:
+        """
+        Precision of the forward passes, inference only:
+            fp32: eager fp32
+            bf16: bf16 autocast, the embeddings are still returned as fp32. Only faster on CPUs with
+                native bf16 (AVX512-BF16, AMX) and on GPUs supporting it
+            int8: Linear layers of quantized_modules replaced by dynamically quantized int8 ones, CPU only.
+                The fp32 weights of these layers are dropped, so it can't be changed afterwards
+
+        Raises:
+            ValueError: If the precision is unknown or not available on the device
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+        if self.precision == "int8" and precision != "int8":
+            raise ValueError("An int8 quantized model can't be converted back")
+
+        if precision == "int8" and self.precision != "int8":
+            if self.device.type != "cpu":
+                raise ValueError("int8 dynamic quantization only runs on CPU")
+            torch.ao.quantization.quantize_dynamic(self, set(self.quantized_modules), dtype=torch.qint8, inplace=True)
+        elif precision == "bf16" and not bf16_supported(self.device):
+            logger.warning(f"{self.device} has no native bf16 support, bf16 autocast will likely be slower than fp32")
+
+        self.precision = precision
+        logger.info(f"Embedding precision set to {precision}")
+
+    def autocast(self):
+        """Autocast context of the forward passes for the precision"""
+        if self.precision == "bf16":
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return nullcontext()
+
+    def load_inference_weights(self, model_weight: str) -> None:
+        """
+        Assign the memory-mapped weights to the parameters, leaving out the tensors of the modules
+        that weren't built (pooler, vision tower and projection of a text-only model).
+        The parameters share the mapped pages instead of holding a copy of the checkpoint.
+
+        Raises:
+            RuntimeError: If a parameter of the model is missing from the weights
+        """
+        state_dict = load_weights(model_weight)
+        expected = self.state_dict().keys()
+        skipped = [key for key in state_dict if key not in expected]
+        self.load_state_dict({key: value for key, value in state_dict.items() if key in expected}, assign=True)
+        logger.info(f"Loaded {len(state_dict) - len(skipped)} tensors from {model_weight}, skipped {len(skipped)} of unused modules")
+
+    def get_extended_attention_mask(
+        self, attention_mask: Tensor, input_shape: Tuple[int], device: torch.device = None, dtype: torch.float = torch.float16  # type: ignore
+    ) -> Tensor:
+        """
+        Makes broadcastable attention and causal masks so that future and masked tokens are ignored.
+
+        Arguments:
+            attention_mask (`torch.Tensor`):
+                Mask with ones indicating tokens to attend to, zeros for tokens to ignore.
+            input_shape (`Tuple[int]`):
+                The shape of the input to the model.
+
+        Returns:
+            `torch.Tensor` The extended attention mask, with a the same dtype as `attention_mask.dtype`.
+        """
+
+        # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
+        # ourselves in which case we just need to make it broadcastable to all heads.
+        if attention_mask.dim() == 3:
+            extended_attention_mask = attention_mask[:, None, :, :]
+        elif attention_mask.dim() == 2:
+            # Provided a padding mask of dimensions [batch_size, seq_length]
+            # - if the model is a decoder, apply a causal mask in addition to the padding mask
+            # - if the model is an encoder, make the mask broadcastable to [batch_size, num_heads, seq_length, seq_length]
+
+            extended_attention_mask = attention_mask[:, None, None, :]
+        else:
+            raise ValueError(f"Wrong shape for input_ids (shape {input_shape}) or attention_mask (shape {attention_mask.shape})")
+
+        # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
+        # masked positions, this operation will create a tensor which is 0.0 for
+        # positions we want to attend and the dtype's smallest value for masked positions.
+        # Since we are adding it to the raw scores before the softmax, this is
+        # effectively the same as removing these entirely.
+        extended_attention_mask = extended_attention_mask.to(dtype=dtype)  # fp16 compatibility
+        extended_attention_mask = (1.0 - extended_attention_mask) * torch.finfo(dtype).min
+
+        return extended_attention_mask
+
+    def sentence_embedding(self, hidden_state, mask) -> tuple[Tensor, Optional[Tensor]]:
+        if self.sentence_pooling_method == "mean":
+            s = torch.sum(hidden_state * mask.unsqueeze(-1).float(), dim=1)
+            d = mask.sum(axis=1, keepdim=True).float()
+            return s / d
+        elif self.sentence_pooling_method == "cls":
+            return hidden_state[:, 0], hidden_state[:, 1:]
+
+    def encode_text(self, texts):
+        """
+        encode text only
+        """
+        with self.autocast():
+            input_ids = texts["input_ids"]
+            attention_mask = texts["attention_mask"]
+
+            input_shape = input_ids.size()
+            device = input_ids.device
+
+            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
+
+            head_mask = [None] * self.depth
+            extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(attention_mask, input_shape).to(self.dtype)
+
+            embedding_output = self.bge_embeddings(
+                input_ids=input_ids,
+                position_ids=None,
+                token_type_ids=token_type_ids,
+                inputs_embeds=None,
+                past_key_values_length=0,
+            )
+            encoder_outputs = self.bge_encoder(
+                embedding_output,
+                attention_mask=extended_attention_mask,
+                head_mask=head_mask,
+                encoder_hidden_states=None,
+                encoder_attention_mask=None,
+                past_key_values=None,
+                use_cache=False,
+                output_attentions=False,
+                output_hidden_states=False,
+                return_dict=True,
+            )
+            sequence_output = encoder_outputs[0]
+            # pooled_output = self.bge_pooler(sequence_output) if self.bge_pooler is not None else None
+
+            t_reps, t_reps_colbert = self.sentence_embedding(sequence_output, texts["attention_mask"])  # tensor: reps with pooling
+            if self.normalized:
+                t_reps = torch.nn.functional.normalize(t_reps, dim=-1)
+                t_reps_colbert = torch.nn.functional.normalize(t_reps_colbert, dim=-1)
+        return t_reps.float(), t_reps_colbert.float()
+
+
+class BGETextEncoder(BGETextBase):
+    """Inference only BGE-M3 text encoder with the weights of Visualized_BGE, see Visualized_BGE.encode_text"""
+
+    def __init__(
+        self,
+        model_weight: str,
+        normalized: bool = True,
+        sentence_pooling_method: str = "cls",
+        device: str = "cpu",
+        precision: str = "fp32",
+    ):
+        """
+        Args:
+            precision: fp32, bf16 or int8, see set_precision
+        """
+        super().__init__()
+
+        self.hidden_dim = 1024
+        self.depth = 24
+        self.normalized = normalized
+        self.sentence_pooling_method = sentence_pooling_method
+
+        with no_init_weights():
+            bge = create_bge_model(add_pooling_layer=False)
+        self.bge_encoder = bge.encoder
+        self.bge_embeddings = bge.embeddings
+
+        self.load_inference_weights(model_weight)
+        self.tokenizer = load_tokenizer()
+
+        self.device = torch.device(device)
+        self.to(self.device)
+        self.dtype = next(bge.parameters()).dtype
+
+        self.eval()
+        self.requires_grad_(False)
+        self.set_precision(precision)
+
+    def encode(self, text) -> tuple[Tensor, Optional[Tensor]]:
+        texts = self.tokenizer(text, return_tensors="pt", padding=True)
+        return self.encode_text(texts.to(self.device))
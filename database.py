@@ -1,4 +1,6 @@
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import uuid
 import psycopg
 from psycopg_pool import ConnectionPool
@@ -7,6 +9,7 @@ from pgvector.psycopg import register_vector
 import atexit
 
 from common import Chunk, CourseInstance, File, Review, Transaction, User, Vetrina
+import file_staging
 from db_errors import UnauthorizedError, NotFoundException, ForbiddenError, AlreadyOwnedError
 from dotenv import load_dotenv
 import logging
@@ -15,6 +18,15 @@ import numpy as np
 from langdetect import detect
 from PIL import Image
 
+try:
+    from flask import g, has_request_context
+except ImportError:  # workers don't need Flask, every connection() call then checks out its own connection
+    g = None
+
+    def has_request_context() -> bool:
+        return False
+
+
 load_dotenv()
 
 DB_NAME = os.getenv("DB_NAME")
@@ -23,6 +35,23 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST", "127.0.0.1")
 FILES_FOLDER = os.getenv("FILES_FOLDER")
 IMAGES_FOLDER = os.getenv("IMAGES_FOLDER")
+IMAGE_WRITE_WORKERS = int(os.getenv("IMAGE_WRITE_WORKERS", 8))
+
+# Connection pool sizing, keep DB_POOL_MAX_SIZE * number of processes below the server max_connections
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", 600))
+
+# Approximate nearest-neighbour index on chunk_embeddings.embedding ("hnsw" or "ivfflat")
+VECTOR_INDEX_NAME = "chunk_embeddings_embedding_idx"
+VECTOR_INDEX_METHOD = os.getenv("VECTOR_INDEX_METHOD", "hnsw")
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 64))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 100))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", 10))
+
+CONNINFO = f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST}"
 
 
 def configure_connection(conn: psycopg.Connection) -> psycopg.Connection:
@@ -33,13 +62,14 @@ def configure_connection(conn: psycopg.Connection) -> psycopg.Connection:
 
 
 pool: ConnectionPool = ConnectionPool(
-    f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST}",
-    min_size=2,
-    max_size=10,
+    CONNINFO,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    max_idle=DB_POOL_MAX_IDLE,
     configure=configure_connection,
-    timeout=30,
+    timeout=DB_POOL_TIMEOUT,
 )
-logging.info(f"Initialized connection pool with min_size={2}, max_size={10}")
+logging.info(f"Initialized connection pool with min_size={DB_POOL_MIN_SIZE}, max_size={DB_POOL_MAX_SIZE}")
 
 
 def cleanup_connection_pool():
@@ -53,19 +83,56 @@ def cleanup_connection_pool():
 
 atexit.register(cleanup_connection_pool)
 
-def connect(autocommit: bool = False, no_dict_row_factory: bool = False, vector: bool = False) -> psycopg.Connection:
+
+@contextmanager
+def connection() -> Iterator[psycopg.Connection]:
     """
-    Legacy connection function for backwards compatibility.
-    Note: The pool automatically provides vector capabilities and dict row factory.
+    Get a connection from the pool.
+    Inside a Flask request the same connection is reused by every call and given back at teardown
+    (see init_app), outside of it the connection is returned to the pool on exit.
+    Either way the work done in the block is committed on success and rolled back on error.
     """
-    # Get connection from pool
-    conn = psycopg.connect(
-        f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST}",
-        autocommit=autocommit,
-        row_factory=psycopg.rows.dict_row if not no_dict_row_factory else None,
-        connect_timeout=5,
-    )
-    # Register vector extension for this connection
+    if not has_request_context():
+        with pool.connection() as conn:
+            yield conn
+        return
+
+    conn = g.get("db_conn")
+    if conn is None:
+        conn = pool.getconn()
+        g.db_conn = conn
+
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def init_app(app) -> None:
+    """Return the per-request connection to the pool when the request ends."""
+
+    @app.teardown_appcontext
+    def release_connection(exception=None):
+        conn = g.pop("db_conn", None)
+        if conn is not None:
+            pool.putconn(conn)
+
+
+def get_pool_stats() -> Dict[str, int]:
+    """Get the connection pool counters (size, available connections, waiting clients...)."""
+    return pool.get_stats()
+
+
+def connect(autocommit: bool = False, vector: bool = True) -> psycopg.Connection:
+    """
+    Open a dedicated connection outside the pool.
+    Only for maintenance commands that need their own session (e.g. CREATE INDEX CONCURRENTLY, or
+    creating the schema before the vector extension exists), request and worker code must use connection().
+    """
+    conn = psycopg.connect(CONNINFO, autocommit=autocommit, row_factory=psycopg.rows.dict_row, connect_timeout=5)
     if vector:
         register_vector(conn)
     return conn
@@ -73,7 +140,7 @@ def connect(autocommit: bool = False, no_dict_row_factory: bool = False, vector:
 
 def create_tables(debug: bool = False) -> None:
     with open("schema.sql", "r") as f:
-        with connect(no_dict_row_factory=True) as conn:
+        with connect(vector=False) as conn:
             logging.info("Connected to database")
             with conn.cursor() as cursor:
                 logging.info("Created cursor")
@@ -90,7 +157,7 @@ def create_tables(debug: bool = False) -> None:
 
 def fill_courses(debug: bool = False) -> None:
     df = pd.read_csv("data/courses.csv", encoding="latin1")
-    with connect() as conn:
+    with connection() as conn:
         logging.info("Connected to database")
         with conn.cursor() as cursor:
             logging.info("Created cursor")
@@ -134,7 +201,7 @@ def create_user(username: str, email: str, password: str, name: str, surname: st
     Raises:
         UniqueViolation: If the username or email already exists
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -165,7 +232,7 @@ def verify_user(email: str, password: str) -> User:
     Raises:
         UnauthorizedError: If the email or password is invalid
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
             user_data = cursor.fetchone()
@@ -182,7 +249,7 @@ def delete_user(user_id: int) -> None:
     Args:
         user_id: ID of the user to delete
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
             conn.commit()
@@ -199,7 +266,7 @@ def get_user_by_id(user_id: int, sensitive_data: bool = False, profile_data: boo
     Returns:
         User: The user object if found, None otherwise
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 "SELECT * FROM users WHERE user_id = %s",
@@ -253,7 +320,7 @@ def update_user(user_id: int, user_update_data) -> User:
     # Add user_id to the end of values for WHERE clause
     update_values.append(user_id)
     
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             query = f"""
                 UPDATE users 
@@ -377,7 +444,7 @@ def search_vetrine(params: Dict[str, Any], user_id: Optional[int] = None) -> Lis
     # Combine parameters in the correct order: base + where + order
     all_params = base_params + where_params + order_params
 
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(final_query, tuple(all_params))
             vetrine_data = cursor.fetchall()
@@ -386,10 +453,17 @@ def search_vetrine(params: Dict[str, Any], user_id: Optional[int] = None) -> Lis
 
 
 def new_search(
-    query: str, query_embedding: np.ndarray, params: Dict[str, Any] = {}, user_id: Optional[int] = None
+    query: str,
+    query_embedding: np.ndarray,
+    params: Dict[str, Any] = {},
+    user_id: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
 ) -> Tuple[List[Vetrina], Dict[int, List[Chunk]]]:
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
+            set_vector_search_params(cursor, ef_search=ef_search, probes=probes)
+
             try:
                 lang = detect(query)
                 if lang not in ["it", "en"]:
@@ -451,40 +525,57 @@ def new_search(
             sql_query = f"""
             WITH combined_results AS (
                 (
-                    -- Semantic Search
+                    -- Semantic Search: the inner ORDER BY ... LIMIT is served by the ANN index,
+                    -- the rank is computed only over the 50 candidates it returns
                     SELECT
-                        ce.vetrina_id,
-                        ce.file_id,
-                        ce.page_number,
-                        ce.description, -- Pass description through for grouping
-                        ce.image_path,
-                        1.0 / (%s::integer + RANK() OVER (ORDER BY ce.embedding <#> %s)) AS semantic_score,
+                        vetrina_id,
+                        file_id,
+                        page_number,
+                        description, -- Pass description through for grouping
+                        image_path,
+                        1.0 / (%s::integer + RANK() OVER (ORDER BY distance)) AS semantic_score,
                         0.0 AS keyword_score
-                    {base_from_clause}
-                    WHERE {where_clause}
-                    ORDER BY ce.embedding <#> %s
-                    LIMIT 50
+                    FROM (
+                        SELECT
+                            ce.vetrina_id,
+                            ce.file_id,
+                            ce.page_number,
+                            ce.description,
+                            ce.image_path,
+                            ce.embedding <#> %s AS distance
+                        {base_from_clause}
+                        WHERE {where_clause}
+                        ORDER BY ce.embedding <#> %s
+                        LIMIT 50
+                    ) semantic_candidates
                 )
 
                 UNION ALL
 
                 (
-                    -- Keyword Search
                     SELECT
-                        ce.vetrina_id,
-                        ce.file_id,
-                        ce.page_number,
-                        ce.description, -- Pass description through for grouping
-                        ce.image_path,
+                        vetrina_id,
+                        file_id,
+                        page_number,
+                        description, -- Pass description through for grouping
+                        image_path,
                         0.0 AS semantic_score,
-                        1.0 / (%s::integer + RANK() OVER (ORDER BY ts_rank_cd(
-                            CASE WHEN v.language = 'en' THEN to_tsvector('english', ce.description) ELSE to_tsvector('italian', ce.description) END,
-                            plainto_tsquery('{tsquery_config}', %s::text)
-                        ) DESC)) AS keyword_score
-                    {base_from_clause}
-                    WHERE {where_clause} AND
-                        (CASE WHEN v.language = 'en' THEN to_tsvector('english', ce.description) ELSE to_tsvector('italian', ce.description) END) @@ plainto_tsquery('{tsquery_config}', %s::text)
-                    LIMIT 50
+                        1.0 / (%s::integer + RANK() OVER (ORDER BY keyword_rank DESC)) AS keyword_score
+                    FROM (
+                        -- Keyword Search: ce.tsv is stored at insert time and matched through its GIN index
+                        SELECT
+                            ce.vetrina_id,
+                            ce.file_id,
+                            ce.page_number,
+                            ce.description,
+                            ce.image_path,
+                            ts_rank_cd(ce.tsv, query_tsq) AS keyword_rank
+                        {base_from_clause}
+                        CROSS JOIN plainto_tsquery('{tsquery_config}', %s::text) AS query_tsq
+                        WHERE {where_clause} AND ce.tsv @@ query_tsq
+                        ORDER BY keyword_rank DESC
+                        LIMIT 50
+                    ) keyword_candidates
                 )
             ),
             ranked_results AS (
@@ -521,7 +612,7 @@ def new_search(
 
             # --- 4. Assemble Parameters and Execute ---
             semantic_params = [k, query_embedding] + filter_params + [query_embedding]
-            keyword_params = [k, query] + filter_params + [query]
+            keyword_params = [k, query] + filter_params
             all_params = semantic_params + keyword_params
 
             cursor.execute(sql_query, all_params)
@@ -559,7 +650,7 @@ def create_vetrina(user_id: int, course_instance_id: int, name: str, description
     Returns:
         Vetrina: The newly created vetrina object
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -594,7 +685,7 @@ def delete_vetrina(user_id: int, vetrina_id: int) -> None:
         NotFoundException: If the vetrina is not found
         ForbiddenError: If the user is not the author of the vetrina
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM vetrina WHERE vetrina_id = %s AND author_id = %s", (vetrina_id, user_id))
             conn.commit()
@@ -606,7 +697,7 @@ def get_vetrina_by_id(vetrina_id: int, user_id: int | None = None) -> Tuple[Vetr
     Get a vetrina by its ID.
     If user_id is provided, it will also check if the vetrina is in the user's favorites.
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             favorite_select = ""
             params = [vetrina_id]
@@ -655,7 +746,7 @@ def scrape_faculties_courses() -> Dict[str, List[Tuple[str, str]]]:
     Returns:
         Dict[str, List[Tuple[str, str]]]: Dictionary of faculties with their courses (course_code, course_name)
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("SELECT DISTINCT course_code, course_name, faculty_name FROM course_instances")
             courses = cursor.fetchall()
@@ -682,7 +773,7 @@ def get_course_by_id(course_id: int) -> CourseInstance:
     Raises:
         NotFoundException: If the course is not found
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 "SELECT instance_id, course_code, course_name, faculty_name, course_year, date_year, language, course_semester, canale, professors FROM course_instances WHERE instance_id = %s",
@@ -760,6 +851,52 @@ def add_file_to_vetrina(
     return file
 
 
+def find_processed_file_by_sha256(cursor: psycopg.Cursor, sha256: str) -> Optional[File]:
+    """
+    Find an already processed file with the same content, to reuse its stored files and chunk embeddings.
+
+    Args:
+        sha256: SHA256 hash of the file content
+
+    Returns:
+        The oldest file with this hash that has chunk embeddings, None if the content was never processed
+    """
+    cursor.execute(
+        """
+        SELECT f.* FROM files f
+        WHERE f.sha256 = %s
+        AND EXISTS (SELECT 1 FROM chunk_embeddings ce WHERE ce.file_id = f.file_id)
+        ORDER BY f.file_id
+        LIMIT 1
+        """,
+        (sha256,),
+    )
+    file_data = cursor.fetchone()
+    return File.from_dict(file_data) if file_data else None
+
+
+def copy_chunk_embeddings(cursor: psycopg.Cursor, source_file_id: int, vetrina_id: int, file_id: int) -> int:
+    """
+    Copy the chunk embeddings of a file to another file with the same content.
+    Descriptions, window images and embeddings are shared, the language follows the target vetrina.
+
+    Returns:
+        Number of copied chunks
+    """
+    cursor.execute(
+        """
+        INSERT INTO chunk_embeddings (vetrina_id, file_id, page_number, description, image_path, embedding, language)
+        SELECT %s, %s, ce.page_number, ce.description, ce.image_path, ce.embedding,
+            COALESCE((SELECT language FROM vetrina WHERE vetrina_id = %s), 'en')
+        FROM chunk_embeddings ce
+        WHERE ce.file_id = %s
+        """,
+        (vetrina_id, file_id, vetrina_id, source_file_id),
+    )
+    logging.debug(f"Copied {cursor.rowcount} chunk embeddings from file {source_file_id} to file {file_id}")
+    return cursor.rowcount
+
+
 def add_file_to_processing_queue(
     requester_id: int,
     vetrina_id: int,
@@ -769,12 +906,19 @@ def add_file_to_processing_queue(
     price: int = 0,
     tag: str | None = None,
     language: str = "it",
-    file_data: bytes | None = None,
+    staged_path: str | None = None,
+    sha256: str | None = None,
+    size: int = 0,
 ) -> File:
     """
     Add a file to the processing queue.
+
+    Args:
+        staged_path: Path of the uploaded file in the staging folder (see file_staging.py)
+        sha256: Hex digest of the uploaded file
+        size: Size of the uploaded file in bytes
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             with conn.transaction():
 
@@ -791,29 +935,277 @@ def add_file_to_processing_queue(
 
                 # insert the file into the processing queue
                 cursor.execute(
-                    "INSERT INTO file_processing_queue (requester_id, vetrina_id, file_name, display_name, extension, price, tag, language, file_data) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING *",
-                    (requester_id, vetrina_id, file_name, display_name, extension, price, tag, language, file_data),
+                    "INSERT INTO file_processing_queue (requester_id, vetrina_id, file_name, display_name, extension, price, tag, language, staged_path, sha256, size) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING *",
+                    (requester_id, vetrina_id, file_name, display_name, extension, price, tag, language, staged_path, sha256, size),
                 )
 
 
-def insert_chunk_embeddings(vetrina_id: int, file_id: int, chunks: list[dict[str, str | int | np.ndarray]], cursor: psycopg.Cursor) -> None:
-    """Insert chunk embeddings into the database"""
-    for chunk in chunks:
-        page_number = chunk["page_number"]
-        description = chunk["description"]
-        embedding = chunk["embedding"]
-        image: Image.Image = chunk["image"]
-        image_name = f"{uuid.uuid4()}.png"
-        image.save(os.path.join(IMAGES_FOLDER, image_name))
-
-        embedding = embedding.squeeze()
-        cursor.execute(
-            """INSERT INTO chunk_embeddings 
-            (vetrina_id, file_id, page_number, description, image_path, embedding) 
-            VALUES (%s, %s, %s, %s, %s, %s)""",
-            (vetrina_id, file_id, page_number, description, image_name, embedding),
-        )
-    logging.debug(f"Inserted {len(chunks)} chunk embeddings")
+def claim_queue_file(worker_id: str, lease_seconds: int, max_attempts: int) -> Optional[Dict[str, Any]]:
+    """
+    Claim the oldest pending file of the processing queue for a worker.
+    Rows locked by another worker are skipped, rows whose lease expired (crashed worker) are claimed again.
+
+    Args:
+        worker_id: Identifier of the claiming worker, stored in locked_by
+        lease_seconds: Duration of the lease, renewed with heartbeat_queue_file
+        max_attempts: Rows already attempted this many times are marked as failed instead (and their staged upload removed)
+
+    Returns:
+        The claimed queue row, None if there is nothing to process
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE file_processing_queue q
+                SET status = 'failed', locked_by = NULL, lease_expires_at = NULL, staged_path = '',
+                    last_error = COALESCE(q.last_error, 'Lease expired too many times')
+                FROM (
+                    SELECT uploading_file_id, staged_path FROM file_processing_queue
+                    WHERE status = 'processing' AND lease_expires_at < CURRENT_TIMESTAMP AND attempts >= %s
+                    FOR UPDATE SKIP LOCKED
+                ) expired
+                WHERE q.uploading_file_id = expired.uploading_file_id
+                RETURNING expired.staged_path
+                """,
+                (max_attempts,),
+            )
+            failed_paths = [row["staged_path"] for row in cursor.fetchall()]
+            cursor.execute(
+                """
+                UPDATE file_processing_queue
+                SET status = 'processing',
+                    locked_by = %s,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    attempts = attempts + 1
+                WHERE uploading_file_id = (
+                    SELECT uploading_file_id FROM file_processing_queue
+                    WHERE (status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP)
+                        OR (status = 'processing' AND lease_expires_at < CURRENT_TIMESTAMP)
+                    ORDER BY upload_date ASC
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+                """,
+                (worker_id, lease_seconds),
+            )
+            queue_file = cursor.fetchone()
+            if queue_file:
+                logging.debug(f"Queue file {queue_file['uploading_file_id']} claimed by {worker_id} (attempt {queue_file['attempts']})")
+
+    remove_failed_uploads(failed_paths)
+    return queue_file
+
+
+def remove_failed_uploads(staged_paths: list[str]) -> None:
+    """Remove the staged uploads of queue files that reached the failed state, once it is committed."""
+    for staged_path in staged_paths:
+        if staged_path:
+            file_staging.remove_staged_file(staged_path)
+
+
+def heartbeat_queue_file(uploading_file_id: int, worker_id: str, lease_seconds: int) -> bool:
+    """
+    Extend the lease of a claimed queue file.
+
+    Returns:
+        bool: False if the worker no longer holds the lease
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE file_processing_queue
+                SET lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE uploading_file_id = %s AND locked_by = %s AND status = 'processing'
+                """,
+                (lease_seconds, uploading_file_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+
+def complete_queue_file(cursor: psycopg.Cursor, uploading_file_id: int, worker_id: str) -> None:
+    """
+    Remove a processed file from the queue, in the transaction that stores its results.
+
+    Raises:
+        ForbiddenError: If the worker lost the lease, so the results must not be committed
+    """
+    cursor.execute(
+        "DELETE FROM file_processing_queue WHERE uploading_file_id = %s AND locked_by = %s AND status = 'processing'",
+        (uploading_file_id, worker_id),
+    )
+    if cursor.rowcount == 0:
+        raise ForbiddenError(f"Worker {worker_id} no longer holds the lease on queue file {uploading_file_id}")
+
+
+def retry_backoff_seconds(attempts: int, base_seconds: float, max_seconds: float) -> float:
+    """Delay before retrying a queue file after its attempts-th attempt failed: base_seconds * 2^(attempts - 1), at most max_seconds."""
+    return float(min(base_seconds * 2 ** max(attempts - 1, 0), max_seconds))
+
+
+def release_queue_file(
+    uploading_file_id: int, worker_id: str, error: str, max_attempts: int, retry_base_seconds: float = 30, retry_max_seconds: float = 3600
+) -> Optional[float]:
+    """
+    Give back a queue file after a processing error: it becomes pending again after an exponential
+    backoff (see retry_backoff_seconds), or failed once it has been attempted max_attempts times.
+    The per-page checkpoint is kept, so the retry resumes from it.
+    A failed file can't be retried anymore, its staged upload is removed and staged_path cleared.
+
+    Returns:
+        Seconds until the file can be retried, None if it was marked as failed (or the lease was lost)
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT attempts, staged_path FROM file_processing_queue WHERE uploading_file_id = %s AND locked_by = %s FOR UPDATE",
+                (uploading_file_id, worker_id),
+            )
+            queue_file = cursor.fetchone()
+            if queue_file is None:
+                logging.debug(f"Queue file {uploading_file_id} not released, {worker_id} no longer holds its lease")
+                return None
+
+            failed = queue_file["attempts"] >= max_attempts
+            retry_in = retry_backoff_seconds(queue_file["attempts"], retry_base_seconds, retry_max_seconds)
+            cursor.execute(
+                """
+                UPDATE file_processing_queue
+                SET status = %(status)s,
+                    staged_path = %(staged_path)s,
+                    locked_by = NULL,
+                    lease_expires_at = NULL,
+                    last_error = %(error)s,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %(retry_in)s)
+                WHERE uploading_file_id = %(id)s
+                """,
+                {
+                    "status": "failed" if failed else "pending",
+                    "staged_path": "" if failed else queue_file["staged_path"],
+                    "error": error,
+                    "retry_in": retry_in,
+                    "id": uploading_file_id,
+                },
+            )
+            logging.debug(f"Queue file {uploading_file_id} released by {worker_id}: {error}")
+
+    if failed:
+        remove_failed_uploads([queue_file["staged_path"]])
+        return None
+    return retry_in
+
+
+def requeue_failed_files(uploading_file_id: int | None = None) -> int:
+    """
+    Move failed (dead letter) queue files back to pending with a fresh attempt budget.
+    Their checkpoint is kept, so they resume from the last completed page. The staged upload of a
+    file is removed when it fails: a dead letter is only requeued once its upload has been staged
+    again and staged_path set, the others are left failed.
+
+    Args:
+        uploading_file_id: Queue file to requeue, all failed files if None
+
+    Returns:
+        Number of requeued files
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE file_processing_queue
+                SET status = 'pending', attempts = 0, next_attempt_at = CURRENT_TIMESTAMP
+                WHERE status = 'failed' AND staged_path <> '' AND (%(id)s::integer IS NULL OR uploading_file_id = %(id)s)
+                """,
+                {"id": uploading_file_id},
+            )
+            logging.debug(f"Requeued {cursor.rowcount} failed queue files")
+            return cursor.rowcount
+
+
+def checkpoint_queue_page(uploading_file_id: int, worker_id: str, page_number: int, chunks: list[dict[str, str | int | np.ndarray]]) -> None:
+    """
+    Persist the chunks of a completed page and advance the checkpoint of a claimed queue file.
+    Pages are checkpointed in order, the chunk images must already be saved (image_path).
+
+    Raises:
+        ForbiddenError: If the worker no longer holds the lease
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            with conn.transaction():
+                cursor.execute(
+                    """
+                    UPDATE file_processing_queue SET checkpoint_page = %s
+                    WHERE uploading_file_id = %s AND locked_by = %s AND status = 'processing'
+                    """,
+                    (page_number, uploading_file_id, worker_id),
+                )
+                if cursor.rowcount == 0:
+                    raise ForbiddenError(f"Worker {worker_id} no longer holds the lease on queue file {uploading_file_id}")
+
+                # A page may have been partially stored by a worker that lost its lease
+                cursor.execute(
+                    "DELETE FROM file_processing_chunks WHERE uploading_file_id = %s AND page_number = %s",
+                    (uploading_file_id, page_number),
+                )
+                with cursor.copy(
+                    "COPY file_processing_chunks (uploading_file_id, page_number, description, context, image_path, embedding) FROM STDIN (FORMAT BINARY)"
+                ) as copy:
+                    copy.set_types(["int4", "int4", "text", "text", "varchar", "vector"])
+                    for chunk in chunks:
+                        embedding = np.asarray(chunk["embedding"], dtype=np.float32).squeeze()
+                        copy.write_row((uploading_file_id, page_number, chunk["description"], chunk["context"], chunk["image_path"], embedding))
+    logging.debug(f"Queue file {uploading_file_id} checkpointed at page {page_number} ({len(chunks)} chunks)")
+
+
+def get_checkpoint_chunks(uploading_file_id: int, page_number: int | None = None) -> List[Dict[str, Any]]:
+    """
+    Get the checkpointed chunks of a queue file, of a single page if page_number is given.
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT page_number, description, context, image_path FROM file_processing_chunks
+                WHERE uploading_file_id = %(id)s AND (%(page)s::integer IS NULL OR page_number = %(page)s)
+                ORDER BY page_number
+                """,
+                {"id": uploading_file_id, "page": page_number},
+            )
+            return cursor.fetchall()
+
+
+def insert_checkpointed_chunk_embeddings(cursor: psycopg.Cursor, uploading_file_id: int, vetrina_id: int, file_id: int) -> int:
+    """
+    Move the checkpointed chunks of a queue file to chunk_embeddings, in the transaction that completes it.
+
+    Returns:
+        Number of inserted chunks
+    """
+    cursor.execute(
+        """
+        INSERT INTO chunk_embeddings (vetrina_id, file_id, page_number, description, image_path, embedding, language)
+        SELECT %s, %s, fpc.page_number, fpc.description, fpc.image_path, fpc.embedding,
+            COALESCE((SELECT language FROM vetrina WHERE vetrina_id = %s), 'en')
+        FROM file_processing_chunks fpc
+        WHERE fpc.uploading_file_id = %s
+        ORDER BY fpc.page_number
+        """,
+        (vetrina_id, file_id, vetrina_id, uploading_file_id),
+    )
+    logging.debug(f"Inserted {cursor.rowcount} checkpointed chunk embeddings of queue file {uploading_file_id}")
+    return cursor.rowcount
+
+
+def save_chunk_images(images: list[Image.Image]) -> list[str]:
+    """Save chunk images to IMAGES_FOLDER in parallel, returns the generated file names."""
+    image_names = [f"{uuid.uuid4()}.png" for _ in images]
+    with ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS) as executor:
+        # PNG encoding releases the GIL, so the writes overlap
+        list(executor.map(lambda args: args[0].save(os.path.join(IMAGES_FOLDER, args[1])), zip(images, image_names)))
+    return image_names
 
 
 def update_file_display_name(user_id: int, file_id: int, new_display_name: str) -> File:
@@ -831,7 +1223,7 @@ def update_file_display_name(user_id: int, file_id: int, new_display_name: str)
     Raises:
         NotFoundException: If the file doesn't exist or the user doesn't own it
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             # Update the display name only if the user owns the file (through vetrina authorship)
             cursor.execute(
@@ -864,7 +1256,7 @@ def get_files_from_vetrina(vetrina_id: int, user_id: int | None = None) -> List[
     Returns:
         List[File]: List of File objects in the vetrina, with ownership and favorite information if user_id is provided
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             if user_id is not None:
                 # Query that checks if the user owns the file
@@ -907,7 +1299,7 @@ def delete_file(requester_id: int, file_id: int) -> File:
     Raises:
         NotFoundException: If the file is not found or the user doesn't have access
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -938,7 +1330,7 @@ def get_file(file_id: int) -> File:
     Raises:
         NotFoundException: If the file is not found
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 "SELECT * FROM files WHERE file_id = %s",
@@ -962,7 +1354,7 @@ def check_file_ownership(user_id: int, file_id: int) -> File:
     Returns:
         File: The file object if the user owns it, None otherwise
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             # Single query that returns file data only if user has ownership access
             cursor.execute(
@@ -993,7 +1385,7 @@ def add_owned_file(user_id: int, file_id: int) -> None:
     """
     Add a file to the owned files of a user.
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("INSERT INTO owned_files (owner_id, file_id) VALUES (%s, %s)", (user_id, file_id))
             conn.commit()
@@ -1004,7 +1396,7 @@ def remove_owned_file(user_id: int, file_id: int) -> None:
     """
     Remove a file from the owned files of a user.
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM owned_files WHERE owner_id = %s AND file_id = %s", (user_id, file_id))
             conn.commit()
@@ -1031,7 +1423,7 @@ def buy_file_transaction(user_id: int, file_id: int) -> Tuple[Transaction, File]
         NotFoundException: If the file is not found
         AlreadyOwnedError: If the user already owns the file
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             with conn.transaction():
                 cursor.execute(
@@ -1091,7 +1483,7 @@ def add_favorite_vetrina(user_id: int, vetrina_id: int) -> None:
     Raises:
         NotFoundException: If the vetrina doesn't exist
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("INSERT INTO favourite_vetrine (user_id, vetrina_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (user_id, vetrina_id))
             conn.commit()
@@ -1109,7 +1501,7 @@ def remove_favorite_vetrina(user_id: int, vetrina_id: int) -> None:
     Raises:
         NotFoundException: If the favorite doesn't exist
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM favourite_vetrine WHERE user_id = %s AND vetrina_id = %s", (user_id, vetrina_id))
             if cursor.rowcount == 0:
@@ -1129,7 +1521,7 @@ def add_favorite_file(user_id: int, file_id: int) -> None:
     Raises:
         NotFoundException: If the file doesn't exist
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("INSERT INTO favourite_file (user_id, file_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (user_id, file_id))
             conn.commit()
@@ -1147,7 +1539,7 @@ def remove_favorite_file(user_id: int, file_id: int) -> None:
     Raises:
         NotFoundException: If the favorite doesn't exist
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM favourite_file WHERE user_id = %s AND file_id = %s", (user_id, file_id))
             if cursor.rowcount == 0:
@@ -1167,7 +1559,7 @@ def get_vetrine_with_owned_files(user_id: int) -> List[Vetrina]:
     Returns:
         List[Vetrina]: List of Vetrina objects (without files)
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1199,7 +1591,7 @@ def get_favorites(user_id: int) -> List[Vetrina]:
     Returns:
         List[Vetrina]: List of Vetrina objects (without files) with favorite=True if the vetrina itself is favorited
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1237,7 +1629,7 @@ def get_reviews_for_user_vetrine(user_id: int) -> List[Review]:
     Returns:
         List[Review]: List of Review objects for vetrine and files authored by the user
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1266,7 +1658,7 @@ def get_reviews_authored_by_user(user_id: int) -> List[Review]:
     Returns:
         List[Review]: List of Review objects authored by the user
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1298,7 +1690,7 @@ def add_vetrina_review(user_id: int, rating: int, review_text: str, vetrina_id:
     Returns:
         Review: The created review object
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1333,7 +1725,7 @@ def add_file_review(user_id: int, rating: int, review_text: str, file_id: int) -
     Returns:
         Review: The created review object
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1361,7 +1753,7 @@ def get_vetrina_reviews(vetrina_id: int) -> List[Review]:
     """
     Get all reviews for a vetrina.
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1383,7 +1775,7 @@ def get_file_reviews(file_id: int) -> List[Review]:
     """
     Get all reviews for a file.
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1418,7 +1810,7 @@ def delete_review(user_id: int, file_id: int | None = None, vetrina_id: int | No
     if file_id is None and vetrina_id is None:
         raise ValueError("Either file_id or vetrina_id must be provided")
 
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             if file_id is not None:
                 # Delete file review
@@ -1453,7 +1845,7 @@ def follow_user(user_id: int, followed_user_id: int) -> None:
     if user_id == followed_user_id:
         raise ValueError("Users cannot follow themselves")
 
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 "INSERT INTO follow (user_id, followed_user_id) VALUES (%s, %s) RETURNING *",
@@ -1474,7 +1866,7 @@ def unfollow_user(user_id: int, followed_user_id: int) -> None:
     Raises:
         NotFoundException: If the follow relationship doesn't exist
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM follow WHERE user_id = %s AND followed_user_id = %s", (user_id, followed_user_id))
             conn.commit()
@@ -1491,7 +1883,7 @@ def get_user_followers(user_id: int) -> List[User]:
     Returns:
         List[User]: List of User objects containing follower information
     """
-    with connect() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1519,7 +1911,7 @@ def get_user_following(user_id: int) -> List[User]:
     Returns:
         List[User]: List of User objects containing followed user information
     """
-    with pool.connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
                 """
@@ -1535,3 +1927,95 @@ def get_user_following(user_id: int) -> List[User]:
             logging.debug(f"Found {len(following_data)} users that user {user_id} is following")
 
             return [User.from_dict(following_row) for following_row in following_data]
+
+
+# ---------------------------------------------
+# Vector index management
+# ---------------------------------------------
+
+
+def set_vector_search_params(cursor: psycopg.Cursor, ef_search: Optional[int] = None, probes: Optional[int] = None) -> None:
+    """
+    Tune the ANN index for the current transaction (recall vs latency trade-off).
+
+    Args:
+        cursor: Cursor of the transaction running the vector query
+        ef_search: HNSW candidate list size (default: HNSW_EF_SEARCH)
+        probes: Number of IVFFlat lists to scan (default: IVFFLAT_PROBES)
+    """
+    ef_search = HNSW_EF_SEARCH if ef_search is None else int(ef_search)
+    probes = IVFFLAT_PROBES if probes is None else int(probes)
+    if ef_search < 1 or probes < 1:
+        raise ValueError("ef_search and probes must be positive")
+    # set_config(..., true) behaves like SET LOCAL and is reset at the end of the transaction
+    cursor.execute(
+        "SELECT set_config('hnsw.ef_search', %s, true), set_config('ivfflat.probes', %s, true)",
+        (str(ef_search), str(probes)),
+    )
+
+
+def create_vector_index(method: Optional[str] = None, lists: Optional[int] = None, replace: bool = False) -> None:
+    """
+    Create the approximate nearest-neighbour index on chunk_embeddings.embedding.
+    The index is built with CONCURRENTLY so searches keep working during the build.
+
+    Args:
+        method: "hnsw" or "ivfflat" (default: VECTOR_INDEX_METHOD)
+        lists: Number of IVFFlat lists (default: rows / 1000, sqrt(rows) above one million rows)
+        replace: Drop the existing index first, e.g. to switch method or parameters
+    """
+    method = method or VECTOR_INDEX_METHOD
+    if method not in ("hnsw", "ivfflat"):
+        raise ValueError(f"Unsupported vector index method: {method}")
+
+    # CREATE/DROP INDEX CONCURRENTLY cannot run inside a transaction block
+    with connect(autocommit=True) as conn:
+        with conn.cursor() as cursor:
+            if replace:
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {VECTOR_INDEX_NAME}")
+
+            if method == "hnsw":
+                options = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+            else:
+                if lists is None:
+                    cursor.execute("SELECT COUNT(*) AS n_rows FROM chunk_embeddings")
+                    rows = cursor.fetchone()["n_rows"]
+                    lists = rows // 1000 if rows <= 1_000_000 else int(np.sqrt(rows))
+                options = f"lists = {max(int(lists), 1)}"
+
+            cursor.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {VECTOR_INDEX_NAME} "
+                f"ON chunk_embeddings USING {method} (embedding vector_ip_ops) WITH ({options})"
+            )
+            logging.info(f"Vector index {VECTOR_INDEX_NAME} ready ({method}, {options})")
+
+
+def reindex_vector_index() -> None:
+    """
+    Rebuild the vector index in place, e.g. after a bulk load or when IVFFlat centroids
+    no longer represent the data.
+    """
+    with connect(autocommit=True) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"REINDEX INDEX CONCURRENTLY {VECTOR_INDEX_NAME}")
+            logging.info(f"Vector index {VECTOR_INDEX_NAME} rebuilt")
+
+
+def get_vector_index_info() -> Optional[Dict[str, Any]]:
+    """
+    Get the definition and size of the vector index.
+
+    Returns:
+        Dict with the index name, definition and size in bytes, None if the index does not exist
+    """
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT indexname AS name, indexdef AS definition, pg_relation_size(indexname::regclass) AS size
+                FROM pg_indexes
+                WHERE tablename = 'chunk_embeddings' AND indexname = %s
+                """,
+                (VECTOR_INDEX_NAME,),
+            )
+            return cursor.fetchone()
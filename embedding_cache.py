@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def normalize_query(text: str) -> str:
+    """Normalize a search query so that trivially different spellings share a cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache with TTL for query embeddings, with an optional shared Redis tier.
+    Entries are keyed on the normalized text and the model version; Redis stores raw float32 bytes.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, model_version: str = "", redis_url: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.model_version = model_version
+        self.entries: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+        self.redis = None
+        if redis_url:
+            if redis is None:
+                logging.warning("EMBEDDING_CACHE_REDIS_URL is set but the redis package is not installed, using the local cache only")
+            else:
+                self.redis = redis.Redis.from_url(redis_url)
+
+    def _redis_key(self, text: str) -> str:
+        return f"query_embedding:{self.model_version}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(text)
+            if entry is not None:
+                expires_at, embedding = entry
+                if expires_at > now:
+                    self.entries.move_to_end(text)
+                    self.hits += 1
+                    return embedding
+                del self.entries[text]
+
+        if self.redis is not None:
+            try:
+                data = self.redis.get(self._redis_key(text))
+            except Exception as e:
+                logging.error(f"Error reading query embedding from Redis: {e}")
+                data = None
+            if data is not None:
+                embedding = np.frombuffer(data, dtype=np.float32).reshape(1, -1)
+                self._set_local(text, embedding)
+                with self.lock:
+                    self.redis_hits += 1
+                return embedding
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, text: str, embedding: np.ndarray) -> None:
+        embedding = np.ascontiguousarray(embedding, dtype=np.float32).reshape(1, -1)
+        embedding.flags.writeable = False
+        self._set_local(text, embedding)
+
+        # A TTL of 0 or less disables caching, Redis rejects a zero expiry
+        ttl_ms = int(self.ttl * 1000)
+        if self.redis is not None and ttl_ms > 0:
+            try:
+                self.redis.set(self._redis_key(text), embedding.tobytes(), px=ttl_ms)
+            except Exception as e:
+                logging.error(f"Error writing query embedding to Redis: {e}")
+
+    def _set_local(self, text: str, embedding: np.ndarray) -> None:
+        with self.lock:
+            self.entries[text] = (time.monotonic() + self.ttl, embedding)
+            self.entries.move_to_end(text)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "model_version": self.model_version,
+                "redis": self.redis is not None,
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+            }
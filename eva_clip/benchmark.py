@@ -0,0 +1,196 @@
+"""
+Micro-benchmarks of the EVA vision tower on the current device.
+
+Usage:
+    python -m eva_clip.benchmark attention [--batch 8] [--runs 20] [--impls naive,sdpa] [--full]
+    python -m eva_clip.benchmark positional [--batch 8] [--runs 50] [--full]
+
+attention: latency and peak memory of one Attention layer (EVA02-CLIP-L-14 shapes, rope, subln) or,
+with --full, of the whole vision tower, for each attention implementation. Every implementation runs
+in its own process so the CPU peak memory (max RSS) of one doesn't hide the others.
+
+positional: per image latency of the rope, of one Attention layer and, with --full, of the whole
+vision tower with the positional tables recomputed at every forward and with inference mode.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import torch
+
+from .eva_vit_model import Attention
+from .rope import VisionRotaryEmbeddingFast
+
+# EVA02-CLIP-L-14 vision tower
+DIM = 1024
+HEADS = 16
+IMAGE_SIZE = 224
+PATCH_SIZE = 14
+PT_HW_SEQ_LEN = 16
+
+
+def build_attention(attn_impl: str, seed: int = 0) -> Attention:
+    torch.manual_seed(seed)
+    hw_seq_len = IMAGE_SIZE // PATCH_SIZE
+    rope = VisionRotaryEmbeddingFast(dim=DIM // HEADS // 2, pt_seq_len=PT_HW_SEQ_LEN, ft_seq_len=hw_seq_len)
+    attn = Attention(DIM, num_heads=HEADS, qkv_bias=True, rope=rope, subln=True, attn_impl=attn_impl)
+    for param in attn.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    return attn.eval()
+
+
+def build_vision_tower(attn_impl: str, seed: int = 0):
+    from .factory import create_eva_vision_and_transforms
+
+    torch.manual_seed(seed)
+    model, _, _ = create_eva_vision_and_transforms("EVA02-CLIP-L-14", force_custom_clip=True, force_attn_impl=attn_impl)
+    return model.eval()
+
+
+def _time_ms(forward, runs: int, device: torch.device) -> list[float]:
+    forward()  # Warm up, and fill the inference mode tables
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        forward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def _max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def _run(args: tuple) -> dict:
+    attn_impl, batch, runs, full, device = args
+    torch.set_grad_enabled(False)
+    device = torch.device(device)
+
+    if full:
+        model = build_vision_tower(attn_impl).to(device)
+        x = torch.randn(batch, 3, IMAGE_SIZE, IMAGE_SIZE, device=device)
+        forward = lambda: model.encode_image(x, normalize=False)
+    else:
+        model = build_attention(attn_impl).to(device)
+        x = torch.randn(batch, (IMAGE_SIZE // PATCH_SIZE) ** 2 + 1, DIM, device=device)
+        forward = lambda: model(x)
+
+    # Peak memory of a single forward on top of the weights and inputs
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated() / 2**20
+        forward()
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / 2**20 - baseline
+    else:
+        baseline = _max_rss_mb()
+        forward()
+        peak_mb = _max_rss_mb() - baseline
+
+    latencies = _time_ms(forward, runs, device)
+
+    return {
+        "impl": attn_impl,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "peak_mb": peak_mb,
+    }
+
+
+def attention_parity(impls: list[str], batch: int, device: str) -> dict:
+    """Max absolute difference of each implementation's output against the naive attention."""
+    torch.set_grad_enabled(False)
+    x = torch.randn(batch, (IMAGE_SIZE // PATCH_SIZE) ** 2 + 1, DIM, device=device)
+    reference = build_attention("naive").to(device)(x)
+    return {impl: (build_attention(impl).to(device)(x) - reference).abs().max().item() for impl in impls}
+
+
+def benchmark_attention(impls: list[str], batch: int, runs: int, full: bool, device: str) -> list[dict]:
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for impl in impls:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_run, ((impl, batch, runs, full, device),)))
+    return results
+
+
+def _set_inference_mode(module: torch.nn.Module, enabled: bool) -> None:
+    for submodule in module.modules():
+        if hasattr(submodule, "set_inference_mode"):
+            submodule.set_inference_mode(enabled)
+
+
+def benchmark_positional(batch: int, runs: int, full: bool, device: str) -> list[dict]:
+    """Per image p50 of the rope, one Attention layer and optionally the vision tower, without and with inference mode."""
+    torch.set_grad_enabled(False)
+    device = torch.device(device)
+    tokens = (IMAGE_SIZE // PATCH_SIZE) ** 2 + 1
+
+    attn = build_attention("auto").to(device)
+    x = torch.randn(batch, tokens, DIM, device=device)
+    q = torch.randn(batch, HEADS, tokens - 1, DIM // HEADS, device=device)
+    cases = [("rope", attn.rope, lambda: attn.rope(q)), ("attention", attn, lambda: attn(x))]
+    if full:
+        tower = build_vision_tower("auto").to(device)
+        images = torch.randn(batch, 3, IMAGE_SIZE, IMAGE_SIZE, device=device)
+        cases.append(("vision tower", tower.visual, lambda: tower.encode_image(images, normalize=False)))
+
+    results = []
+    for name, module, forward in cases:
+        row = {"module": name}
+        for enabled in (False, True):
+            _set_inference_mode(module, enabled)
+            row["inference" if enabled else "baseline"] = float(np.percentile(_time_ms(forward, runs, device), 50)) / batch
+        results.append(row)
+    return results
+
+
+def positional_parity(batch: int, device: str) -> float:
+    """Max absolute difference of one Attention layer output with and without inference mode."""
+    torch.set_grad_enabled(False)
+    attn = build_attention("naive").to(device)
+    x = torch.randn(batch, (IMAGE_SIZE // PATCH_SIZE) ** 2 + 1, DIM, device=device)
+    reference = attn(x)
+    attn.rope.set_inference_mode(True)
+    return (attn(x) - reference).abs().max().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EVA vision tower micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    attention_parser = subparsers.add_parser("attention")
+    attention_parser.add_argument("--impls", default="naive,sdpa")
+    attention_parser.add_argument("--batch", type=int, default=8)
+    attention_parser.add_argument("--runs", type=int, default=20)
+    attention_parser.add_argument("--full", action="store_true", help="Benchmark the whole vision tower instead of one layer")
+    attention_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+    positional_parser = subparsers.add_parser("positional")
+    positional_parser.add_argument("--batch", type=int, default=8)
+    positional_parser.add_argument("--runs", type=int, default=50)
+    positional_parser.add_argument("--full", action="store_true", help="Also benchmark the whole vision tower")
+    positional_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+    args = parser.parse_args()
+
+    if args.command == "attention":
+        impls = [impl for impl in args.impls.split(",") if impl]
+        print(f"{'batch ' + str(args.batch) + (' full tower' if args.full else ' one layer') + ' on ' + args.device}")
+        print(f"{'impl':<10}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}{'max diff':>12}")
+        parity = attention_parity(impls, min(args.batch, 2), args.device)
+        for row in benchmark_attention(impls, args.batch, args.runs, args.full, args.device):
+            print(f"{row['impl']:<10}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['peak_mb']:>10.1f}{parity[row['impl']]:>12.2e}")
+
+    elif args.command == "positional":
+        print(f"batch {args.batch} on {args.device}, max diff of inference mode {positional_parity(min(args.batch, 2), args.device):.2e}")
+        print(f"{'module':<14}{'ms/img':>10}{'inference':>11}{'saved':>8}")
+        for row in benchmark_positional(args.batch, args.runs, args.full, args.device):
+            saved = 1 - row["inference"] / row["baseline"] if row["baseline"] else 0.0
+            print(f"{row['module']:<14}{row['baseline']:>10.3f}{row['inference']:>11.3f}{saved:>8.1%}")
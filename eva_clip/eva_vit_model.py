@@ -20,6 +20,12 @@ except ImportError:
     xops = None
     # print("Please 'pip install xformers'")
 
+# Attention implementations, selected when the model is built:
+# "xformers" (memory efficient, CUDA only), "sdpa" (torch scaled_dot_product_attention, fused kernels
+# that don't materialize the N x N matrix when possible), "naive" (explicit softmax(q @ k^T) @ v) and
+# "auto" (xformers on CUDA when installed, sdpa otherwise)
+ATTN_IMPLS = ("auto", "xformers", "sdpa", "naive")
+
 
 class DropPath(nn.Module):
     """Drop paths (Stochastic Depth) per sample  (when applied in main path of residual blocks).
@@ -97,8 +103,14 @@ class SwiGLU(nn.Module):
 class Attention(nn.Module):
     def __init__(
             self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.,
-            proj_drop=0., window_size=None, attn_head_dim=None, xattn=False, rope=None, subln=False, norm_layer=nn.LayerNorm):
+            proj_drop=0., window_size=None, attn_head_dim=None, xattn=False, rope=None, subln=False, norm_layer=nn.LayerNorm,
+            attn_impl="auto"):
         super().__init__()
+        if attn_impl not in ATTN_IMPLS:
+            raise ValueError(f"Unknown attention implementation {attn_impl}, valid values are: {', '.join(ATTN_IMPLS)}")
+        if attn_impl == "xformers" and xops is None:
+            raise ValueError("The xformers attention implementation requires xformers, pip install xformers")
+        self.attn_impl = attn_impl
         self.num_heads = num_heads
         head_dim = dim // num_heads
         if attn_head_dim is not None:
@@ -161,6 +173,30 @@ class Attention(nn.Module):
 
         self.rope = rope
 
+        # Inference mode: relative position bias gathered once per (dtype, device)
+        self.inference = False
+        self.inference_bias = {}
+
+    def set_inference_mode(self, enabled=True):
+        self.inference = enabled
+        self.inference_bias = {}
+
+    def precompute(self, dtype, device):
+        if self.relative_position_bias_table is not None:
+            self.cached_relative_position_bias(dtype, device)
+
+    def cached_relative_position_bias(self, dtype, device):
+        """1, nH, N, N relative position bias, cached in inference mode"""
+        cache = self.inference and not self.training
+        key = (dtype, device)
+        bias = self.inference_bias.get(key) if cache else None
+        if bias is None:
+            with torch.set_grad_enabled(torch.is_grad_enabled() and not cache):
+                bias = self.relative_position_bias().unsqueeze(0).to(device=device, dtype=dtype)
+            if cache:
+                self.inference_bias[key] = bias
+        return bias
+
     def forward(self, x, rel_pos_bias=None, attn_mask=None):
         B, N, C = x.shape
         if self.subln: 
@@ -191,7 +227,11 @@ class Attention(nn.Module):
             ro_k_t = self.rope(k_t)
             k = torch.cat((k[:, :, :1, :], ro_k_t), -2).type_as(v)
 
-        if xops is not None:
+        attn_impl = self.attn_impl
+        if attn_impl == "auto":
+            attn_impl = "xformers" if xops is not None and q.is_cuda else "sdpa"
+
+        if attn_impl == "xformers":
             q = q.permute(0, 2, 1, 3)   # B, num_heads, N, C -> B, N, num_heads, C
             k = k.permute(0, 2, 1, 3)
             v = v.permute(0, 2, 1, 3)
@@ -205,17 +245,26 @@ class Attention(nn.Module):
             x = self.inner_attn_ln(x)
             x = self.proj(x)
             x = self.proj_drop(x)
+        elif attn_impl == "sdpa":
+            # Relative position biases and the padding mask are folded into a single additive mask,
+            # a mask-free call lets torch pick a fused kernel
+            bias = self.attention_bias(rel_pos_bias, attn_mask, q.dtype)
+            x = F.scaled_dot_product_attention(
+                q, k, v,
+                attn_mask=bias,
+                dropout_p=self.xattn_drop if self.training else 0.,
+                scale=self.scale,
+                )
+            x = x.transpose(1, 2).reshape(B, N, -1)
+            x = self.inner_attn_ln(x)
+            x = self.proj(x)
+            x = self.proj_drop(x)
         else:
             q = q * self.scale
             attn = (q @ k.transpose(-2, -1))
 
             if self.relative_position_bias_table is not None:
-                relative_position_bias = \
-                    self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                        self.window_size[0] * self.window_size[1] + 1,
-                        self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-                relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-                attn = attn + relative_position_bias.unsqueeze(0).type_as(attn)
+                attn = attn + self.cached_relative_position_bias(attn.dtype, attn.device)
 
             if rel_pos_bias is not None:
                 attn = attn + rel_pos_bias.type_as(attn)
@@ -233,19 +282,41 @@ class Attention(nn.Module):
             x = self.proj_drop(x)
         return x
 
+    def relative_position_bias(self):
+        relative_position_bias = \
+            self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+                self.window_size[0] * self.window_size[1] + 1,
+                self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def attention_bias(self, rel_pos_bias=None, attn_mask=None, dtype=torch.float32):
+        """Additive attention mask for scaled_dot_product_attention, None when nothing is masked or biased"""
+        bias = None
+        if self.relative_position_bias_table is not None:
+            bias = self.cached_relative_position_bias(dtype, self.relative_position_bias_table.device)  # 1, nH, N, N
+        if rel_pos_bias is not None:
+            bias = rel_pos_bias.to(dtype) if bias is None else bias + rel_pos_bias.to(dtype)
+        if attn_mask is not None:
+            attn_mask = attn_mask.bool()[:, None, None, :]  # B, 1, 1, N
+            if bias is None:
+                # A boolean mask (True = attend) is passed as is
+                return attn_mask
+            bias = bias.masked_fill(~attn_mask, float("-inf"))
+        return bias
+
 
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
                  drop_path=0., init_values=None, act_layer=nn.GELU, norm_layer=nn.LayerNorm,
                  window_size=None, attn_head_dim=None, xattn=False, rope=None, postnorm=False,
-                 subln=False, naiveswiglu=False):
+                 subln=False, naiveswiglu=False, attn_impl="auto"):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
             attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim,
-            xattn=xattn, rope=rope, subln=subln, norm_layer=norm_layer)
+            xattn=xattn, rope=rope, subln=subln, norm_layer=norm_layer, attn_impl=attn_impl)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -346,12 +417,30 @@ class RelativePositionBias(nn.Module):
 
         self.register_buffer("relative_position_index", relative_position_index)
 
+        # Inference mode: the bias only depends on the weights, gather it once
+        self.inference = False
+        self.inference_bias = None
+
+    def set_inference_mode(self, enabled=True):
+        self.inference = enabled
+        self.inference_bias = None
+
+    def precompute(self, dtype, device):
+        self.forward()
+
     def forward(self):
-        relative_position_bias = \
-            self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                self.window_size[0] * self.window_size[1] + 1,
-                self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        cache = self.inference and not self.training
+        if cache and self.inference_bias is not None:
+            return self.inference_bias
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not cache):
+            relative_position_bias = \
+                self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+                    self.window_size[0] * self.window_size[1] + 1,
+                    self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
+            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        if cache:
+            self.inference_bias = relative_position_bias
+        return relative_position_bias
 
 
 class EVAVisionTransformer(nn.Module):
@@ -362,7 +451,7 @@ class EVAVisionTransformer(nn.Module):
                  drop_path_rate=0., norm_layer=nn.LayerNorm, init_values=None, patch_dropout=0.,
                  use_abs_pos_emb=True, use_rel_pos_bias=False, use_shared_rel_pos_bias=False, rope=False,
                  use_mean_pooling=True, init_scale=0.001, grad_checkpointing=False, xattn=False, postnorm=False,
-                 pt_hw_seq_len=16, intp_freq=False, naiveswiglu=False, subln=False):
+                 pt_hw_seq_len=16, intp_freq=False, naiveswiglu=False, subln=False, attn_impl="auto"):
         super().__init__()
         self.image_size = img_size
         self.num_classes = num_classes
@@ -406,7 +495,8 @@ class EVAVisionTransformer(nn.Module):
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
                 init_values=init_values, window_size=self.patch_embed.patch_shape if use_rel_pos_bias else None,
-                xattn=xattn, rope=self.rope, postnorm=postnorm, subln=subln, naiveswiglu=naiveswiglu)
+                xattn=xattn, rope=self.rope, postnorm=postnorm, subln=subln, naiveswiglu=naiveswiglu,
+                attn_impl=attn_impl)
             for i in range(depth)])
         self.norm = nn.Identity() if use_mean_pooling else norm_layer(embed_dim)
         self.fc_norm = norm_layer(embed_dim) if use_mean_pooling else None
@@ -477,6 +567,22 @@ class EVAVisionTransformer(nn.Module):
         self.num_classes = num_classes
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
+    def set_inference_mode(self, enabled=True, dtype=None, device=None):
+        """
+        Inference mode caches the positional tensors that only depend on the weights (rope cos/sin tables,
+        relative position biases) instead of recomputing them in every block at every forward.
+        They are precomputed for dtype/device when given, otherwise on first use. Turn it off before
+        training or changing the weights, the cached tensors don't track gradients.
+        """
+        for module in self.modules():
+            if module is not self and hasattr(module, "set_inference_mode"):
+                module.set_inference_mode(enabled)
+        if enabled and dtype is not None:
+            device = device or self.cls_token.device
+            for module in self.modules():
+                if module is not self and hasattr(module, "precompute"):
+                    module.precompute(dtype, device)
+
     def forward_features(self, x, return_all_features=False):
         
         x = self.patch_embed(x)
@@ -490,11 +596,12 @@ class EVAVisionTransformer(nn.Module):
 
         # a patch_dropout of 0. would mean it is disabled and this function would do nothing but return what was passed in
         if os.getenv('RoPE') == '1':
+            # Bound from the class method, so the partials don't nest a little more at every forward
             if self.training and not isinstance(self.patch_dropout, nn.Identity):
                 x, patch_indices_keep = self.patch_dropout(x)
-                self.rope.forward = partial(self.rope.forward, patch_indices_keep=patch_indices_keep)
+                self.rope.forward = partial(type(self.rope).forward, self.rope, patch_indices_keep=patch_indices_keep)
             else:
-                self.rope.forward = partial(self.rope.forward, patch_indices_keep=None)
+                self.rope.forward = partial(type(self.rope).forward, self.rope, patch_indices_keep=None)
                 x = self.patch_dropout(x)
         else:
             x = self.patch_dropout(x)
@@ -226,6 +226,7 @@ def create_model(
         skip_list: list  = [],
         is_only_visual: bool = False,
         is_only_text: bool = False,
+        force_attn_impl: Optional[str] = None,
 ):
     model_name = model_name.replace('/', '-')  # for callers using old naming with / in ViT names
     if isinstance(device, str):
@@ -262,6 +263,10 @@ def create_model(
             # override the default patch dropout value
             model_cfg['vision_cfg']["patch_dropout"] = force_patch_dropout
 
+        if force_attn_impl is not None:
+            # override the attention implementation of the vision tower
+            model_cfg['vision_cfg']["attn_impl"] = force_attn_impl
+
         cast_dtype = get_cast_dtype(precision)
         custom_clip = model_cfg.pop('custom_text', False) or force_custom_clip or ('hf_model_name' in model_cfg['text_cfg'])
 
@@ -431,6 +436,8 @@ def create_eva_vision_and_transforms(
         image_std: Optional[Tuple[float, ...]] = None,
         cache_dir: Optional[str] = None,
         skip_list: list = [],
+        force_attn_impl: Optional[str] = None,
+        train_transform: bool = True,
 ):
     model = create_model(
         model_name,
@@ -449,16 +456,18 @@ def create_eva_vision_and_transforms(
         cache_dir=cache_dir,
         skip_list=skip_list,
         is_only_visual=True, # only use visual tower
+        force_attn_impl=force_attn_impl,
     )
 
     image_mean = image_mean or getattr(model.visual, 'image_mean', None)
     image_std = image_std or getattr(model.visual, 'image_std', None)
+    # None for inference only models
     preprocess_train = image_transform(
         model.visual.image_size,
         is_train=True,
         mean=image_mean,
         std=image_std
-    )
+    ) if train_transform else None
     preprocess_val = image_transform(
         model.visual.image_size,
         is_train=False,
@@ -60,6 +60,7 @@ class CLIPVisionCfg:
     intp_freq: bool = False
     naiveswiglu: bool = False
     subln: bool = False
+    attn_impl: str = "auto"  # attention implementation of the EVA vision tower: auto, xformers, sdpa or naive
 
 
 @dataclass
@@ -127,7 +128,8 @@ def _build_vision_tower(
             pt_hw_seq_len= vision_cfg.pt_hw_seq_len,   # 224/14
             intp_freq= vision_cfg.intp_freq,
             naiveswiglu= vision_cfg.naiveswiglu,
-            subln= vision_cfg.subln
+            subln= vision_cfg.subln,
+            attn_impl= vision_cfg.attn_impl
         )
     elif vision_cfg.timm_model_name:
         visual = TimmModel(
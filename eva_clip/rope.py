@@ -26,6 +26,10 @@ def rotate_half(x):
     x = torch.stack((-x2, x1), dim = -1)
     return rearrange(x, '... d r -> ... (d r)')
 
+def swap_pairs(x):
+    # rotate_half without the sign, which the inference tables fold into freqs_sin
+    return x.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
+
 
 class VisionRotaryEmbedding(nn.Module):
     def __init__(
@@ -116,22 +120,39 @@ class VisionRotaryEmbeddingFast(nn.Module):
         self.register_buffer("freqs_cos", freqs_cos)
         self.register_buffer("freqs_sin", freqs_sin)
 
+        # Inference mode: cos and signed sin tables cast once per (dtype, device)
+        self.inference = False
+        self.inference_tables = {}
+
         logging.debug(f'Shape of rope freq: {self.freqs_cos.shape}')
 
-    def forward(self, t, patch_indices_keep=None):
-        if patch_indices_keep is not None:
-            batch = t.size()[0]
-            batch_indices = torch.arange(batch)
-            batch_indices = batch_indices[..., None]
+    def set_inference_mode(self, enabled=True):
+        self.inference = enabled
+        self.inference_tables = {}
 
-            freqs_cos = repeat(self.freqs_cos, 'i j -> n i m j', n=t.shape[0], m=t.shape[1])
-            freqs_sin = repeat(self.freqs_sin, 'i j -> n i m j', n=t.shape[0], m=t.shape[1])
+    def tables(self, dtype, device):
+        key = (dtype, device)
+        tables = self.inference_tables.get(key)
+        if tables is None:
+            with torch.no_grad():
+                sign = torch.tensor([-1., 1.], device=self.freqs_sin.device).repeat(self.freqs_sin.shape[-1] // 2)
+                tables = (self.freqs_cos.to(device=device, dtype=dtype), (self.freqs_sin * sign).to(device=device, dtype=dtype))
+            self.inference_tables[key] = tables
+        return tables
 
-            freqs_cos = freqs_cos[batch_indices, patch_indices_keep]
-            freqs_cos = rearrange(freqs_cos, 'n i m j -> n m i j')
-            freqs_sin = freqs_sin[batch_indices, patch_indices_keep]
-            freqs_sin = rearrange(freqs_sin, 'n i m j -> n m i j')
+    def precompute(self, dtype, device):
+        self.tables(dtype, device)
+
+    def forward(self, t, patch_indices_keep=None):
+        if patch_indices_keep is not None:
+            # Per sample kept positions, broadcast over the heads instead of repeating the tables
+            freqs_cos = self.freqs_cos[patch_indices_keep].unsqueeze(1)  # n, 1, kept, j
+            freqs_sin = self.freqs_sin[patch_indices_keep].unsqueeze(1)
 
             return  t * freqs_cos + rotate_half(t) * freqs_sin
 
+        if self.inference:
+            freqs_cos, freqs_sin_signed = self.tables(t.dtype, t.device)
+            return t * freqs_cos + swap_pairs(t) * freqs_sin_signed
+
         return  t * self.freqs_cos + rotate_half(t) * self.freqs_sin
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Staging area for uploaded files waiting in file_processing_queue.
+
+Uploads are streamed to STAGING_FOLDER with a fixed-size buffer while their sha256 is computed,
+and the queue row only stores the path. The worker opens the staged file directly and removes
+it once the file has been processed, so the upload never sits in memory or in the database.
+"""
+
+import hashlib
+import logging
+import os
+import uuid
+from typing import BinaryIO, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STAGING_FOLDER = os.getenv("STAGING_FOLDER", os.path.join(os.getenv("FILES_FOLDER", "."), "staging"))
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_SIZE", 1024 * 1024))  # Bytes read per chunk while staging an upload
+
+
+def stage_upload(stream: BinaryIO, file_name: str) -> Tuple[str, str, int]:
+    """
+    Stream an upload to the staging folder.
+    The file is written under a temporary name and renamed when complete, so a staged path is never partial.
+
+    Args:
+        stream: Readable binary stream of the upload
+        file_name: Name of the file, used as suffix of the staged file name
+
+    Returns:
+        Tuple of (staged file path, sha256 hex digest, size in bytes)
+    """
+    os.makedirs(STAGING_FOLDER, exist_ok=True)
+    staged_path = os.path.join(STAGING_FOLDER, f"{uuid.uuid4()}-{os.path.basename(file_name)}")
+    partial_path = staged_path + ".part"
+
+    sha256 = hashlib.sha256()
+    size = 0
+    buffer = bytearray(UPLOAD_BUFFER_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(partial_path, "wb") as f:
+            while True:
+                read = stream.readinto(view) if hasattr(stream, "readinto") else _read_into(stream, view)
+                if not read:
+                    break
+                sha256.update(view[:read])
+                f.write(view[:read])
+                size += read
+        os.replace(partial_path, staged_path)
+    except BaseException:
+        remove_staged_file(partial_path)
+        raise
+
+    logging.debug(f"Staged upload {file_name} at {staged_path} ({size} bytes)")
+    return staged_path, sha256.hexdigest(), size
+
+
+def _read_into(stream: BinaryIO, view: memoryview) -> int:
+    data = stream.read(len(view))
+    view[: len(data)] = data
+    return len(data)
+
+
+def remove_staged_file(staged_path: str) -> None:
+    """Remove a staged file, ignoring files that are already gone."""
+    try:
+        os.remove(staged_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.error(f"Error removing staged file {staged_path}: {e}")
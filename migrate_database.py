@@ -0,0 +1,46 @@
+"""
+Upgrade an existing database to the current schema.sql without dropping any data.
+
+schema.sql recreates every table from scratch, so new columns, tables and indexes are also
+shipped as idempotent statements in migrations/, applied here in file name order. A .sql
+migration is executed as is, a .py migration (for data that SQL alone can't move, e.g. files)
+defines migrate(conn). Every migration can be run again on an up to date database.
+
+Usage:
+    python migrate_database.py
+"""
+
+import glob
+import importlib.util
+import logging
+import os
+
+from database import connect
+
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+
+def _run_python_migration(path: str, conn) -> None:
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.migrate(conn)
+
+
+def migrate() -> None:
+    paths = glob.glob(os.path.join(MIGRATIONS_FOLDER, "*.sql")) + glob.glob(os.path.join(MIGRATIONS_FOLDER, "*.py"))
+    with connect(vector=False) as conn:
+        for path in sorted(paths, key=os.path.basename):
+            if path.endswith(".py"):
+                _run_python_migration(path, conn)
+            else:
+                with open(path, "r") as f:
+                    with conn.cursor() as cursor:
+                        cursor.execute(f.read())
+            conn.commit()
+            logging.info(f"Applied {os.path.basename(path)}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
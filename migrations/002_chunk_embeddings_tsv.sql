@@ -0,0 +1,14 @@
+-- Stored tsvector of the chunk descriptions, searched through a GIN index (see new_search)
+ALTER TABLE chunk_embeddings ADD COLUMN IF NOT EXISTS language VARCHAR(15) NOT NULL DEFAULT 'en';
+
+-- Chunks inserted before the column existed take the language of their vetrina
+UPDATE chunk_embeddings ce
+SET language = v.language
+FROM vetrina v
+WHERE ce.vetrina_id = v.vetrina_id AND ce.language IS DISTINCT FROM v.language;
+
+ALTER TABLE chunk_embeddings ADD COLUMN IF NOT EXISTS tsv tsvector GENERATED ALWAYS AS (
+    to_tsvector(CASE WHEN language = 'en' THEN 'english'::regconfig ELSE 'italian'::regconfig END, description)
+) STORED;
+
+CREATE INDEX IF NOT EXISTS chunk_embeddings_tsv_idx ON chunk_embeddings USING GIN (tsv);
@@ -0,0 +1,20 @@
+-- Claim protocol of file_processing_queue (see claim_queue_file): the failed flag becomes a status
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'failed'));
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS locked_by VARCHAR(255);
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'file_processing_queue' AND column_name = 'failed'
+    ) THEN
+        UPDATE file_processing_queue SET status = 'failed' WHERE failed;
+        ALTER TABLE file_processing_queue DROP COLUMN failed;
+    END IF;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS file_processing_queue_status_upload_date_idx ON file_processing_queue (status, upload_date);
@@ -0,0 +1,15 @@
+-- Wake up the ingestion workers (LISTEN file_processing_queue) when a file is queued
+CREATE OR REPLACE FUNCTION notify_file_processing_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('file_processing_queue', NEW.uploading_file_id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_notify_file_processing_queue ON file_processing_queue;
+
+CREATE TRIGGER trigger_notify_file_processing_queue
+    AFTER INSERT ON file_processing_queue
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_file_processing_queue();
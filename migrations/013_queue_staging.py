@@ -0,0 +1,43 @@
+"""
+Queued uploads move from file_processing_queue.file_data to the staging folder (see file_staging.py).
+
+The upload of every row still holding file_data is written to the staging folder, then the
+column is dropped. A row without any upload can't be processed and is marked as failed.
+"""
+
+import io
+import logging
+
+import file_staging
+
+
+def _has_column(cursor, table: str, column: str) -> bool:
+    cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s", (table, column))
+    return cursor.fetchone() is not None
+
+
+def migrate(conn) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute("ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS staged_path VARCHAR(1024)")
+        cursor.execute("ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64)")
+        cursor.execute("ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS size BIGINT NOT NULL DEFAULT 0")
+
+        if _has_column(cursor, "file_processing_queue", "file_data"):
+            cursor.execute("SELECT uploading_file_id FROM file_processing_queue WHERE staged_path IS NULL AND file_data IS NOT NULL")
+            for row in cursor.fetchall():
+                # One upload in memory at a time
+                cursor.execute("SELECT file_name, file_data FROM file_processing_queue WHERE uploading_file_id = %s", (row["uploading_file_id"],))
+                queued = cursor.fetchone()
+                staged_path, sha256, size = file_staging.stage_upload(io.BytesIO(queued["file_data"]), queued["file_name"])
+                cursor.execute(
+                    "UPDATE file_processing_queue SET staged_path = %s, sha256 = %s, size = %s, file_data = NULL WHERE uploading_file_id = %s",
+                    (staged_path, sha256, size, row["uploading_file_id"]),
+                )
+                logging.info(f"Staged queued file {row['uploading_file_id']} at {staged_path}")
+
+        cursor.execute(
+            "UPDATE file_processing_queue SET staged_path = '', sha256 = '', status = 'failed', last_error = 'No upload to stage' WHERE staged_path IS NULL"
+        )
+        cursor.execute("ALTER TABLE file_processing_queue ALTER COLUMN staged_path SET NOT NULL")
+        cursor.execute("ALTER TABLE file_processing_queue ALTER COLUMN sha256 SET NOT NULL")
+        cursor.execute("ALTER TABLE file_processing_queue DROP COLUMN IF EXISTS file_data")
@@ -0,0 +1,2 @@
+-- Content-addressed lookup of already processed uploads
+CREATE INDEX IF NOT EXISTS files_sha256_idx ON files (sha256);
@@ -0,0 +1,16 @@
+-- Retries with exponential backoff and per-page checkpoints of file_processing_queue
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE file_processing_queue ADD COLUMN IF NOT EXISTS checkpoint_page INTEGER NOT NULL DEFAULT 0;
+
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS file_processing_chunks (
+    uploading_file_id INTEGER REFERENCES file_processing_queue(uploading_file_id) ON DELETE CASCADE NOT NULL,
+    page_number INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    context TEXT NOT NULL,
+    image_path VARCHAR(255) NOT NULL,
+    embedding vector(1024) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS file_processing_chunks_uploading_file_id_page_number_idx ON file_processing_chunks (uploading_file_id, page_number);
@@ -4,7 +4,23 @@ from io import BytesIO
 import logging
 
 
-def blur_pages(doc: pymupdf.Document, excluded_pages: list[int], blur_strength: int = 0.2):
+# Scale at which redacted pages are rasterized
+REDACT_SCALE = 0.1
+
+
+def blur_pages(doc: pymupdf.Document, excluded_pages: list[int], blur_strength: int = 0.2, rasters=None):
+    """
+    Replace every page except excluded_pages with a low resolution raster of itself.
+
+    Args:
+        doc: PDF document, modified in place
+        excluded_pages: 1-based page numbers to leave untouched
+        blur_strength: Unused, kept for the blur filter
+        rasters: Optional PageRasterCache of doc, so pages already rendered by the other stages are reused
+
+    Returns:
+        The redacted document
+    """
     indexes = []
     for page_number in excluded_pages:
         if page_number > 0 and page_number <= doc.page_count:
@@ -16,8 +32,12 @@ def blur_pages(doc: pymupdf.Document, excluded_pages: list[int], blur_strength:
         if page_index in indexes:
             continue
         page: pymupdf.Page = doc.load_page(page_index)
-        mat: pymupdf.Matrix = pymupdf.Matrix(0.1, 0.1)
-        image: Image.Image = page.get_pixmap(matrix=mat).pil_image()  # .filter(ImageFilter.GaussianBlur(blur_strength))
+        if rasters is not None:
+            image: Image.Image = rasters.get(page_index, REDACT_SCALE)
+            rasters.release("redactor", page_index)
+        else:
+            mat: pymupdf.Matrix = pymupdf.Matrix(REDACT_SCALE, REDACT_SCALE)
+            image: Image.Image = page.get_pixmap(matrix=mat).pil_image()  # .filter(ImageFilter.GaussianBlur(blur_strength))
         bio = BytesIO()
         image.save(bio, format="PNG")
         bio.seek(0)
@@ -9,6 +9,7 @@ DROP TABLE IF EXISTS favourite_file CASCADE;
 DROP TABLE IF EXISTS chunk_embeddings CASCADE;
 DROP TABLE IF EXISTS review CASCADE;
 DROP TABLE IF EXISTS file_processing_queue CASCADE;
+DROP TABLE IF EXISTS file_processing_chunks CASCADE;
 
 CREATE EXTENSION IF NOT EXISTS vector;
 
@@ -80,6 +81,9 @@ CREATE TABLE IF NOT EXISTS files (
     vetrina_id INTEGER REFERENCES vetrina(vetrina_id) ON DELETE CASCADE
 );
 
+-- Content-addressed lookup of already processed uploads
+CREATE INDEX IF NOT EXISTS files_sha256_idx ON files (sha256);
+
 CREATE TABLE IF NOT EXISTS file_processing_queue (
     uploading_file_id SERIAL PRIMARY KEY,
     requester_id INTEGER REFERENCES users(user_id) ON DELETE CASCADE NOT NULL,
@@ -90,11 +94,36 @@ CREATE TABLE IF NOT EXISTS file_processing_queue (
     price REAL NOT NULL DEFAULT 0,
     tag VARCHAR(50),
     language VARCHAR(15) NOT NULL DEFAULT 'it',
-    file_data BYTEA,
+    staged_path VARCHAR(1024) NOT NULL,  -- Upload in the staging folder, see file_staging.py
+    sha256 VARCHAR(64) NOT NULL,
+    size BIGINT NOT NULL DEFAULT 0,
     upload_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    failed BOOLEAN NOT NULL DEFAULT FALSE
+    -- Claim protocol: pending -> processing (leased by locked_by until lease_expires_at) -> deleted or failed
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'failed')),
+    locked_by VARCHAR(255),
+    lease_expires_at TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    -- Retries with exponential backoff, failed rows are the dead letters
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- Number of pages already chunked and embedded, their results are in file_processing_chunks
+    checkpoint_page INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE INDEX IF NOT EXISTS file_processing_queue_status_upload_date_idx ON file_processing_queue (status, upload_date);
+
+-- Per-page progress of a queued file, so an interrupted ingestion resumes after the last completed page
+CREATE TABLE IF NOT EXISTS file_processing_chunks (
+    uploading_file_id INTEGER REFERENCES file_processing_queue(uploading_file_id) ON DELETE CASCADE NOT NULL,
+    page_number INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    context TEXT NOT NULL,
+    image_path VARCHAR(255) NOT NULL,
+    embedding vector(1024) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS file_processing_chunks_uploading_file_id_page_number_idx ON file_processing_chunks (uploading_file_id, page_number);
+
 CREATE TABLE IF NOT EXISTS transactions (
     transaction_id SERIAL PRIMARY KEY,
     user_id INTEGER REFERENCES users(user_id) NOT NULL,
@@ -128,7 +157,11 @@ CREATE TABLE IF NOT EXISTS chunk_embeddings (
     vetrina_id INTEGER REFERENCES vetrina(vetrina_id) ON DELETE CASCADE NOT NULL,
     file_id INTEGER REFERENCES files(file_id) ON DELETE CASCADE NOT NULL,
     image_path VARCHAR(255) NOT NULL,
-    embedding vector(1024) NOT NULL
+    embedding vector(1024) NOT NULL,
+    language VARCHAR(15) NOT NULL DEFAULT 'en',
+    tsv tsvector GENERATED ALWAYS AS (
+        to_tsvector(CASE WHEN language = 'en' THEN 'english'::regconfig ELSE 'italian'::regconfig END, description)
+    ) STORED
 );
 
 CREATE TABLE IF NOT EXISTS review (
@@ -155,6 +188,12 @@ CREATE TABLE IF NOT EXISTS follow (
 CREATE INDEX ON vetrina USING GIN (to_tsvector('english', description)) WHERE language = 'en';
 CREATE INDEX ON vetrina USING GIN (to_tsvector('italian', description)) WHERE language = 'it';
 
+CREATE INDEX IF NOT EXISTS chunk_embeddings_tsv_idx ON chunk_embeddings USING GIN (tsv);
+
+-- Approximate nearest-neighbour index for the semantic search (<#> is the negative inner product)
+-- Managed with database.create_vector_index / vector_index.py, tuned per query via hnsw.ef_search
+CREATE INDEX IF NOT EXISTS chunk_embeddings_embedding_idx ON chunk_embeddings USING hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64);
+
 
 -- Function to update vetrina review statistics
 CREATE OR REPLACE FUNCTION update_vetrina_review_stats()
@@ -364,6 +403,15 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- Function to wake up the ingestion workers when a file is queued
+CREATE OR REPLACE FUNCTION notify_file_processing_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('file_processing_queue', NEW.uploading_file_id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
 -- Create triggers for review table
 DROP TRIGGER IF EXISTS trigger_update_vetrina_stats_insert ON review;
 DROP TRIGGER IF EXISTS trigger_update_vetrina_stats_update ON review;
@@ -402,6 +450,14 @@ CREATE TRIGGER trigger_update_file_stats_delete
     FOR EACH ROW
     EXECUTE FUNCTION update_file_review_stats();
 
+-- Create trigger for file_processing_queue to notify the queue listener
+DROP TRIGGER IF EXISTS trigger_notify_file_processing_queue ON file_processing_queue;
+
+CREATE TRIGGER trigger_notify_file_processing_queue
+    AFTER INSERT ON file_processing_queue
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_file_processing_queue();
+
 -- Create triggers for files table to update vetrina tags and file count
 DROP TRIGGER IF EXISTS trigger_update_vetrina_tags_insert ON files;
 DROP TRIGGER IF EXISTS trigger_update_vetrina_tags_update ON files;
@@ -78,6 +78,9 @@ class SearchRequest(BaseModel):
     course_year: Optional[int] = Field(None, ge=1, le=6)
     tag: Optional[FileTag] = None
     extension: Optional[FileExtension] = None
+    # ANN tuning of the vector search, see database.set_vector_search_params
+    ef_search: Optional[int] = Field(None, ge=1, le=1000)
+    probes: Optional[int] = Field(None, ge=1, le=1000)
 
 
 # Response schemas removed - using standard Flask jsonify + to_dict() pattern 
\ No newline at end of file
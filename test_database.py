@@ -0,0 +1,131 @@
+"""
+Tests of the database connection handling and queue bookkeeping that don't need a PostgreSQL server:
+the pool is replaced by an in-memory one handing out a recording connection.
+"""
+
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip("psycopg")
+pytest.importorskip("psycopg_pool")
+pytest.importorskip("pgvector")
+
+import database
+
+
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.queries.append((query, params))
+        self.rowcount = 3
+
+    def fetchone(self):
+        return self.conn.row
+
+    def fetchall(self):
+        return self.conn.rows
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.queries = []
+        self.row = None  # Returned by fetchone
+        self.rows = []  # Returned by fetchall
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = RecordingConnection()
+        self.checkouts = 0
+
+    @contextmanager
+    def connection(self):
+        self.checkouts += 1
+        yield self.conn
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    fake = FakePool()
+    monkeypatch.setattr(database, "pool", fake)
+    return fake
+
+
+def test_connection_outside_app_context_uses_the_pool(fake_pool):
+    with database.connection() as conn:
+        assert conn is fake_pool.conn
+    assert fake_pool.checkouts == 1
+
+
+def test_database_function_outside_app_context(fake_pool):
+    assert database.requeue_failed_files() == 3
+    assert fake_pool.checkouts == 1
+    assert "file_processing_queue" in fake_pool.conn.queries[0][0]
+
+
+def test_retry_backoff_doubles_at_every_attempt():
+    assert [database.retry_backoff_seconds(attempts, 30, 3600) for attempts in (1, 2, 3, 4)] == [30, 60, 120, 240]
+
+
+def test_retry_backoff_is_capped():
+    assert database.retry_backoff_seconds(20, 30, 3600) == 3600
+
+
+def test_retry_backoff_of_a_first_attempt_is_the_base_delay():
+    # attempts is incremented by the claim, 0 only happens for rows released without being claimed
+    assert database.retry_backoff_seconds(0, 30, 3600) == 30
+
+
+def test_release_retries_a_file_with_attempts_left(fake_pool, tmp_path):
+    staged_path = tmp_path / "upload.pdf"
+    staged_path.write_bytes(b"%PDF-1.7")
+    fake_pool.conn.row = {"attempts": 2, "staged_path": str(staged_path)}
+
+    assert database.release_queue_file(1, "worker", "error", max_attempts=3, retry_base_seconds=30) == 60
+
+    update_params = fake_pool.conn.queries[1][1]
+    assert update_params["status"] == "pending"
+    assert update_params["retry_in"] == 60
+    assert update_params["staged_path"] == str(staged_path)
+    assert staged_path.exists()
+
+
+def test_release_fails_a_file_out_of_attempts_and_removes_its_upload(fake_pool, tmp_path):
+    staged_path = tmp_path / "upload.pdf"
+    staged_path.write_bytes(b"%PDF-1.7")
+    fake_pool.conn.row = {"attempts": 3, "staged_path": str(staged_path)}
+
+    assert database.release_queue_file(1, "worker", "error", max_attempts=3) is None
+
+    update_params = fake_pool.conn.queries[1][1]
+    assert update_params["status"] == "failed"
+    assert update_params["staged_path"] == ""
+    assert update_params["error"] == "error"
+    assert not staged_path.exists()
+
+
+def test_release_without_the_lease_changes_nothing(fake_pool):
+    fake_pool.conn.row = None
+
+    assert database.release_queue_file(1, "worker", "error", max_attempts=3) is None
+    assert len(fake_pool.conn.queries) == 1
+
+
+def test_checkpoint_chunks_of_the_resumed_page(fake_pool):
+    fake_pool.conn.rows = [{"page_number": 4, "description": "d", "context": "c", "image_path": "p.png"}]
+
+    assert database.get_checkpoint_chunks(7, 4) == fake_pool.conn.rows
+    assert fake_pool.conn.queries[0][1] == {"id": 7, "page": 4}
@@ -0,0 +1,116 @@
+"""
+Management command for the chunk_embeddings ANN index.
+
+Usage:
+    python vector_index.py create [hnsw|ivfflat] [--replace]
+    python vector_index.py reindex
+    python vector_index.py report [--queries 50] [--k 50] [--ef-search 20,40,100,200] [--probes 1,5,10,20]
+"""
+
+import argparse
+import logging
+import time
+from typing import Dict, List
+
+import numpy as np
+
+import database
+
+
+def _top_k(cursor, query_embedding: np.ndarray, k: int) -> List[int]:
+    cursor.execute(
+        "SELECT chunk_id FROM chunk_embeddings ORDER BY embedding <#> %s LIMIT %s",
+        (query_embedding, k),
+    )
+    return [row["chunk_id"] for row in cursor.fetchall()]
+
+
+def recall_latency_report(num_queries: int = 50, k: int = 50, ef_search_values: List[int] = [], probes_values: List[int] = []) -> List[Dict]:
+    """
+    Measure recall@k and latency of the ANN index against an exact scan.
+    Stored chunk embeddings are used as sample queries.
+
+    Args:
+        num_queries: Number of sample queries
+        k: Number of neighbours to compare (new_search uses 50)
+        ef_search_values: HNSW ef_search values to evaluate
+        probes_values: IVFFlat probes values to evaluate
+
+    Returns:
+        List of dicts with the setting, recall and p50/p95 latency in milliseconds
+    """
+    with database.connection() as conn:
+        with conn.cursor() as cursor:
+            # Each block below is its own transaction so SET LOCAL never leaks into the next measurement
+            with conn.transaction():
+                cursor.execute("SELECT embedding FROM chunk_embeddings ORDER BY random() LIMIT %s", (num_queries,))
+                queries = [row["embedding"] for row in cursor.fetchall()]
+
+            # Ground truth with a sequential scan
+            exact = []
+            exact_latencies = []
+            with conn.transaction():
+                cursor.execute("SET LOCAL enable_indexscan = off")
+                for query_embedding in queries:
+                    start = time.perf_counter()
+                    exact.append(set(_top_k(cursor, query_embedding, k)))
+                    exact_latencies.append((time.perf_counter() - start) * 1000)
+
+            results = [{"setting": "exact", "recall": 1.0, "p50_ms": np.percentile(exact_latencies, 50), "p95_ms": np.percentile(exact_latencies, 95)}]
+
+            settings = [("ef_search", value) for value in ef_search_values] + [("probes", value) for value in probes_values]
+            for name, value in settings:
+                recalls = []
+                latencies = []
+                for query_embedding, truth in zip(queries, exact):
+                    with conn.transaction():
+                        database.set_vector_search_params(cursor, **{name: value})
+                        start = time.perf_counter()
+                        approx = _top_k(cursor, query_embedding, k)
+                        latencies.append((time.perf_counter() - start) * 1000)
+                    recalls.append(len(truth.intersection(approx)) / max(len(truth), 1))
+                results.append(
+                    {
+                        "setting": f"{name}={value}",
+                        "recall": float(np.mean(recalls)),
+                        "p50_ms": np.percentile(latencies, 50),
+                        "p95_ms": np.percentile(latencies, 95),
+                    }
+                )
+            return results
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    parser = argparse.ArgumentParser(description="Manage the chunk_embeddings vector index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create")
+    create_parser.add_argument("method", nargs="?", choices=["hnsw", "ivfflat"], default=None)
+    create_parser.add_argument("--lists", type=int, default=None)
+    create_parser.add_argument("--replace", action="store_true")
+
+    subparsers.add_parser("reindex")
+
+    report_parser = subparsers.add_parser("report")
+    report_parser.add_argument("--queries", type=int, default=50)
+    report_parser.add_argument("--k", type=int, default=50)
+    report_parser.add_argument("--ef-search", type=_int_list, default=[20, 40, 100, 200])
+    report_parser.add_argument("--probes", type=_int_list, default=[])
+
+    args = parser.parse_args()
+
+    if args.command == "create":
+        database.create_vector_index(method=args.method, lists=args.lists, replace=args.replace)
+    elif args.command == "reindex":
+        database.reindex_vector_index()
+    elif args.command == "report":
+        print(database.get_vector_index_info())
+        print(f"{'setting':<16}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p95 ms':>10}")
+        for row in recall_latency_report(args.queries, args.k, args.ef_search, args.probes):
+            print(f"{row['setting']:<16}{row['recall']:>12.3f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}")
@@ -0,0 +1,96 @@
+"""
+Benchmark of the ingestion pipeline on local PDFs, without the queue and the database.
+
+Runs the same page pipeline as process_pending_files (render, chunk, score windows, embed,
+save chunk images, redact) and reports the throughput. With the heuristic or replay chunker
+backend it runs on a plain Linux box without the LM Studio server. Chunk images are written to
+a temporary directory, removed at the end.
+
+Usage:
+    python benchmark_ingestion.py file.pdf [file.pdf ...] [--chunker heuristic|replay|lmstudio] [--record DIR]
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+import argparse
+import logging
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pymupdf
+from PIL import Image
+
+import config
+import redact
+from chunker import CHUNKER_SCALE
+from ingestion import REDACT_EXCLUDED_PAGES, RERANKER_SCALE, get_embedder, iter_enriched_pages
+from page_rasters import PageRasterCache
+from redact import REDACT_SCALE
+
+IMAGE_WRITE_WORKERS = int(os.getenv("IMAGE_WRITE_WORKERS", 8))  # Same setting as database.save_chunk_images
+
+
+def save_images_to(folder: str):
+    """save_images of iter_enriched_pages writing to folder, in parallel like database.save_chunk_images"""
+
+    def save_images(images: List[Image.Image]) -> List[str]:
+        image_names = [f"{uuid.uuid4()}.png" for _ in images]
+        with ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS) as executor:
+            list(executor.map(lambda args: args[0].save(os.path.join(folder, args[1])), zip(images, image_names)))
+        return image_names
+
+    return save_images
+
+
+def benchmark_file(path: str, images_folder: str) -> dict:
+    with pymupdf.open(path) as doc:
+        rasters = PageRasterCache(doc)
+        rasters.require("chunker", CHUNKER_SCALE)
+        rasters.require("reranker", RERANKER_SCALE)
+        rasters.require("redactor", REDACT_SCALE, pages=[i for i in range(doc.page_count) if i + 1 not in REDACT_EXCLUDED_PAGES])
+
+        start = time.perf_counter()
+        num_chunks = 0
+        for _, page_chunks in iter_enriched_pages(doc, path, rasters, save_images_to(images_folder), num_windows=8, window_height_percentage=0.42):
+            num_chunks += len(page_chunks)
+        pipeline_seconds = time.perf_counter() - start
+
+        redact.blur_pages(doc, REDACT_EXCLUDED_PAGES, rasters=rasters)
+        total_seconds = time.perf_counter() - start
+
+        return {
+            "file": path,
+            "pages": doc.page_count,
+            "chunks": num_chunks,
+            "renders": rasters.renders,
+            "pipeline_s": pipeline_seconds,
+            "total_s": total_seconds,
+            "pages_per_s": doc.page_count / total_seconds if total_seconds else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion pipeline on local PDFs")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--chunker", choices=["lmstudio", "heuristic", "replay"], default=config.CHUNKER_BACKEND)
+    parser.add_argument("--record", default=None, help="Record the chunks in this directory, for the replay backend")
+    args = parser.parse_args()
+
+    config.CHUNKER_BACKEND = args.chunker
+    if args.record:
+        config.CHUNKER_RECORD_DIR = args.record
+
+    get_embedder()  # Loaded before timing, as the worker does at startup
+    print(f"{'file':<40}{'pages':>7}{'chunks':>8}{'renders':>9}{'total s':>10}{'pages/s':>9}")
+    with tempfile.TemporaryDirectory(prefix="benchmark_ingestion_") as images_folder:
+        for path in args.files:
+            row = benchmark_file(path, images_folder)
+            print(f"{row['file'][-40:]:<40}{row['pages']:>7}{row['chunks']:>8}{row['renders']:>9}{row['total_s']:>10.1f}{row['pages_per_s']:>9.2f}")
@@ -28,11 +28,12 @@ celery_app.conf.update(
     # Task timeout - increase for file processing
     task_time_limit=config.CELERY_TASK_TIME_LIMIT * 2,  # Double the time limit
     task_soft_time_limit=config.CELERY_TASK_SOFT_TIME_LIMIT * 2,
-    # Beat schedule configuration
+    # Beat schedule configuration: uploads are picked up through LISTEN/NOTIFY (queue_listener.py),
+    # the beat only catches expired leases and notifications missed while the listener was down
     beat_schedule={
         'process-pending-files': {
             'task': 'celery_worker.process_pending_files',
-            'schedule': 30.0,  # Run every 30 seconds
+            'schedule': config.QUEUE_POLL_SECONDS,
         },
     },
     timezone='UTC',
@@ -1,23 +1,24 @@
-import hashlib
 import os
+import shutil
+import socket
+import threading
 import traceback
-from chunker import process_pdf_chunks
+import uuid
+from chunker import CHUNKER_SCALE
 import redact
-import torch
-import numpy as np
+from redact import REDACT_SCALE
 import logging
 import pymupdf
-from PIL import Image
-from io import BytesIO
-from typing import List, Dict, Union, Any
-from bge_model import Visualized_BGE
-from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+from typing import Dict, Any
+from celery.signals import worker_ready
+from page_rasters import PageRasterCache
 import dotenv
 
 dotenv.load_dotenv()
 
 # Import database functions and models
 import database
+import file_staging
 
 # Configure logging
 logging.basicConfig(
@@ -36,264 +37,218 @@ import config as config
 # Import the Celery app from celery_config
 from celery_config import celery_app as app
 
-model_path = os.path.join(MODELS_FOLDER, "Visualized_m3.pth")
+# Page pipeline (chunker, reranker, embedder), shared with benchmark_ingestion.py
+from ingestion import REDACT_EXCLUDED_PAGES, RERANKER_SCALE, get_embedder, iter_enriched_pages, reranker
 
-# Global model instances - embedder always loaded, reranker loaded on demand
-embedder = Visualized_BGE(model_weight=model_path, device="cpu")
-reranker = None
-reranker_processor = None
 
+@worker_ready.connect
+def warmup_models(**kwargs):
+    """Load the models when the worker starts instead of on the first upload"""
+    get_embedder()
+    if config.RERANKER_WARMUP:
+        reranker.warmup()
 
-def load_reranker():
-    """Load the reranker model temporarily for processing"""
-    global reranker, reranker_processor
 
-    if reranker is not None:
-        return
+class LeaseHeartbeat:
+    """Background thread renewing the lease of a claimed queue file while it is being processed."""
 
-    logger.info("Loading reranker model...")
+    def __init__(self, uploading_file_id: int, worker_id: str):
+        self.uploading_file_id = uploading_file_id
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"lease-heartbeat-{uploading_file_id}", daemon=True)
 
-    try:
-        reranker_processor = AutoProcessor.from_pretrained(os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct_processor"), local_files_only=True)
-        reranker = Qwen2VLForConditionalGeneration.from_pretrained(
-            os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct"),
-            device_map="auto",
-            local_files_only=True,
-        )
-        logger.info("Reranker model loaded successfully from local path")
-    except:
-        reranker_processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-2B-Instruct")
-        reranker = Qwen2VLForConditionalGeneration.from_pretrained(
-            "lightonai/MonoQwen2-VL-v0.1",
-            device_map="auto",
-        )
-        reranker_processor.save_pretrained(os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct_processor"))
-        reranker.save_pretrained(os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct"))
-        logger.info("Reranker model loaded successfully from HuggingFace and saved to local path")
-
-
-def unload_reranker():
-    """Unload the reranker model after processing"""
-    global reranker, reranker_processor
-
-    if reranker is not None:
-        logger.info("Unloading reranker model...")
-        del reranker
-        del reranker_processor
-        reranker = None
-        reranker_processor = None
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        logger.info("Reranker model unloaded successfully")
-
-
-def compute_similarity_score(query: str, image: Image.Image) -> float:
-    """Compute relevance score using reranker model"""
-    logger.debug(f"Computing similarity score for query: {query[:50]}...")
-
-    # Reranker should already be loaded by the calling function
-
-    # Construct the prompt
-    prompt = ("Assert the relevance of the previous image document to the following query, " "answer True or False. The query is: {query}").format(
-        query=query
-    )
-
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": prompt},
-            ],
-        }
-    ]
-
-    # Apply chat template and tokenize
-    text = reranker_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = reranker_processor(text=text, images=image, return_tensors="pt").to("cuda")
-
-    # Run inference to obtain logits
-    with torch.no_grad():
-        outputs = reranker(**inputs)
-        logits_for_last_token = outputs.logits[:, -1, :]
-
-    # Convert tokens and calculate relevance score
-    true_token_id = reranker_processor.tokenizer.convert_tokens_to_ids("True")
-    false_token_id = reranker_processor.tokenizer.convert_tokens_to_ids("False")
-    relevance_score = torch.softmax(logits_for_last_token[:, [true_token_id, false_token_id]], dim=-1)
-
-    # Return True probability as the score
-    score = relevance_score[0, 0].item()
-    logger.debug(f"Similarity score computed: {score:.4f}")
-
-    # Free VRAM
-    del inputs, outputs, logits_for_last_token, relevance_score
-    torch.cuda.empty_cache()
-
-    return score
-
-
-def get_sentence_embedding(sentence: str) -> np.ndarray:
-    """Get sentence embedding using embedder model"""
-    logger.debug(f"Getting sentence embedding for: {sentence[:50]}...")
-
-    with torch.no_grad():
-        embedding = embedder.encode(text=sentence)[0].detach().cpu().numpy()
-        logger.debug(f"Sentence embedding computed with shape: {embedding.shape}")
-        return embedding
-
-
-def get_chunk_embeddings(description: str, image: Image.Image, context: str) -> np.ndarray:
-    """Get chunk embeddings using embedder model"""
-    logger.debug(f"Getting chunk embeddings for description: {description[:50]}...")
-
-    with torch.no_grad():
-        embedding = embedder.encode(image=image, text=f"{description} {context}")[0].detach().cpu().numpy()
-        logger.debug(f"Chunk embedding computed with shape: {embedding.shape}")
-        return embedding
-
-
-def retrieve_snippet_images(
-    doc: pymupdf.Document, snippets: List[Dict[str, Union[str, int]]], num_windows: int = 8, window_height_percentage: float = 0.35
-) -> List[Dict[str, Any]]:
-    """
-    Process snippets to add images and embeddings from PDF data in memory.
+    def __enter__(self) -> "LeaseHeartbeat":
+        self.thread.start()
+        return self
 
-    Args:
-        doc: PDF document
-        snippets: List of snippets to process
-        num_windows: Number of windows to extract (default: 8)
-        window_height_percentage: Height of each window as percentage of page height
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        self.thread.join()
 
-    Returns:
-        List of enriched snippets with images and embeddings
-    """
-    logger.info(f"Number of snippets to process: {len(snippets)}")
+    def _run(self) -> None:
+        while not self.stopped.wait(config.QUEUE_HEARTBEAT_SECONDS):
+            try:
+                if not database.heartbeat_queue_file(self.uploading_file_id, self.worker_id, config.QUEUE_LEASE_SECONDS):
+                    logger.warning(f"Lost the lease on queue file {self.uploading_file_id}")
+                    return
+            except Exception as e:
+                logger.error(f"Error renewing lease on queue file {self.uploading_file_id}: {e}")
 
-    # Load reranker for this processing session
-    load_reranker()
 
+def link_stored_file(source_name: str, target_name: str) -> None:
+    """Make target_name in FILES_FOLDER share the stored content of source_name (hard link, copy as fallback)."""
+    source_path = os.path.join(FILES_FOLDER, source_name)
+    target_path = os.path.join(FILES_FOLDER, target_name)
+    if os.path.exists(target_path):
+        os.remove(target_path)
     try:
-        page_images = []
-        logger.info("Loading PDF pages from memory...")
-
-        for page in doc:
-            page_images.append(page.get_pixmap(matrix=pymupdf.Matrix(2, 2)).pil_image())
-        logger.info(f"Loaded {len(page_images)} pages from PDF")
-
-        width, height = page_images[0].size
-        window_height = int(height * window_height_percentage)
-        step_size = (height - window_height) / (num_windows - 1) if num_windows > 1 else 0
-
-        for i, snippet in enumerate(snippets):
-            logger.info(f"Processing snippet {i+1}/{len(snippets)}")
-            page_number = snippet["page_number"]
-            description = snippet["description"]
-            page_image = page_images[page_number - 1]
-            logger.info(f"Snippet on page {page_number}, description: {description[:50]}...")
-
-            windows = []
-
-            for j in range(num_windows):
-                top = int(j * step_size)
-                if top + window_height > height:
-                    top = height - window_height
-
-                window_image = page_image.crop((0, top, width, top + window_height))
-                score = compute_similarity_score(description, window_image)
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
 
-                windows.append((window_image, float(score)))
-                logger.debug(f"Window {j+1}: top={top}, score={score:.4f}")
 
-            best_image = max(windows, key=lambda x: x[1])[0]
-            best_score = max(windows, key=lambda x: x[1])[1]
-            logger.info(f"Best window score: {best_score:.4f}")
-
-            snippet["image"] = best_image
-            embedding = get_chunk_embeddings(description, page_image, snippet["context"])
-            snippet["embedding"] = embedding
-            logger.info(f"Snippet {i+1} processing completed")
+def ingest_duplicate(pending_file: Dict[str, Any], worker_id: str) -> bool:
+    """
+    Ingest a queued file whose content was already processed, reusing the stored files, chunk
+    descriptions, window images and embeddings of the first file with the same sha256.
+    The stored files are linked inside the transaction and removed again if it is rolled back.
 
-        logger.info("All snippets processed successfully")
-        return snippets
+    Returns:
+        True if the file was a duplicate and has been ingested, False if it must be processed
+    """
+    linked = []
+    try:
+        with database.connection() as conn:
+            with conn.cursor() as cursor:
+                with conn.transaction():
+                    source_file = database.find_processed_file_by_sha256(cursor, pending_file["sha256"])
+                    if source_file is None:
+                        return False
+
+                    for source_name, target_name in (
+                        (source_file.filename, pending_file["file_name"]),
+                        (source_file.filename + "_redacted.pdf", pending_file["file_name"] + "_redacted.pdf"),
+                    ):
+                        link_stored_file(source_name, target_name)
+                        linked.append(target_name)
+
+                    db_file = database.add_file_to_vetrina(
+                        cursor=cursor,
+                        requester_id=pending_file["requester_id"],
+                        vetrina_id=pending_file["vetrina_id"],
+                        file_name=pending_file["file_name"],
+                        sha256=pending_file["sha256"],
+                        extension=pending_file["extension"],
+                        price=pending_file["price"],
+                        size=pending_file["size"],
+                        tag=pending_file["tag"],
+                        language=pending_file["language"],
+                        num_pages=source_file.num_pages,
+                        display_name=pending_file["display_name"],
+                    )
+                    num_chunks = database.copy_chunk_embeddings(cursor, source_file.file_id, pending_file["vetrina_id"], db_file.file_id)
+                    database.complete_queue_file(cursor, pending_file["uploading_file_id"], worker_id)
+    except BaseException:
+        # The transaction was rolled back, don't leave the linked files in FILES_FOLDER
+        for target_name in linked:
+            try:
+                os.remove(os.path.join(FILES_FOLDER, target_name))
+            except OSError as e:
+                logger.error(f"Error removing linked file {target_name}: {e}")
+        raise
 
-    finally:
-        # Always unload reranker after processing
-        unload_reranker()
+    file_staging.remove_staged_file(pending_file["staged_path"])
+    logger.info(f"Queue file {pending_file['uploading_file_id']} is a duplicate of file {source_file.file_id}, reused {num_chunks} chunks")
+    return True
 
 
 @app.task(bind=True, name="celery_worker.process_pending_files")
 def process_pending_files(self):
     """
-    Periodic task to process pending files from the queue.
-    This task runs every 30 seconds and processes ALL pending files until the queue is empty.
-    Each file is processed one at a time.
+    Task processing ALL pending files of the queue until it is empty.
+    It is enqueued by queue_listener.py as soon as a file is queued (LISTEN/NOTIFY), the beat schedule
+    (every QUEUE_POLL_SECONDS) is only a fallback that also picks up expired leases and due retries.
+    Files are claimed one at a time with a lease, so any number of workers can run this task concurrently.
+    Every completed page is checkpointed, so a retried file resumes after its last completed page.
     """
     logger.info("Starting periodic file processing - checking for pending files...")
 
+    # Identifies this task run in file_processing_queue.locked_by (computed here, after any fork)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
     while True:
-        with database.connect() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    """
-                    SELECT * FROM file_processing_queue 
-                    WHERE failed = FALSE
-                    ORDER BY upload_date ASC 
-                    LIMIT 1
-                    """
-                )
-                pending_file = cursor.fetchone()
-                if not pending_file:
-                    break
+        pending_file = database.claim_queue_file(worker_id, config.QUEUE_LEASE_SECONDS, config.QUEUE_MAX_ATTEMPTS)
+        if not pending_file:
+            break
+        logger.info(f"Claimed queue file {pending_file['uploading_file_id']} (attempt {pending_file['attempts']})")
 
         # Process the PDF file (outside database transaction to avoid timeouts)
         try:
-            with pymupdf.open(stream=BytesIO(pending_file["file_data"]), filetype="pdf") as doc:
-                chunks = process_pdf_chunks(doc, pending_file["display_name"], "")
-                logger.info(f"Generated {len(chunks)} chunks")
-                num_pages = doc.page_count
-                doc.save(os.path.join(FILES_FOLDER, pending_file["file_name"]))
-
-                enriched_chunks = retrieve_snippet_images(doc, chunks, num_windows=8, window_height_percentage=0.42)
-                logger.info(f"Enriched {len(enriched_chunks)} chunks")
-
-                redacted_doc = redact.blur_pages(doc, [1])
-                redacted_doc.save(os.path.join(FILES_FOLDER, pending_file["file_name"] + "_redacted.pdf"))
-
-            # Now save to database with vector support
-            with database.connect(vector=True) as conn:
-                with conn.cursor() as cursor:
-                    with conn.transaction():
-                        db_file = database.add_file_to_vetrina(
-                            cursor=cursor,
-                            requester_id=pending_file["requester_id"],
-                            vetrina_id=pending_file["vetrina_id"],
-                            file_name=pending_file["file_name"],
-                            sha256=hashlib.sha256(pending_file["file_data"]).hexdigest(),
-                            extension=pending_file["extension"],
-                            price=pending_file["price"],
-                            size=len(pending_file["file_data"]),
-                            tag=pending_file["tag"],
-                            language=pending_file["language"],
-                            num_pages=num_pages,
-                            display_name=pending_file["display_name"],
-                        )
-
-                        database.insert_chunk_embeddings(pending_file["vetrina_id"], db_file.file_id, enriched_chunks, cursor)
-                        cursor.execute("DELETE FROM file_processing_queue WHERE uploading_file_id = %s", (pending_file["uploading_file_id"],))
-                        pending_file = None
+            # Identical content was already chunked and embedded, copy it instead of running the pipeline again
+            if ingest_duplicate(pending_file, worker_id):
+                continue
+
+            with LeaseHeartbeat(pending_file["uploading_file_id"], worker_id):
+                # Pages completed by a previous attempt are not processed again
+                start_page = pending_file["checkpoint_page"]
+                previous_chunks = database.get_checkpoint_chunks(pending_file["uploading_file_id"], start_page) if start_page > 0 else None
+                if start_page > 0:
+                    logger.info(f"Resuming queue file {pending_file['uploading_file_id']} after page {start_page}")
+
+                # Opened from the staging folder, the upload is never loaded in memory as a whole
+                with pymupdf.open(pending_file["staged_path"], filetype="pdf") as doc:
+                    # Page rasters are shared by all stages, rendered again only for a larger scale
+                    rasters = PageRasterCache(doc)
+                    rasters.require("chunker", CHUNKER_SCALE, pages=range(start_page, doc.page_count))
+                    rasters.require("reranker", RERANKER_SCALE, pages=range(start_page, doc.page_count))
+                    rasters.require("redactor", REDACT_SCALE, pages=[i for i in range(doc.page_count) if i + 1 not in REDACT_EXCLUDED_PAGES])
+
+                    num_pages = doc.page_count
+                    doc.save(os.path.join(FILES_FOLDER, pending_file["file_name"]))
+
+                    for page_number, page_chunks in iter_enriched_pages(
+                        doc,
+                        pending_file["display_name"],
+                        rasters,
+                        database.save_chunk_images,
+                        num_windows=8,
+                        window_height_percentage=0.42,
+                        start_page=start_page,
+                        previous_chunks=previous_chunks,
+                    ):
+                        database.checkpoint_queue_page(pending_file["uploading_file_id"], worker_id, page_number, page_chunks)
+
+                    redacted_doc = redact.blur_pages(doc, REDACT_EXCLUDED_PAGES, rasters=rasters)
+                    redacted_doc.save(os.path.join(FILES_FOLDER, pending_file["file_name"] + "_redacted.pdf"))
+
+                # Now save to database with vector support
+                with database.connection() as conn:
+                    with conn.cursor() as cursor:
+                        with conn.transaction():
+                            db_file = database.add_file_to_vetrina(
+                                cursor=cursor,
+                                requester_id=pending_file["requester_id"],
+                                vetrina_id=pending_file["vetrina_id"],
+                                file_name=pending_file["file_name"],
+                                sha256=pending_file["sha256"],
+                                extension=pending_file["extension"],
+                                price=pending_file["price"],
+                                size=pending_file["size"],
+                                tag=pending_file["tag"],
+                                language=pending_file["language"],
+                                num_pages=num_pages,
+                                display_name=pending_file["display_name"],
+                            )
+
+                            num_chunks = database.insert_checkpointed_chunk_embeddings(
+                                cursor, pending_file["uploading_file_id"], pending_file["vetrina_id"], db_file.file_id
+                            )
+                            logger.info(f"Stored {num_chunks} chunks")
+                            # Also drops the checkpointed chunks (ON DELETE CASCADE)
+                            database.complete_queue_file(cursor, pending_file["uploading_file_id"], worker_id)
+                file_staging.remove_staged_file(pending_file["staged_path"])
         except Exception as e:
             logger.error(f"Error processing file: {e} {traceback.format_exc()}")
             try:
-                pass
-                # cursor.execute(
-                #     "UPDATE file_processing_queue SET failed = TRUE WHERE uploading_file_id = %s", (pending_file["uploading_file_id"],)
-                # )
-                # conn.commit()
+                retry_in = database.release_queue_file(
+                    pending_file["uploading_file_id"],
+                    worker_id,
+                    str(e),
+                    config.QUEUE_MAX_ATTEMPTS,
+                    config.QUEUE_RETRY_BASE_SECONDS,
+                    config.QUEUE_RETRY_MAX_SECONDS,
+                )
+                if retry_in is None:
+                    logger.error(f"Queue file {pending_file['uploading_file_id']} failed {pending_file['attempts']} times, marked as failed")
+                else:
+                    # Wake up a worker when the backoff expires, the beat schedule is only a fallback
+                    logger.info(f"Retrying queue file {pending_file['uploading_file_id']} in {retry_in:.0f}s")
+                    self.apply_async(countdown=retry_in)
             except Exception as e:
-                logger.error(f"Error marking file as failed in file processing queue: {e}")
-            finally:
-                pending_file = None
+                logger.error(f"Error releasing file in file processing queue: {e}")
+        finally:
+            pending_file = None
 
     logger.info("No pending files found in queue")
     return {"message": "No pending files"}
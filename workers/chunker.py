@@ -1,111 +1,243 @@
 import lmstudio as lms
 import pymupdf
-import os
-import tempfile
 import json
-
-
-def extract_page_images(doc: pymupdf.Document):
-    """Extract images from PDF pages and return temporary file paths"""
-    images = []
-
-    for i in range(doc.page_count):
-        page = doc.load_page(i)
-        mat = pymupdf.Matrix(1.0, 1.0)  # Higher resolution for better OCR
-        image = page.get_pixmap(matrix=mat).pil_image()
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        image.save(temp_file.name, format="PNG")
-        temp_file.close()
-        images.append((temp_file, image))
-
-    return images
-
-
-def get_current_context_length(chat: lms.Chat, model: lms.LLM) -> int:
-    formatted = model.apply_prompt_template(chat)
-    return len(model.tokenize(formatted))
-
-
-def process_pdf_chunks(doc: pymupdf.Document, file_name: str, collection_name: str) -> list[dict[str, str | int]]:
-    """Process PDF one page at a time. Returns list of chunks."""
-
-    # Specify the host IP and port
-    SERVER_API_HOST = "lancionaco.love:1234"
-
-    try:
-        # This must be the *first* convenience API interaction
-        lms.configure_default_client(SERVER_API_HOST)
-    except Exception as e:
-        pass
-
-    models = lms.list_loaded_models()
-    for model in models:
-        model.unload()
-
-    try:
-        model = lms.llm("google/gemma-3-12b", config={"contextLength": 6000, "gpu": {"ratio": 0.75}})
-        chat = lms.Chat()
-
-        schema = {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "description": {"type": "string"},
-                    "context":     {"type": "string"},
-                },
-                "required": ["description", "context"],
-                "additionalProperties": False
-            }
-        }
-
-
-        chat.add_system_prompt(
-            """
-            I'm giving you images of pages of a pdf file, you are a bot that does visual pdf semantic chunking and produces texts destined to be transformed to embedding vectors, for a rag system.
-
-            HOW TO CHUNK: try to make the chunks based on titles, and try to make them corresponds to paragraphs. for example, a single chunk should contain a cluster of information related to the same concept. The goal is to do RAG on the chunks, so it is imperative to cluster any information that is relevant to the general concept of the chunk, in the same chunk, so don't split too much when you can make a bigger chunk that still makes sense. End a chunk only when the next part of the page begins to represent a different concept. Most of the time, a page contains multiple chunks, but you can still sometimes output 1 if the page is really all about one concept or example or formula. Don't leave stones unturned, but this doesn't mean that you can output a chunk that is too small if you can aggregate it with other information within the page.
-
-            HOW TO OUTPUT: output in json format, example: [{"description": "text1", "context": "context1"}, {"description": "Explanation for the variance formula", "context": "Statistics, Mathematics"}, ...]. When I give you other pages, you must remember the last chunk you outputted and continue from there. A chunk can begin in one page and end in another, but don't output chunks that we already outputted, even if in previous responses. Description field: Don't return the exact text, don't return data too specific, and don't return one-time details (data of an exercise), but a description of what the chunk is about or its topic, the description should just tell what information is inside. don't say "this chunk explains", or "this section", or "this part explains", just tell what the content is about. When the chunk is an explanation, say "Explanation of", if its an exercise "Exercise on", if its an example "example of", etc... context field: include context from the document to enhance the performance of the rag system. Make this context as small as possible. This context is meant to expand on the chunk content, and include stuff that you know because you have the full picture, for example the course, file name or field. don't be afraid to repeat context across chunks. Don't say "This content is part of" or stuff like that, just say the context. For example, if you have a chunk explaining derivatives, the context would be: "(General context around the chunk), Derivatives, Calculus 1, Mathematics". Generate chunks until all the pages are covered.
-            """
-        )
-
-        all_chunks = []
-        images = extract_page_images(doc)
-
-        # Process one page at a time
-        for current_page, (temp_image, _) in enumerate(images):
-            current_page += 1
-            file_handlers = [lms.prepare_image(src=temp_image.name)]
-            chat.add_user_message(
-                content=f"{file_name}, {collection_name}, Page: {current_page}", 
-                images=file_handlers
-            )
-
-            response = model.respond(chat, response_format=schema, config={"contextOverflowPolicy": "rollingWindow"})
+import sys
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from io import BytesIO
+from typing import Callable, Iterator
+
+import config
+import heuristic_chunker
+import replay_chunker
+from page_rasters import PageRasterCache
+
+# Scale at which pages are sent to the LLM
+CHUNKER_SCALE = 1.0
+
+
+def prepare_page_image(rasters: PageRasterCache, page_index: int) -> lms.FileHandle:
+    """Encode a page raster as PNG in memory and upload it to the LLM server"""
+    image = rasters.get(page_index, CHUNKER_SCALE)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return lms.prepare_image(buffer.getvalue(), name=f"page_{page_index + 1}.png")
+
+
+SYSTEM_PROMPT = """
+I'm giving you images of pages of a pdf file, you are a bot that does visual pdf semantic chunking and produces texts destined to be transformed to embedding vectors, for a rag system.
+
+HOW TO CHUNK: try to make the chunks based on titles, and try to make them corresponds to paragraphs. for example, a single chunk should contain a cluster of information related to the same concept. The goal is to do RAG on the chunks, so it is imperative to cluster any information that is relevant to the general concept of the chunk, in the same chunk, so don't split too much when you can make a bigger chunk that still makes sense. End a chunk only when the next part of the page begins to represent a different concept. Most of the time, a page contains multiple chunks, but you can still sometimes output 1 if the page is really all about one concept or example or formula. Don't leave stones unturned, but this doesn't mean that you can output a chunk that is too small if you can aggregate it with other information within the page.
+
+HOW TO OUTPUT: output in json format, example: [{"description": "text1", "context": "context1"}, {"description": "Explanation for the variance formula", "context": "Statistics, Mathematics"}, ...]. Together with a page I may give you a summary of the chunk that ended the previous page. A chunk can begin in one page and end in another: if the page starts by continuing that chunk, don't output it again, start from the next concept. If I don't give you the previous chunk and the page starts by continuing a concept from the previous page (no title, the first sentence or exercise starts before the page), output that continuation as the first chunk with "continues_previous": true. Description field: Don't return the exact text, don't return data too specific, and don't return one-time details (data of an exercise), but a description of what the chunk is about or its topic, the description should just tell what information is inside. don't say "this chunk explains", or "this section", or "this part explains", just tell what the content is about. When the chunk is an explanation, say "Explanation of", if its an exercise "Exercise on", if its an example "example of", etc... context field: include context from the document to enhance the performance of the rag system. Make this context as small as possible. This context is meant to expand on the chunk content, and include stuff that you know because you have the full picture, for example the course, file name or field. don't be afraid to repeat context across chunks. Don't say "This content is part of" or stuff like that, just say the context. For example, if you have a chunk explaining derivatives, the context would be: "(General context around the chunk), Derivatives, Calculus 1, Mathematics". Generate chunks until the whole page is covered.
+"""
+
+SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "description": {"type": "string"},
+            "context":     {"type": "string"},
+            "continues_previous": {"type": "boolean"},
+        },
+        "required": ["description", "context"],
+        "additionalProperties": False
+    }
+}
+
+# Model handle kept across documents, the model stays loaded on the LM Studio server
+_model: lms.LLM | None = None
+_model_lock = threading.Lock()
+
+
+def get_chunker_model() -> lms.LLM:
+    """Get the chunking model, loading it on the LM Studio server only if it isn't loaded already."""
+    global _model
+    with _model_lock:
+        if _model is None:
             try:
-                os.unlink(temp_image.name)
+                # This must be the *first* convenience API interaction
+                lms.configure_default_client(config.CHUNKER_SERVER_HOST)
             except Exception:
                 pass
 
-            chat.add_assistant_response(response)
-            temp_chunks = json.loads(response.content)
-            
-            # Update page_number for chunks from this page
-            for chunk in temp_chunks:
-                chunk['page_number'] = current_page
-            
-            all_chunks.extend(temp_chunks)
-            print(f"Page {current_page} processed, context length: {get_current_context_length(chat, model)}/{model.get_context_length()}")
-
+            # Free the server for the chunking model, unless it is already loaded
+            loaded = lms.list_loaded_models("llm")
+            if not any(model.identifier == config.CHUNKER_MODEL for model in loaded):
+                for model in lms.list_loaded_models():
+                    model.unload()
+
+            _model = lms.llm(config.CHUNKER_MODEL, config={"contextLength": 6000, "gpu": {"ratio": 0.75}})
+        return _model
+
+
+def reset_chunker_model() -> None:
+    """Forget the model handle (e.g. after a server error), the next call gets a fresh one."""
+    global _model
+    with _model_lock:
+        _model = None
+
+
+def summarize_chunk(chunk: dict[str, str | int] | None) -> str:
+    """Short summary of a chunk, sent with the next pages so the model knows where the previous page ended."""
+    if not chunk:
+        return ""
+    summary = f"{chunk['description']} ({chunk['context']})"
+    if len(summary) > config.CHUNKER_SUMMARY_CHARS:
+        summary = summary[: config.CHUNKER_SUMMARY_CHARS].rsplit(" ", 1)[0] + "..."
+    return summary
+
+
+def drop_continuation(page_chunks: list[dict[str, str | int]], trailing_chunk: dict[str, str | int] | None) -> list[dict[str, str | int]]:
+    """
+    Drop the first chunk of a page when the model flagged it as continuing the previous page, that concept
+    is already covered by trailing_chunk (the last chunk of the previous pages), as when the model knows it.
+    """
+    if page_chunks and page_chunks[0].get("continues_previous") and trailing_chunk is not None:
+        page_chunks = page_chunks[1:]
+    for chunk in page_chunks:
+        chunk.pop("continues_previous", None)
+    return page_chunks
+
+
+def chunk_page(model: lms.LLM, image: lms.FileHandle, file_name: str, collection_name: str, page_number: int, previous_summary: str) -> list[dict[str, str | int]]:
+    """Chunk a single page with a one-shot chat, returns its chunks"""
+    chat = lms.Chat(SYSTEM_PROMPT)
+    content = f"{file_name}, {collection_name}, Page: {page_number}"
+    if previous_summary:
+        content += f"\nPrevious chunk: {previous_summary}"
+    chat.add_user_message(content=content, images=[image])
+
+    response = model.respond(chat, response_format=SCHEMA)
+    chunks = json.loads(response.content)
+    for chunk in chunks:
+        chunk["page_number"] = page_number
+    return chunks
+
+
+def iter_llm_chunks(
+    doc: pymupdf.Document,
+    file_name: str,
+    collection_name: str,
+    rasters: PageRasterCache | None = None,
+    start_page: int = 0,
+    previous_chunks: list[dict[str, str | int]] | None = None,
+    concurrency: int = config.CHUNKER_CONCURRENCY,
+) -> Iterator[tuple[int, list[dict[str, str | int]]]]:
+    """
+    LM Studio chunker backend. Pages are sent to the LLM in windows of concurrency pages in parallel,
+    instead of the whole conversation the first page of a window carries the summary of the trailing
+    chunk of the previous window. The other pages don't know how the previous page ended, so the model
+    flags a chunk continuing it and drop_continuation removes it once the previous page is chunked.
+    With CHUNKER_FALLBACK set, pages whose request fails or takes more than CHUNKER_TIMEOUT_SECONDS
+    (from when it was sent) are chunked by the fallback backend instead.
+    """
+    if rasters is None:
+        rasters = PageRasterCache(doc)
+    concurrency = max(concurrency, 1)
+
+    model = get_chunker_model()
+    trailing_chunk = previous_chunks[-1] if previous_chunks else None
+    fallback_body_size = None
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="chunker")
+    try:
+        for window_start in range(start_page, doc.page_count, concurrency):
+            previous_summary = summarize_chunk(trailing_chunk)
+
+            # Pages are rendered and uploaded here, only the LLM requests run in parallel
+            futures = []
+            timed_out = False
+            for page_index in range(window_start, min(window_start + concurrency, doc.page_count)):
+                image = prepare_page_image(rasters, page_index)
+                rasters.release("chunker", page_index)
+                summary = previous_summary if page_index == window_start else ""
+                future = executor.submit(chunk_page, model, image, file_name, collection_name, page_index + 1, summary)
+                futures.append((page_index + 1, time.monotonic(), future))
+
+            for page_number, submitted_at, future in futures:
+                try:
+                    # The budget of a page runs from its request, not from when its turn to be collected comes
+                    timeout = max(config.CHUNKER_TIMEOUT_SECONDS - (time.monotonic() - submitted_at), 0) if config.CHUNKER_FALLBACK else None
+                    page_chunks = future.result(timeout=timeout)
+                except Exception as e:
+                    if isinstance(e, FuturesTimeoutError):
+                        timed_out = True
+                    else:
+                        reset_chunker_model()
+                    if config.CHUNKER_FALLBACK != "heuristic":
+                        raise
+                    logging.warning(f"LLM chunking of page {page_number} failed ({e!r}), using the heuristic chunker")
+                    if fallback_body_size is None:
+                        fallback_body_size = heuristic_chunker.body_font_size(rasters)
+                    page_text = rasters.page_text(page_number - 1, sort=True)
+                    page_chunks, _ = heuristic_chunker.chunk_page(page_text, page_number, file_name, collection_name, fallback_body_size)
+
+                page_chunks = drop_continuation(page_chunks, trailing_chunk)
+                if page_chunks:
+                    trailing_chunk = page_chunks[-1]
+                logging.info(f"Page {page_number} processed, {len(page_chunks)} chunks")
+                yield page_number, page_chunks
+
+            if timed_out:
+                # Timed out requests keep their thread until the server answers, the next windows get a fresh executor
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="chunker")
     finally:
-        model.unload()
-
+        # Don't wait for requests still running on the server
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Chunker backends, all with the iter_pdf_chunks interface:
+# (doc, file_name, collection_name, rasters, start_page, previous_chunks) -> (page_number, chunks) in page order
+CHUNKER_BACKENDS: dict[str, Callable[..., Iterator[tuple[int, list[dict[str, str | int]]]]]] = {
+    "lmstudio": iter_llm_chunks,
+    "heuristic": heuristic_chunker.iter_heuristic_chunks,
+    "replay": replay_chunker.iter_replayed_chunks,
+}
+
+
+def process_pdf_chunks(
+    doc: pymupdf.Document, file_name: str, collection_name: str, rasters: PageRasterCache | None = None, backend: str | None = None
+) -> list[dict[str, str | int]]:
+    """Chunk every page of the PDF. Returns list of chunks."""
+    all_chunks = []
+    for _, page_chunks in iter_pdf_chunks(doc, file_name, collection_name, rasters, backend=backend):
+        all_chunks.extend(page_chunks)
     return all_chunks
 
 
+def iter_pdf_chunks(
+    doc: pymupdf.Document,
+    file_name: str,
+    collection_name: str,
+    rasters: PageRasterCache | None = None,
+    start_page: int = 0,
+    previous_chunks: list[dict[str, str | int]] | None = None,
+    backend: str | None = None,
+) -> Iterator[tuple[int, list[dict[str, str | int]]]]:
+    """
+    Chunk the PDF page by page with the given backend (default: config.CHUNKER_BACKEND),
+    yielding (page_number, chunks) in page order.
+    To resume an interrupted run, start_page is the number of pages already processed and
+    previous_chunks the chunks of the last of them.
+    With CHUNKER_RECORD_DIR set, the chunks are recorded for the replay backend.
+    """
+    backend = backend or config.CHUNKER_BACKEND
+    if backend not in CHUNKER_BACKENDS:
+        raise ValueError(f"Unknown chunker backend {backend}, valid backends are: {', '.join(CHUNKER_BACKENDS)}")
+
+    pages = CHUNKER_BACKENDS[backend](doc, file_name, collection_name, rasters=rasters, start_page=start_page, previous_chunks=previous_chunks)
+    if config.CHUNKER_RECORD_DIR and backend != "replay":
+        pages = replay_chunker.record_chunks(pages, config.CHUNKER_RECORD_DIR, doc)
+    yield from pages
+
+
 if __name__ == "__main__":
     # Example usage
     doc = pymupdf.open("Statistics Exam - DONE.pdf")
-    process_pdf_chunks(doc, "Systems of linear equations", "Statistics")
+    process_pdf_chunks(doc, "Systems of linear equations", "Statistics", backend=sys.argv[1] if len(sys.argv) > 1 else None)
     doc.close()
@@ -38,6 +38,33 @@ DEFAULT_WINDOW_HEIGHT_PERCENTAGE = 0.35
 DEFAULT_EMBEDDING_TIMEOUT = 300  # 5 minutes
 DEFAULT_ENRICHMENT_TIMEOUT = 1800  # 30 minutes
 DEFAULT_CHUNK_PROCESSING_TIMEOUT = 2400  # 40 minutes
+CHUNKER_BACKEND = os.getenv("CHUNKER_BACKEND", "lmstudio")  # lmstudio, heuristic (local, text layer only) or replay
+CHUNKER_FALLBACK = os.getenv("CHUNKER_FALLBACK", "")  # "heuristic" to chunk pages locally when the LLM fails or is saturated
+CHUNKER_TIMEOUT_SECONDS = float(os.getenv("CHUNKER_TIMEOUT_SECONDS", 300))  # LLM response time after which the fallback is used
+CHUNKER_RECORD_DIR = os.getenv("CHUNKER_RECORD_DIR")  # Record the chunks of every document here, for the replay backend
+CHUNKER_REPLAY_DIR = os.getenv("CHUNKER_REPLAY_DIR", "chunker_recordings")  # Recordings served by the replay backend
+CHUNKER_SERVER_HOST = os.getenv("CHUNKER_SERVER_HOST", "lancionaco.love:1234")  # LM Studio server
+CHUNKER_MODEL = os.getenv("CHUNKER_MODEL", "google/gemma-3-12b")
+CHUNKER_CONCURRENCY = int(os.getenv("CHUNKER_CONCURRENCY", 4))  # Pages chunked in parallel, match the server parallel slots
+CHUNKER_SUMMARY_CHARS = int(os.getenv("CHUNKER_SUMMARY_CHARS", 300))  # Length of the previous chunk summary sent with the first page of each window
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 16))  # Chunks per embedder forward pass
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "fp32")  # fp32, bf16 or int8 (BGE encoder only), see benchmark_precision.py
+RERANKER_BATCH_SIZE = int(os.getenv("RERANKER_BATCH_SIZE", 8))  # (snippet, window) pairs per reranker forward pass
+PIPELINE_MAX_PAGES_IN_FLIGHT = int(os.getenv("PIPELINE_MAX_PAGES_IN_FLIGHT", 4))  # Chunked pages waiting for the reranker, bounds worker memory
+
+# Processing queue claim protocol
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", 300))  # A claimed file is retried by another worker after this
+QUEUE_HEARTBEAT_SECONDS = int(os.getenv("QUEUE_HEARTBEAT_SECONDS", 60))  # Lease renewal interval while processing
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", 3))  # Attempts before a file is marked as failed (dead letter)
+QUEUE_RETRY_BASE_SECONDS = float(os.getenv("QUEUE_RETRY_BASE_SECONDS", 30))  # Backoff before the first retry, doubled at every attempt
+QUEUE_RETRY_MAX_SECONDS = float(os.getenv("QUEUE_RETRY_MAX_SECONDS", 3600))  # Backoff cap
+QUEUE_NOTIFY_CHANNEL = "file_processing_queue"  # Channel notified by the insert trigger on file_processing_queue
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", 300))  # Fallback beat for expired leases and missed notifications
+
+# Model residency: the reranker stays loaded between files
+RERANKER_WARMUP = os.getenv("RERANKER_WARMUP", "1") == "1"  # Load the reranker when the worker starts
+RERANKER_IDLE_TIMEOUT = float(os.getenv("RERANKER_IDLE_TIMEOUT", 1800))  # Unload after 30 minutes without files
+MODEL_MIN_FREE_MEMORY = float(os.getenv("MODEL_MIN_FREE_MEMORY", 0.1))  # Unload an idle model below this free RAM/VRAM fraction
 
 # GPU configuration
 CUDA_DEVICE = os.getenv("CUDA_VISIBLE_DEVICES", "0") 
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""
+Local chunker backend: chunks pages from the PDF text layer, without any LLM.
+
+Headings are detected from the font size (or bold text slightly above the body size) of the
+PyMuPDF text blocks, and every heading starts a new chunk holding the text blocks that follow
+it. Much faster than the LLM backend and good enough for benchmarks, offline ingestion and as
+a fallback when the LLM server is saturated. Pages without a text layer (scans) get no chunks.
+"""
+
+from collections import Counter
+from typing import Iterator
+
+import pymupdf
+
+from page_rasters import PageRasterCache
+
+HEADING_SIZE_RATIO = 1.15  # A block whose font is this much larger than the body text is a heading
+HEADING_MAX_CHARS = 120  # Longer blocks are never headings
+CHUNK_MAX_CHARS = 1500  # A chunk is closed when its text grows beyond this
+DESCRIPTION_MAX_CHARS = 400
+FONT_SAMPLE_PAGES = 20  # Pages sampled to find the body font size
+
+
+def body_font_size(rasters: PageRasterCache) -> float:
+    """Most common font size of the document text, weighted by the number of characters."""
+    sizes = Counter()
+    page_count = rasters.doc.page_count
+    step = max(page_count // FONT_SAMPLE_PAGES, 1)
+    for page_index in range(0, page_count, step):
+        for block in rasters.page_text(page_index)["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    sizes[round(span["size"], 1)] += len(span["text"].strip())
+    return sizes.most_common(1)[0][0] if sizes else 0.0
+
+
+def _block_text(block: dict) -> tuple[str, float, bool]:
+    """Text, largest font size and whether all the text is bold, for a text block."""
+    spans = [span for line in block["lines"] for span in line["spans"] if span["text"].strip()]
+    text = " ".join(" ".join(span["text"] for span in line["spans"]).strip() for line in block["lines"])
+    size = max((span["size"] for span in spans), default=0.0)
+    bold = bool(spans) and all(span["flags"] & pymupdf.TEXT_FONT_BOLD for span in spans)
+    return " ".join(text.split()), size, bold
+
+
+def _make_chunk(heading: str | None, texts: list[str], file_name: str, collection_name: str, page_number: int) -> dict[str, str | int]:
+    text = " ".join(texts)
+    description = f"{heading}: {text}" if heading and text else heading or text
+    if len(description) > DESCRIPTION_MAX_CHARS:
+        description = description[:DESCRIPTION_MAX_CHARS].rsplit(" ", 1)[0] + "..."
+    context = ", ".join(part for part in (heading, file_name, collection_name) if part)
+    return {"description": description, "context": context, "page_number": page_number}
+
+
+def chunk_page(
+    page_text: dict, page_number: int, file_name: str, collection_name: str, body_size: float, heading: str | None = None
+) -> tuple[list[dict[str, str | int]], str | None]:
+    """
+    Chunk a page from its text blocks.
+
+    Args:
+        page_text: get_text("dict", sort=True) of the page, see PageRasterCache.page_text
+        body_size: Font size of the body text, see body_font_size
+        heading: Heading in effect at the start of the page (from the previous page)
+
+    Returns:
+        Tuple of (chunks of the page, heading in effect at the end of the page)
+    """
+    chunks = []
+    texts: list[str] = []
+    length = 0
+
+    for block in page_text["blocks"]:
+        if block["type"] != 0:
+            continue
+        text, size, bold = _block_text(block)
+        if not text:
+            continue
+
+        is_heading = len(text) <= HEADING_MAX_CHARS and (size >= body_size * HEADING_SIZE_RATIO or (bold and size >= body_size))
+        if is_heading or length > CHUNK_MAX_CHARS:
+            if texts:
+                chunks.append(_make_chunk(heading, texts, file_name, collection_name, page_number))
+            texts, length = [], 0
+        if is_heading:
+            heading = text
+        else:
+            texts.append(text)
+            length += len(text)
+
+    if texts:
+        chunks.append(_make_chunk(heading, texts, file_name, collection_name, page_number))
+    return chunks, heading
+
+
+def iter_heuristic_chunks(
+    doc: pymupdf.Document,
+    file_name: str,
+    collection_name: str,
+    rasters: PageRasterCache | None = None,
+    start_page: int = 0,
+    previous_chunks: list[dict[str, str | int]] | None = None,
+) -> Iterator[tuple[int, list[dict[str, str | int]]]]:
+    """
+    Chunker backend with the iter_pdf_chunks interface, chunking pages from their text layer.
+    The document is read through rasters, so the other pipeline stages can render pages concurrently.
+    """
+    if rasters is None:
+        rasters = PageRasterCache(doc)
+    body_size = body_font_size(rasters)
+    heading = None
+    for page_index in range(start_page, doc.page_count):
+        # The page image isn't needed, let the other stages shrink it
+        rasters.release("chunker", page_index)
+        page_chunks, heading = chunk_page(rasters.page_text(page_index, sort=True), page_index + 1, file_name, collection_name, body_size, heading)
+        yield page_index + 1, page_chunks
@@ -0,0 +1,271 @@
+"""
+Page pipeline of the ingestion: chunk -> score windows with the reranker -> embed -> save chunk images.
+
+Used by the queue worker (celery_worker.process_pending_files) and by benchmark_ingestion.py. It doesn't
+touch the database: the chunk images are saved by the save_images function the caller passes, and the
+embedder is loaded on first use, so importing this module has no side effect.
+"""
+
+import logging
+import os
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pymupdf
+import torch
+from PIL import Image
+from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+
+import config
+from bge_model import Visualized_BGE
+from chunker import iter_pdf_chunks
+from model_residency import ResidentModel
+from page_rasters import PageRasterCache
+
+logger = logging.getLogger(__name__)
+
+MODELS_FOLDER = os.getenv("MODELS_FOLDER")
+
+model_path = os.path.join(MODELS_FOLDER, "Visualized_m3.pth")
+
+# Scale at which pages are rendered for the reranker windows and the chunk embeddings
+RERANKER_SCALE = 2.0
+# Pages (1-based) left readable in the redacted preview
+REDACT_EXCLUDED_PAGES = [1]
+
+# Global model instances - embedder loaded on first use and kept, reranker kept resident while in use (see model_residency.py)
+_embedder: Optional[Visualized_BGE] = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder() -> Visualized_BGE:
+    """The chunk embedding model, loaded on first use"""
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = Visualized_BGE(model_weight=model_path, device="cpu", inference=True, precision=config.EMBEDDING_PRECISION)
+        return _embedder
+
+
+def load_reranker() -> Tuple[Qwen2VLForConditionalGeneration, Any]:
+    """Load the reranker model and its processor"""
+    try:
+        reranker_processor = AutoProcessor.from_pretrained(os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct_processor"), local_files_only=True)
+        reranker_model = Qwen2VLForConditionalGeneration.from_pretrained(
+            os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct"),
+            device_map="auto",
+            local_files_only=True,
+        )
+        logger.info("Reranker model loaded successfully from local path")
+    except:
+        reranker_processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-2B-Instruct")
+        reranker_model = Qwen2VLForConditionalGeneration.from_pretrained(
+            "lightonai/MonoQwen2-VL-v0.1",
+            device_map="auto",
+        )
+        reranker_processor.save_pretrained(os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct_processor"))
+        reranker_model.save_pretrained(os.path.join(MODELS_FOLDER, "Qwen2-VL-2B-Instruct"))
+        logger.info("Reranker model loaded successfully from HuggingFace and saved to local path")
+
+    # Batched scoring reads the logits of the last position
+    reranker_processor.tokenizer.padding_side = "left"
+    reranker_model.eval()
+    return reranker_model, reranker_processor
+
+
+reranker = ResidentModel(
+    "reranker",
+    load_reranker,
+    idle_timeout=config.RERANKER_IDLE_TIMEOUT,
+    min_free_memory=config.MODEL_MIN_FREE_MEMORY,
+)
+
+
+def compute_similarity_scores(pairs: List[Tuple[str, Image.Image]], batch_size: int = config.RERANKER_BATCH_SIZE) -> List[float]:
+    """
+    Compute relevance scores for (query, image) pairs using the reranker model.
+    Pairs are scored in padded batches of batch_size, one forward pass per batch.
+    """
+    batch_size = max(batch_size, 1)
+    logger.debug(f"Computing similarity scores for {len(pairs)} pairs in batches of {batch_size}")
+
+    with reranker.use() as (reranker_model, reranker_processor):
+        return _score_pairs(reranker_model, reranker_processor, pairs, batch_size)
+
+
+def _score_pairs(reranker_model, reranker_processor, pairs: List[Tuple[str, Image.Image]], batch_size: int) -> List[float]:
+    true_token_id = reranker_processor.tokenizer.convert_tokens_to_ids("True")
+    false_token_id = reranker_processor.tokenizer.convert_tokens_to_ids("False")
+
+    scores = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start : start + batch_size]
+
+        # Construct the prompts
+        texts = []
+        for query, image in batch:
+            prompt = (
+                "Assert the relevance of the previous image document to the following query, " "answer True or False. The query is: {query}"
+            ).format(query=query)
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image", "image": image},
+                        {"type": "text", "text": prompt},
+                    ],
+                }
+            ]
+            texts.append(reranker_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True))
+
+        # Prompts are left padded, so the last position is the last real token of every row
+        inputs = reranker_processor(text=texts, images=[image for _, image in batch], padding=True, return_tensors="pt").to(reranker_model.device)
+
+        # Run inference to obtain logits
+        with torch.no_grad():
+            outputs = reranker_model(**inputs)
+            logits_for_last_token = outputs.logits[:, -1, :]
+
+        # Return True probability as the score
+        relevance_score = torch.softmax(logits_for_last_token[:, [true_token_id, false_token_id]], dim=-1)
+        scores.extend(relevance_score[:, 0].float().cpu().tolist())
+
+        del inputs, outputs, logits_for_last_token, relevance_score
+
+    # Free VRAM
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    return scores
+
+
+def get_chunk_embeddings_batch(image: Image.Image, chunks: List[Dict[str, Any]], batch_size: int = config.EMBEDDING_BATCH_SIZE) -> List[np.ndarray]:
+    """Get the embeddings of all the chunks of a page image, with a single vision tower pass"""
+    logger.debug(f"Getting chunk embeddings for {len(chunks)} chunks")
+
+    texts = [f"{chunk['description']} {chunk['context']}" for chunk in chunks]
+    with torch.no_grad():
+        embeddings = get_embedder().encode_mm_batch([image], texts, [0] * len(texts), batch_size=batch_size).detach().cpu().numpy()
+    # One [1, hidden_dim] float32 array per chunk
+    return [embeddings[i : i + 1] for i in range(len(chunks))]
+
+
+def enrich_page_snippets(
+    page_image: Image.Image, page_number: int, page_snippets: List[Dict[str, Any]], num_windows: int, window_height_percentage: float
+) -> None:
+    """
+    Add the best matching window image and the embedding to the snippets of one page.
+    Snippets of the same page share the same windows, so all their (snippet, window) pairs are scored together.
+    """
+    logger.info(f"Processing {len(page_snippets)} snippets on page {page_number}")
+
+    width, height = page_image.size
+    window_height = int(height * window_height_percentage)
+    step_size = (height - window_height) / (num_windows - 1) if num_windows > 1 else 0
+
+    windows = []
+    for j in range(num_windows):
+        top = int(j * step_size)
+        if top + window_height > height:
+            top = height - window_height
+        windows.append(page_image.crop((0, top, width, top + window_height)))
+
+    pairs = [(snippet["description"], window_image) for snippet in page_snippets for window_image in windows]
+    scores = compute_similarity_scores(pairs)
+
+    for i, snippet in enumerate(page_snippets):
+        description = snippet["description"]
+        logger.info(f"Snippet on page {page_number}, description: {description[:50]}...")
+        window_scores = scores[i * num_windows : (i + 1) * num_windows]
+        for j, score in enumerate(window_scores):
+            logger.debug(f"Window {j+1}: score={score:.4f}")
+
+        best_window = int(np.argmax(window_scores))
+        logger.info(f"Best window score: {window_scores[best_window]:.4f}")
+
+        snippet["image"] = windows[best_window]
+
+    # The page image is shared by all its snippets, so the vision tower runs once per page
+    for snippet, embedding in zip(page_snippets, get_chunk_embeddings_batch(page_image, page_snippets)):
+        snippet["embedding"] = embedding
+
+
+def iter_enriched_pages(
+    doc: pymupdf.Document,
+    file_name: str,
+    rasters: PageRasterCache,
+    save_images: Callable[[List[Image.Image]], List[str]],
+    num_windows: int = 8,
+    window_height_percentage: float = 0.35,
+    max_pages_in_flight: int = config.PIPELINE_MAX_PAGES_IN_FLIGHT,
+    start_page: int = 0,
+    previous_chunks: Optional[List[Dict[str, Any]]] = None,
+) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+    """
+    Page-at-a-time ingestion pipeline: render -> chunk -> score windows -> embed -> save chunk images.
+    Processing starts after the first start_page pages, see iter_pdf_chunks for resuming.
+
+    The LLM chunker runs in a background thread and hands pages over through a bounded queue, so at most
+    max_pages_in_flight chunked pages (and their rasters) wait for the reranker. Chunk images are written
+    to disk with save_images (e.g. database.save_chunk_images, returning the file names) as soon as a page
+    is done, so the yielded chunks only hold their image_path and embedding and worker memory stays
+    O(pages in flight) instead of O(document).
+
+    Yields:
+        (page_number, enriched chunks) for each page, in page order
+    """
+    pages: "queue.Queue[Tuple[int, Any]]" = queue.Queue(maxsize=max(max_pages_in_flight, 1))
+    stopped = threading.Event()
+    done = object()
+
+    def put(item: Tuple[int, Any]) -> bool:
+        # Give up if the consumer stopped, instead of blocking forever on a full queue
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def chunk_pages() -> None:
+        try:
+            for page_number, page_chunks in iter_pdf_chunks(doc, file_name, "", rasters=rasters, start_page=start_page, previous_chunks=previous_chunks):
+                if not put((page_number, page_chunks)):
+                    return
+            put((0, done))
+        except BaseException as e:
+            put((0, e))
+
+    chunker_thread = threading.Thread(target=chunk_pages, name="pdf-chunker", daemon=True)
+    chunker_thread.start()
+    try:
+        # Keep the reranker loaded for the whole document, it stays resident afterwards for the next files
+        with reranker.use():
+            while True:
+                page_number, page_chunks = pages.get()
+                if page_chunks is done:
+                    break
+                if isinstance(page_chunks, BaseException):
+                    raise page_chunks
+
+                page_index = page_number - 1
+                if page_chunks:
+                    page_image = rasters.get(page_index, RERANKER_SCALE)
+                    enrich_page_snippets(page_image, page_number, page_chunks, num_windows, window_height_percentage)
+                    del page_image
+
+                    # Persist the window images now so the PIL images can be dropped
+                    image_names = save_images([chunk.pop("image") for chunk in page_chunks])
+                    for chunk, image_name in zip(page_chunks, image_names):
+                        chunk["image_path"] = image_name
+                rasters.release("reranker", page_index)
+
+                logger.info(f"Page {page_number} done, {pages.qsize()} pages waiting, {len(rasters.rasters)} rasters held")
+                yield page_number, page_chunks
+    finally:
+        stopped.set()
+        chunker_thread.join()
+        logger.info(f"Pipeline finished ({rasters.renders} page renders), image token cache: {get_embedder().image_token_cache.stats()}")
@@ -0,0 +1,122 @@
+"""
+Keeps a model resident in memory across tasks.
+
+The model is loaded on first use (or explicitly with warmup), kept warm between tasks and
+evicted by a background thread when it has been idle for idle_timeout seconds or when the
+machine runs low on memory while nobody is using it.
+"""
+
+import gc
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def available_memory_fraction() -> Optional[float]:
+    """Fraction of system memory available (MemAvailable / MemTotal), None if it can't be read."""
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        return meminfo["MemAvailable"] / meminfo["MemTotal"]
+    except (OSError, KeyError, ValueError, IndexError):
+        return None
+
+
+class ResidentModel:
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[], Any],
+        idle_timeout: float,
+        min_free_memory: float = 0.1,
+        check_interval: float = 30,
+    ):
+        """
+        Args:
+            name: Name used in the logs
+            loader: Function returning the loaded model (or any object holding it)
+            idle_timeout: Seconds without use after which the model is unloaded (0 disables it)
+            min_free_memory: Unload an idle model when less than this fraction of RAM/VRAM is free
+            check_interval: Seconds between idle/memory checks
+        """
+        self.name = name
+        self.loader = loader
+        self.idle_timeout = idle_timeout
+        self.min_free_memory = min_free_memory
+        self.check_interval = check_interval
+
+        self.model = None
+        self.users = 0
+        self.last_used = 0.0
+        self.loads = 0
+        self.lock = threading.RLock()
+        self.monitor: Optional[threading.Thread] = None
+
+    def warmup(self) -> None:
+        """Load the model now instead of on the first task."""
+        with self.use():
+            pass
+
+    @contextmanager
+    def use(self) -> Iterator[Any]:
+        """Get the model, loading it if needed. The model is never evicted while in use."""
+        with self.lock:
+            if self.model is None:
+                logger.info(f"Loading {self.name} model...")
+                start = time.perf_counter()
+                self.model = self.loader()
+                self.loads += 1
+                logger.info(f"{self.name} model loaded in {time.perf_counter() - start:.1f}s (load #{self.loads})")
+                self._start_monitor()
+            self.users += 1
+            model = self.model
+        try:
+            yield model
+        finally:
+            with self.lock:
+                self.users -= 1
+                self.last_used = time.monotonic()
+
+    def evict(self, reason: str = "requested") -> bool:
+        """Unload the model if it is loaded and not in use."""
+        with self.lock:
+            if self.model is None or self.users > 0:
+                return False
+            logger.info(f"Unloading {self.name} model ({reason})...")
+            self.model = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(f"{self.name} model unloaded")
+        return True
+
+    def _under_memory_pressure(self) -> bool:
+        if torch.cuda.is_available():
+            free, total = torch.cuda.mem_get_info()
+            if free / total < self.min_free_memory:
+                return True
+        available = available_memory_fraction()
+        return available is not None and available < self.min_free_memory
+
+    def _start_monitor(self) -> None:
+        if self.monitor is None or not self.monitor.is_alive():
+            self.monitor = threading.Thread(target=self._monitor, name=f"{self.name}-residency", daemon=True)
+            self.monitor.start()
+
+    def _monitor(self) -> None:
+        while True:
+            time.sleep(self.check_interval)
+            with self.lock:
+                if self.model is None:
+                    return
+                idle = self.users == 0 and self.idle_timeout > 0 and time.monotonic() - self.last_used > self.idle_timeout
+            if idle:
+                self.evict(f"idle for more than {self.idle_timeout:.0f}s")
+            elif self._under_memory_pressure():
+                self.evict("memory pressure")
@@ -0,0 +1,80 @@
+"""
+Shared page rasters for the ingestion pipeline.
+
+Each stage (chunker, reranker, redactor) declares the pages and scale it needs. A page is
+rendered at the scale requested, and only rendered again when a stage asks for a larger one;
+smaller scales are derived by downsampling. Rendering ahead at the largest scale still needed
+would keep every page waiting between stages at that scale. When a stage releases a page the
+raster is shrunk to what the remaining stages need, or dropped when no stage needs it anymore.
+
+PyMuPDF documents are not thread-safe: while the cache is shared between threads, every access
+to the document goes through it (get, page_text) so it is serialized by its lock.
+"""
+
+import logging
+import threading
+from typing import Dict, Iterable, Optional
+
+import pymupdf
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class PageRasterCache:
+    def __init__(self, doc: pymupdf.Document):
+        self.doc = doc
+        self.needs: Dict[int, Dict[str, float]] = {}  # page index -> {stage: scale}
+        self.rasters: Dict[int, tuple[float, Image.Image]] = {}  # page index -> (scale, image)
+        self.renders = 0
+        self.lock = threading.Lock()
+
+    def require(self, stage: str, scale: float, pages: Optional[Iterable[int]] = None) -> None:
+        """Declare that stage will need the given page indexes (default: all pages) at scale."""
+        with self.lock:
+            for page_index in range(self.doc.page_count) if pages is None else pages:
+                self.needs.setdefault(page_index, {})[stage] = scale
+
+    def get(self, page_index: int, scale: float) -> Image.Image:
+        """Get a page raster at scale, rendering it only if no raster at least as large is cached."""
+        with self.lock:
+            cached = self.rasters.get(page_index)
+            if cached is None or cached[0] < scale:
+                page = self.doc.load_page(page_index)
+                cached = (scale, page.get_pixmap(matrix=pymupdf.Matrix(scale, scale)).pil_image())
+                self.renders += 1
+                if self.needs.get(page_index):
+                    self.rasters[page_index] = cached
+            return self._downsample(cached, scale)
+
+    def page_text(self, page_index: int, sort: bool = False) -> dict:
+        """get_text("dict") of a page, under the lock shared with the renders."""
+        with self.lock:
+            return self.doc.load_page(page_index).get_text("dict", sort=sort)
+
+    def release(self, stage: str, page_index: int) -> None:
+        """Mark page_index as no longer needed by stage."""
+        with self.lock:
+            stages = self.needs.get(page_index, {})
+            stages.pop(stage, None)
+            cached = self.rasters.get(page_index)
+            if not stages:
+                self.needs.pop(page_index, None)
+                self.rasters.pop(page_index, None)
+            elif cached is not None and max(stages.values()) < cached[0]:
+                scale = max(stages.values())
+                self.rasters[page_index] = (scale, self._downsample(cached, scale))
+
+    def release_stage(self, stage: str) -> None:
+        """Mark every page as no longer needed by stage."""
+        for page_index in list(self.needs):
+            self.release(stage, page_index)
+
+    def _downsample(self, cached: tuple[float, Image.Image], scale: float) -> Image.Image:
+        # Only cached images are touched here, so pages rendered by one thread can be used by another
+        cached_scale, image = cached
+        if scale >= cached_scale:
+            return image
+        ratio = scale / cached_scale
+        size = (max(round(image.width * ratio), 1), max(round(image.height * ratio), 1))
+        return image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
@@ -0,0 +1,56 @@
+"""
+Listener that starts file processing as soon as a file is queued.
+
+The insert trigger on file_processing_queue sends a NOTIFY on config.QUEUE_NOTIFY_CHANNEL;
+this process LISTENs on a dedicated connection (blocking on the socket, no polling) and
+enqueues the processing task. Bursts of uploads are coalesced into a single task, which
+keeps claiming files until the queue is empty.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).absolute().parent.parent))
+import logging
+import time
+
+import database
+import config as config
+from celery_config import celery_app
+
+logger = logging.getLogger(__name__)
+
+PROCESS_TASK_NAME = "celery_worker.process_pending_files"
+COALESCE_SECONDS = 0.2  # Notifications arriving within this window trigger a single task
+RECONNECT_SECONDS = 5
+
+
+def enqueue_processing() -> None:
+    celery_app.send_task(PROCESS_TASK_NAME)
+
+
+def listen() -> None:
+    """Listen for queued files forever, reconnecting if the database connection drops."""
+    while True:
+        try:
+            with database.connect(autocommit=True, vector=False) as conn:
+                conn.execute(f"LISTEN {config.QUEUE_NOTIFY_CHANNEL}")
+                logger.info(f"Listening on channel {config.QUEUE_NOTIFY_CHANNEL}")
+
+                # Files queued while nobody was listening
+                enqueue_processing()
+
+                while True:
+                    # Block until the first notification, then drain the rest of the burst
+                    notifies = list(conn.notifies(stop_after=1))
+                    notifies.extend(conn.notifies(timeout=COALESCE_SECONDS))
+                    logger.info(f"Queue files {[n.payload for n in notifies]} added, enqueueing processing task")
+                    enqueue_processing()
+        except Exception as e:
+            logger.error(f"Queue listener error: {e}, reconnecting in {RECONNECT_SECONDS}s")
+            time.sleep(RECONNECT_SECONDS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    listen()
@@ -0,0 +1,88 @@
+"""
+Recorded chunker responses.
+
+With CHUNKER_RECORD_DIR set, the chunks produced for every page are appended to
+<dir>/<document sha256>.jsonl. The replay backend serves them back for the same document,
+so the rest of the ingestion pipeline can be benchmarked and regression tested without
+the LLM server.
+"""
+
+import hashlib
+import json
+import os
+from typing import Iterator
+
+import pymupdf
+
+import config
+from page_rasters import PageRasterCache
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def document_key(doc: pymupdf.Document) -> str:
+    """sha256 of the document content, read from disk when the document was opened from a file."""
+    sha256 = hashlib.sha256()
+    if doc.name and os.path.isfile(doc.name):
+        with open(doc.name, "rb") as f:
+            while data := f.read(READ_BUFFER_SIZE):
+                sha256.update(data)
+    else:
+        sha256.update(doc.tobytes())
+    return sha256.hexdigest()
+
+
+def recording_path(directory: str, doc: pymupdf.Document) -> str:
+    return os.path.join(directory, f"{document_key(doc)}.jsonl")
+
+
+def record_chunks(
+    pages: Iterator[tuple[int, list[dict[str, str | int]]]], directory: str, doc: pymupdf.Document
+) -> Iterator[tuple[int, list[dict[str, str | int]]]]:
+    """Pass pages through while appending them to the recording of doc."""
+    os.makedirs(directory, exist_ok=True)
+    path = recording_path(directory, doc)
+    for page_number, page_chunks in pages:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"page_number": page_number, "chunks": page_chunks}) + "\n")
+        yield page_number, page_chunks
+
+
+def load_recording(directory: str, doc: pymupdf.Document) -> dict[int, list[dict[str, str | int]]]:
+    """Recorded chunks of doc by page number, the last recording of a page wins."""
+    path = recording_path(directory, doc)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No recorded chunks for {doc.name or 'document'} in {directory}")
+    pages = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                pages[record["page_number"]] = record["chunks"]
+    return pages
+
+
+def iter_replayed_chunks(
+    doc: pymupdf.Document,
+    file_name: str,
+    collection_name: str,
+    rasters: PageRasterCache | None = None,
+    start_page: int = 0,
+    previous_chunks: list[dict[str, str | int]] | None = None,
+    directory: str | None = None,
+) -> Iterator[tuple[int, list[dict[str, str | int]]]]:
+    """
+    Chunker backend with the iter_pdf_chunks interface, replaying the chunks recorded for doc.
+
+    Raises:
+        FileNotFoundError: If doc was never recorded
+        KeyError: If a page is missing from the recording
+    """
+    recording = load_recording(directory or config.CHUNKER_REPLAY_DIR, doc)
+    for page_index in range(start_page, doc.page_count):
+        if rasters is not None:
+            rasters.release("chunker", page_index)
+        page_number = page_index + 1
+        if page_number not in recording:
+            raise KeyError(f"Page {page_number} is missing from the recorded chunks")
+        yield page_number, [dict(chunk) for chunk in recording[page_number]]
@@ -14,6 +14,7 @@ from celery_config import celery_app
 
 # Explicitly import the celery_worker module to register tasks
 import celery_worker as celery_worker
+import queue_listener
 
 def ensure_temp_dir():
     """Ensure the temporary directory exists for PID files"""
@@ -77,7 +78,7 @@ def start_beat():
     ]
     
     print("Starting Celery beat scheduler...")
-    print("Beat will trigger periodic file processing every 30 seconds")
+    print("Beat will trigger fallback file processing every few minutes")
     
     # Start the beat scheduler using the celery_app directly
     celery_app.control.purge()  # Clear any old tasks
@@ -104,15 +105,24 @@ def run_beat_in_thread():
     except Exception as e:
         print(f"Error starting beat scheduler: {e}")
 
+def start_listener():
+    """Start the queue listener that enqueues processing as soon as a file is uploaded"""
+    print("Starting queue listener...")
+    queue_listener.listen()
+
 def start_combined():
     """Start both worker and beat in separate processes"""
     print("Starting Celery file processing system...")
-    print("This will start both the worker and beat scheduler")
+    print("This will start the worker, the beat scheduler and the queue listener")
     print("Press Ctrl+C to stop both processes")
     
     # Start beat scheduler in a separate thread
     beat_thread = Thread(target=run_beat_in_thread, daemon=True)
     beat_thread.start()
+
+    # Start queue listener in a separate thread
+    listener_thread = Thread(target=start_listener, daemon=True)
+    listener_thread.start()
     
     try:
         # Give beat a moment to start
@@ -137,8 +147,10 @@ if __name__ == "__main__":
             start_worker()
         elif sys.argv[1] == "beat":
             start_beat()
+        elif sys.argv[1] == "listen":
+            start_listener()
         else:
-            print("Usage: python start_celery_worker.py [worker|beat]")
+            print("Usage: python start_celery_worker.py [worker|beat|listen]")
             print("Or run without arguments to start both")
     else:
         start_combined() 
\ No newline at end of file
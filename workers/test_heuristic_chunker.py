@@ -0,0 +1,64 @@
+"""
+Tests of the heuristic chunker on hand-built get_text("dict") pages, no PDF needed.
+"""
+
+import pytest
+
+pymupdf = pytest.importorskip("pymupdf")
+pytest.importorskip("PIL")
+
+import heuristic_chunker
+
+
+def block(text: str, size: float = 10.0, bold: bool = False) -> dict:
+    span = {"text": text, "size": size, "flags": pymupdf.TEXT_FONT_BOLD if bold else 0}
+    return {"type": 0, "lines": [{"spans": [span]}]}
+
+
+def chunk(*blocks, heading=None):
+    return heuristic_chunker.chunk_page({"blocks": list(blocks)}, 3, "notes.pdf", "Calculus", 10.0, heading)
+
+
+def test_heading_starts_a_chunk():
+    chunks, heading = chunk(
+        block("Integrals", size=14),
+        block("Definition of the Riemann integral."),
+        block("Derivatives", size=14),
+        block("Limit of the difference quotient."),
+    )
+
+    assert heading == "Derivatives"
+    assert [c["description"] for c in chunks] == [
+        "Integrals: Definition of the Riemann integral.",
+        "Derivatives: Limit of the difference quotient.",
+    ]
+    assert chunks[0]["context"] == "Integrals, notes.pdf, Calculus"
+    assert all(c["page_number"] == 3 for c in chunks)
+
+
+def test_bold_text_of_body_size_is_a_heading():
+    chunks, heading = chunk(block("Exercises", bold=True), block("Compute the integral of x squared."))
+
+    assert heading == "Exercises"
+    assert chunks[0]["description"] == "Exercises: Compute the integral of x squared."
+
+
+def test_heading_of_the_previous_page_carries_over():
+    chunks, heading = chunk(block("Continued proof of the theorem."), heading="Integrals")
+
+    assert heading == "Integrals"
+    assert chunks[0]["description"] == "Integrals: Continued proof of the theorem."
+
+
+def test_long_sections_are_split():
+    paragraph = "word " * (heuristic_chunker.CHUNK_MAX_CHARS // 5 + 1)
+    chunks, _ = chunk(block(paragraph), block(paragraph))
+
+    assert len(chunks) == 2
+
+
+def test_page_without_text_has_no_chunks():
+    chunks, heading = chunk({"type": 1}, block("   "))
+
+    assert chunks == []
+    assert heading is None
@@ -0,0 +1,83 @@
+"""
+Tests of the page raster reuse of PageRasterCache, on an in-memory PDF.
+"""
+
+import pytest
+
+pymupdf = pytest.importorskip("pymupdf")
+pytest.importorskip("PIL")
+
+from page_rasters import PageRasterCache
+
+
+@pytest.fixture
+def doc():
+    doc = pymupdf.open()
+    for _ in range(2):
+        doc.new_page(width=200, height=100)
+    yield doc
+    doc.close()
+
+
+def test_smaller_scale_reuses_the_cached_raster(doc):
+    rasters = PageRasterCache(doc)
+    rasters.require("reranker", 2.0)
+    rasters.require("redactor", 0.5)
+
+    assert rasters.get(0, 2.0).size == (400, 200)
+    assert rasters.get(0, 0.5).size == (100, 50)
+    assert rasters.renders == 1
+
+
+def test_page_is_rendered_at_the_requested_scale(doc):
+    rasters = PageRasterCache(doc)
+    rasters.require("chunker", 1.0)
+    rasters.require("reranker", 2.0)
+
+    assert rasters.get(0, 1.0).size == (200, 100)
+    assert rasters.rasters[0][0] == 1.0
+
+
+def test_larger_scale_renders_again(doc):
+    rasters = PageRasterCache(doc)
+    rasters.require("chunker", 1.0)
+    rasters.require("reranker", 2.0)
+
+    rasters.get(0, 1.0)
+    assert rasters.get(0, 2.0).size == (400, 200)
+    assert rasters.get(0, 1.0).size == (200, 100)
+    assert rasters.renders == 2
+
+
+def test_release_shrinks_the_raster_to_the_remaining_stages(doc):
+    rasters = PageRasterCache(doc)
+    rasters.require("reranker", 2.0)
+    rasters.require("redactor", 0.5)
+    rasters.get(0, 2.0)
+
+    rasters.release("reranker", 0)
+    scale, image = rasters.rasters[0]
+    assert scale == 0.5
+    assert image.size == (100, 50)
+
+    rasters.release("redactor", 0)
+    assert 0 not in rasters.rasters
+
+
+def test_pages_no_stage_needs_are_not_cached(doc):
+    rasters = PageRasterCache(doc)
+    rasters.require("redactor", 0.5, pages=[0])
+
+    rasters.get(1, 1.0)
+    assert rasters.rasters == {}
+
+
+def test_release_stage_releases_every_page(doc):
+    rasters = PageRasterCache(doc)
+    rasters.require("chunker", 1.0)
+    for page_index in range(doc.page_count):
+        rasters.get(page_index, 1.0)
+
+    rasters.release_stage("chunker")
+    assert rasters.rasters == {}
+    assert rasters.needs == {}